@@ -2,10 +2,9 @@ from django import forms
 from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.contrib.auth.forms import PasswordChangeForm
 from django.forms.widgets import RadioSelect
-from ldap3.core.exceptions import LDAPInvalidCredentialsResult
 
 from members.models import Person, MembershipRequest, Instrument, User, UsernameValidator
-from sync.ldap import get_connection
+from sync.ldap import check_credentials
 
 
 class ProfileForm(forms.ModelForm):
@@ -26,16 +25,7 @@ class ProfileForm(forms.ModelForm):
 
 def try_ldap_bind(user, password):
     """Tries to bind (login) on LDAP with given credentials."""
-    conn = get_connection()
-    conn.user = user
-    conn.password = password
-    try:
-        conn.bind()
-    except LDAPInvalidCredentialsResult:
-        return False
-    finally:
-        conn.unbind()
-    return True
+    return check_credentials(user, password)
 
 
 class MyPasswordChangeForm(PasswordChangeForm):
@@ -0,0 +1,70 @@
+"""Asyncio interface for the Graph API, to do independent requests concurrently.
+
+The Graph client uses the blocking requests library. AsyncGraph runs its
+methods on worker threads using asyncio.to_thread(), with a semaphore that
+limits the number of requests in flight. The threads share the connection
+pool and the rate limiter of the Graph client, see sync.aad.graph.
+
+Coroutines are run with asyncio.run(), e.g. from a Django-Q task. They must
+not access the database, Django refuses that when an event loop is running.
+For instance, to get the users and groups at the same time:
+
+    client = AsyncGraph(graph)
+    users, groups = asyncio.run(client.gather(client.get_users(), client.get_groups()))
+"""
+import asyncio
+import functools
+from typing import Callable, Awaitable, List, Any, Iterable
+
+from django.conf import settings
+
+from sync.aad.graph import Graph
+
+
+class AsyncGraph:
+    """Graph API with the same methods as Graph, but as coroutines."""
+
+    def __init__(self, graph: Graph, concurrency: int = None):
+        """Constructs.
+
+        Args:
+            graph: The blocking client that is used.
+            concurrency: Maximum number of requests in flight, defaults to
+                the GRAPH_CONCURRENCY setting.
+        """
+        self.graph = graph
+        self.concurrency = concurrency or settings.GRAPH_CONCURRENCY
+        self._loop = None
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # A semaphore can only be used in a single event loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Runs a blocking function on a worker thread, when there's a free slot."""
+        async with self._get_semaphore():
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def gather(self, *aws: Awaitable) -> List[Any]:
+        """Waits for all given awaitables and returns their results in order."""
+        return list(await asyncio.gather(*aws))
+
+    async def map(self, func: Callable, *iterables: Iterable) -> List[Any]:
+        """Runs a blocking function concurrently for each set of arguments, in the way of the map builtin."""
+        return await self.gather(*(self.run(func, *args) for args in zip(*iterables)))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.graph, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return method
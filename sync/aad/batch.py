@@ -0,0 +1,219 @@
+"""Applies AAD sync operations using JSON batching.
+
+Operations that are a single API request are combined in $batch requests of
+up to 20 sub-requests, instead of a round trip per operation. Operations with
+a key in common, see SyncOperation.get_keys(), keep their order using
+dependsOn. Sub-requests that are throttled are retried in a next batch, see
+sync.aad.graph.is_retryable() and sync.aad.graph.get_retry_delay(). Several paged queries can be read in
+batches as well, see get_paged_batch().
+
+Docs: https://learn.microsoft.com/en-us/graph/json-batching
+"""
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from typing import List, Iterable, Dict, Optional, Tuple, Callable
+
+from requests import RequestException
+
+from sync.aad.asyncgraph import AsyncGraph
+from sync.aad.graph import Graph, is_retryable, get_retry_delay
+from sync.aad.operations import SyncOperation
+from sync.metrics import GRAPH_RETRIES
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 20
+"""Maximum number of sub-requests in a batch, imposed by the API."""
+
+FAILED_DEPENDENCY = 424
+
+BatchResult = namedtuple('BatchResult', ['operation', 'success', 'result', 'status'], defaults=[None])
+"""Outcome of an applied operation.
+
+The result is the response status code, or an error message when the
+operation failed or was skipped. The status is the response status code of
+the sub-request, if there was one.
+"""
+
+
+class BatchError(Exception):
+    """Raised when one or more operations failed to apply."""
+
+    def __init__(self, results: List[BatchResult]):
+        self.results = results
+        failed = [r for r in results if not r.success]
+        super().__init__('{} of {} operations failed: {}'.format(
+            len(failed), len(results), '; '.join('{}: {}'.format(r.operation, r.result) for r in failed)))
+
+
+class BatchExecutor:
+    """Applies operations in JSON batches, see module docstring."""
+
+    def __init__(self, graph: Graph, max_size=MAX_BATCH_SIZE, max_retries=3, sleep=time.sleep):
+        """Constructs.
+
+        Args:
+            graph: The API.
+            max_size: Maximum number of sub-requests per batch.
+            max_retries: Number of times a throttled sub-request is retried.
+            sleep: Function used to wait before a retry.
+        """
+        self.graph = graph
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.operations = []  # type: List[SyncOperation]
+        self.results = []  # type: List[Optional[BatchResult]]
+
+    def _done(self, i: int, success: bool, result, status: int = None):
+        self.results[i] = BatchResult(self.operations[i], success, result, status)
+
+    def apply(self, operations: Iterable[SyncOperation]) -> List[BatchResult]:
+        """Applies operations in batches.
+
+        Operations that are not a single request are applied on their own,
+        after the batch before them has been sent.
+
+        Returns:
+            A result for each operation, in the order of the operations.
+            Operations that share a key with a failed operation are skipped and
+            reported as failed.
+        """
+        self.operations = list(operations)
+        self.results = [None] * len(self.operations)
+        last = {}  # Key -> index of the last operation with that key
+        batch = []  # Tuples of (operation index, index of the operation it depends on or None)
+        for i, operation in enumerate(self.operations):
+            keys = operation.get_keys()
+            dependencies = {last[k] for k in keys if k in last}
+            last.update((k, i) for k in keys)
+            request = operation.get_request()
+            in_batch = dependencies & {j for j, _ in batch}
+            # A sub-request can only depend on a single other sub-request
+            if request is None or len(batch) >= self.max_size or len(in_batch) > 1:
+                self._send(batch)
+                batch, in_batch = [], set()
+            if any(self.results[j] and not self.results[j].success for j in dependencies):
+                self._done(i, False, 'skipped, an earlier operation on the object failed')
+            elif request is None:
+                self._apply_single(i)
+            else:
+                batch.append((i, next(iter(in_batch), None)))
+        self._send(batch)
+        return self.results
+
+    def _apply_single(self, i: int):
+        try:
+            self.operations[i].apply(self.graph)
+            self._done(i, True, None)
+        except RequestException as e:
+            self._done(i, False, str(e))
+
+    def _post(self, batch: List[Tuple[int, Optional[int]]]) -> Dict[int, Dict]:
+        """Sends a batch and returns the responses by operation index."""
+        requests = []
+        for i, dependency in batch:
+            method, resource, body = self.operations[i].get_request()
+            request = {'id': str(i), 'method': method, 'url': '/' + resource}
+            if body is not None:
+                request['body'] = body
+                request['headers'] = {'Content-Type': 'application/json'}
+            if dependency is not None:
+                request['dependsOn'] = [str(dependency)]
+            requests.append(request)
+        response = self.graph.call_resource('$batch', method='POST', json={'requests': requests})
+        return {int(r['id']): r for r in response.json()['responses']}
+
+    def _send(self, batch: List[Tuple[int, Optional[int]]]):
+        """Sends a batch and retries the throttled sub-requests."""
+        for attempt in range(self.max_retries + 1):
+            if not batch:
+                return
+            responses = self._post(batch)
+            retry, delay = [], 0.0
+            retry_ids = set()
+            for i, dependency in batch:
+                response = responses.get(i, {'status': 0, 'body': 'missing response'})
+                status = response['status']
+                if 200 <= status < 300:
+                    self._done(i, True, status, status)
+                elif is_retryable(self.operations[i].get_request().method, status) or (
+                        status == FAILED_DEPENDENCY and dependency in retry_ids):
+                    retry.append((i, dependency))
+                    retry_ids.add(i)
+                    delay = max(delay, get_retry_delay(response.get('headers', {}), attempt))
+                    GRAPH_RETRIES.inc(status=status)
+                else:
+                    self._done(i, False, '{}: {}'.format(status, response.get('body')), status)
+            # Dependencies that succeeded are dropped
+            batch = [(i, d if d in retry_ids else None) for i, d in retry]
+            if batch and attempt < self.max_retries:
+                logger.info('Retrying %d sub-requests in %.1f seconds', len(batch), delay)
+                self.sleep(delay)
+        for i, _ in batch:
+            self._done(i, False, 'throttled, gave up after {} retries'.format(self.max_retries))
+
+
+def get_batch(graph: Graph, urls: List[str]) -> List[Dict]:
+    """Sends a batch of GET sub-requests and returns the responses in the order of the URLs."""
+    requests = [{'id': str(i), 'method': 'GET', 'url': '/' + url} for i, url in enumerate(urls)]
+    response = graph.call_resource('$batch', method='POST', json={'requests': requests})
+    responses = {int(r['id']): r for r in response.json()['responses']}
+    return [responses.get(i, {'status': 0, 'body': 'missing response'}) for i in range(len(urls))]
+
+
+def get_paged_batch(graph: Graph,
+                    resources: List[str],
+                    max_size=MAX_BATCH_SIZE,
+                    max_retries=3,
+                    sleep: Callable[[float], None] = time.sleep,
+                    concurrency: int = None) -> Dict[str, List[Dict]]:
+    """Gets all results of several paged queries using JSON batching.
+
+    The batches are sent concurrently, see sync.aad.asyncgraph. The next pages
+    of the queries are requested in a following round of batches.
+
+    Args:
+        graph: The API.
+        resources: The queries, relative to the base URL and including the
+            query parameters, e.g. groups/{id}/members?$select=id.
+        max_size: Maximum number of sub-requests per batch.
+        max_retries: Number of times a throttled sub-request is retried.
+        sleep: Function used to wait before a retry.
+        concurrency: Maximum number of batches in flight, defaults to the
+            GRAPH_CONCURRENCY setting.
+
+    Returns:
+        The items of the `value` field of all pages, by resource.
+
+    Raises:
+        RequestException: When a query failed.
+    """
+    client = AsyncGraph(graph, concurrency)
+    results = {r: [] for r in resources}
+    queue = [(r, r, 0) for r in resources]  # Tuples of (resource, URL of the next page, attempt)
+    while queue:
+        chunks = [queue[i:i + max_size] for i in range(0, len(queue), max_size)]
+        responses = asyncio.run(client.map(get_batch, [graph] * len(chunks), [[u for _, u, _ in c] for c in chunks]))
+        pages = zip(queue, [r for chunk in responses for r in chunk])
+        queue = []
+        delay = 0.0
+        for (resource, url, attempt), response in pages:
+            status = response['status']
+            if 200 <= status < 300:
+                results[resource].extend(response['body']['value'])
+                next_link = response['body'].get('@odata.nextLink')
+                if next_link:
+                    queue.append((resource, next_link[len(graph.url) + 1:], 0))
+            elif is_retryable('GET', status) and attempt < max_retries:
+                queue.append((resource, url, attempt + 1))
+                delay = max(delay, get_retry_delay(response.get('headers', {}), attempt))
+                GRAPH_RETRIES.inc(status=status)
+            else:
+                raise RequestException('GET {} failed with {}: {}'.format(url, status, response.get('body')))
+        if delay:
+            logger.info('Retrying throttled queries in %.1f seconds', delay)
+            sleep(delay)
+    return results
@@ -0,0 +1,213 @@
+"""Persisted snapshot of the remote AAD users and groups, kept up to date using delta queries.
+
+Instead of paging through the whole tenant on each sync, users/delta and
+groups/delta only return the objects that changed since the delta link of the
+previous read. The changes are patched into the snapshot. When the delta link
+has expired, the API responds with 410 Gone and all objects are read again,
+which is also done periodically to catch anything that was missed.
+
+Delta queries can't expand extensions, so the extension of each object is
+kept in the snapshot as well. The extensions of objects that are new in the
+snapshot are read in JSON batches. An extension that is added to an existing
+object does not show up in the delta, so sync.aad.followup records it with
+remember_extension().
+
+Docs: https://learn.microsoft.com/en-us/graph/delta-query-overview
+"""
+import logging
+import time
+from datetime import timedelta
+from typing import List, Dict, Optional, Iterable, Callable
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from sync.aad.batch import MAX_BATCH_SIZE, get_batch
+from sync.aad.graph import Graph, GraphObject, GraphUser, GraphGroup, USER_FIELDS, GROUP_FIELDS, is_retryable, \
+    get_retry_delay
+from sync.aad.operations import SyncOperation, DeleteUserOperation, DeleteGroupOperation
+from sync.metrics import GRAPH_RETRIES
+from sync.models import AADSnapshot
+
+logger = logging.getLogger(__name__)
+
+GONE = 410
+NOT_FOUND = 404
+
+COLLECTIONS = {
+    'users': (GraphUser, USER_FIELDS),
+    'groups': (GraphGroup, GROUP_FIELDS),
+}
+
+
+class DeltaError(Exception):
+    """Raised when the extension of an object could not be read."""
+
+
+class DeltaSnapshot:
+    """Snapshot of the remote users or groups."""
+
+    def __init__(self, graph: Graph, collection: str, max_retries=3, sleep: Callable[[float], None] = time.sleep):
+        """Constructs.
+
+        Args:
+            graph: The API.
+            collection: Either 'users' or 'groups'.
+            max_retries: Number of times a throttled extension read is
+                retried.
+            sleep: Function used to wait before a retry.
+        """
+        self.graph = graph
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.collection = collection
+        self.object_class, self.fields = COLLECTIONS[collection]
+        self.model, _ = AADSnapshot.objects.get_or_create(collection=collection)
+
+    def needs_full_read(self) -> bool:
+        """Whether the snapshot is missing or older than the full read interval."""
+        if not self.model.delta_link or not self.model.full_read:
+            return True
+        interval = timedelta(hours=settings.GRAPH_DELTA_FULL_INTERVAL)
+        return timezone.now() - self.model.full_read > interval
+
+    def refresh(self, full=False) -> List[GraphObject]:
+        """Updates the snapshot from AAD and saves it.
+
+        Args:
+            full: If True all objects are read, else only the changes since
+                the last refresh, unless a full read is due.
+
+        Returns:
+            The remote objects that have the extension, like
+                Graph.get_users() and Graph.get_groups().
+        """
+        self.read(full=full)
+        self.save()
+        return self.get_objects()
+
+    def read(self, full=False):
+        """Reads the changes from AAD and patches them into the snapshot, see refresh().
+
+        This does not access the database, so it can run on another thread.
+        The snapshot needs to be saved afterwards.
+        """
+        changes = None
+        if not full and not self.needs_full_read():
+            # An expired delta link is expected, it should not be logged as an error by Graph.call()
+            response = self.graph.call(self.model.delta_link, raise_for_status=False)
+            if response.status_code == GONE:
+                logger.info('Delta link for %s has expired, reading all objects', self.collection)
+            else:
+                response.raise_for_status()
+                changes, delta_link = self.graph.get_delta_pages(response.json())
+        if changes is None:
+            changes, delta_link = self.graph.get_delta(self.graph.get_url(self.collection + '/delta'),
+                                                       params={'$select': ','.join(self.fields)})
+            self.model.objects_data = {}
+            self.model.extensions = self._read_all_extensions()
+            self.model.full_read = timezone.now()
+        self._patch(changes)
+        self.model.delta_link = delta_link
+
+    def forget(self, operations: Iterable[SyncOperation]):
+        """Drops the objects that have been deleted by given operations.
+
+        Other changes show up in the next delta, this is only needed to use
+        the snapshot again before the next refresh.
+        """
+        deleted = {o.user.directory_id for o in operations if isinstance(o, DeleteUserOperation)}
+        deleted |= {o.group.directory_id for o in operations if isinstance(o, DeleteGroupOperation)}
+        deleted &= self.model.objects_data.keys()
+        for directory_id in deleted:
+            del self.model.objects_data[directory_id]
+        if deleted:
+            self.save()
+
+    def get_objects(self) -> List[GraphObject]:
+        """Returns the objects in the snapshot that have the extension."""
+        extensions = self.model.extensions
+        return [self.object_class.from_object({**obj, 'id': directory_id, 'extensions': [extensions[directory_id]]})
+                for directory_id, obj in self.model.objects_data.items() if extensions.get(directory_id)]
+
+    def _patch(self, changes: List[Dict]):
+        """Patches changed objects into the snapshot and reads the extensions of new objects."""
+        objects = self.model.objects_data
+        extensions = self.model.extensions
+        for change in changes:
+            directory_id = change['id']
+            if '@removed' in change:
+                objects.pop(directory_id, None)
+                extensions.pop(directory_id, None)
+                continue
+            # A change only includes the properties that changed
+            obj = objects.setdefault(directory_id, dict.fromkeys(f for f in self.fields if f != 'id'))
+            obj.update((k, v) for k, v in change.items() if k in obj)
+        extensions.update(self._read_extensions([i for i in objects if i not in extensions]))
+
+    def _read_all_extensions(self) -> Dict[str, Optional[Dict]]:
+        """Reads the extension of all objects, in a single paged query."""
+        params = {
+            '$select': 'id',
+            '$expand': "extensions($filter=id eq '{}')".format(self.graph.extension_id),
+        }
+        objects = self.graph.get_paged(self.collection, params=params)
+        return {o['id']: o['extensions'][0] if o.get('extensions') else None for o in objects}
+
+    def _read_extensions(self, ids: List[str]) -> Dict[str, Optional[Dict]]:
+        """Reads the extension of given objects in JSON batches.
+
+        Throttled reads are retried in a next round of batches, like
+        sync.aad.batch.get_paged_batch().
+
+        Raises:
+            DeltaError: When an extension could not be read, e.g. because
+                the request was still throttled after all retries. The
+                snapshot is not saved, so the changes are read again on the
+                next refresh.
+        """
+        extensions = {}
+        queue = [(directory_id, 0) for directory_id in ids]  # Tuples of (directory ID, attempt)
+        while queue:
+            retry = []
+            delay = 0.0
+            for start in range(0, len(queue), MAX_BATCH_SIZE):
+                chunk = queue[start:start + MAX_BATCH_SIZE]
+                urls = ['{}/{}/extensions/{}'.format(self.collection, directory_id, self.graph.extension_id)
+                        for directory_id, _ in chunk]
+                for (directory_id, attempt), r in zip(chunk, get_batch(self.graph, urls)):
+                    status = r['status']
+                    if status == NOT_FOUND:
+                        extensions[directory_id] = None
+                    elif 200 <= status < 300:
+                        extensions[directory_id] = {k: v for k, v in r['body'].items() if k != '@odata.context'}
+                    elif is_retryable('GET', status) and attempt < self.max_retries:
+                        retry.append((directory_id, attempt + 1))
+                        delay = max(delay, get_retry_delay(r.get('headers', {}), attempt))
+                        GRAPH_RETRIES.inc(status=status)
+                    else:
+                        raise DeltaError('Could not read extension of {}: {} {}'.format(
+                            directory_id, status, r.get('body')))
+            queue = retry
+            if delay:
+                logger.info('Retrying %s throttled extension reads in %.1f seconds', len(queue), delay)
+                self.sleep(delay)
+        return extensions
+
+    def save(self):
+        with transaction.atomic():
+            stored = AADSnapshot.objects.select_for_update().get(pk=self.model.pk)
+            # Keep extensions that were recorded by remember_extension() in the meantime
+            for directory_id, extension in stored.extensions.items():
+                if extension and not self.model.extensions.get(directory_id):
+                    self.model.extensions[directory_id] = extension
+            self.model.save()
+
+
+def remember_extension(collection: str, directory_id: str, extension: Dict):
+    """Records the extension that was added to an object in the snapshot."""
+    with transaction.atomic():
+        model = AADSnapshot.objects.select_for_update().filter(collection=collection).first()
+        if model:
+            model.extensions[directory_id] = extension
+            model.save(update_fields=['extensions'])
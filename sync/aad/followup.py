@@ -0,0 +1,116 @@
+"""Deferred steps for newly created AAD objects.
+
+A new user or group is not readable right away, so adding the extension or
+assigning the license right after creating it fails with 404 for a while.
+Instead of blocking the task worker, the create operations queue a
+PendingFollowUp and return. This module processes the pending follow-ups
+that are due in JSON batches. Objects that are not readable yet are tried
+again later with exponential backoff. After MAX_ATTEMPTS a follow-up is given
+up. It is kept, so that the object is not created again by the sync, and it
+is shown in the admin site where it can be retried.
+
+When follow-ups are done, the extension is recorded in the remote snapshot
+and an AAD sync is triggered. Objects without extension are not known to the
+sync, so e.g. the memberships of new users
+are only synced after this.
+"""
+import logging
+from datetime import timedelta
+from typing import List, Iterable
+
+from django.conf import settings
+from django.db.models import Min
+from django.utils import timezone
+
+from sync.aad.batch import BatchExecutor, BatchResult
+from sync.aad.delta import remember_extension
+from sync.aad.graph import Graph
+from sync.aad.operations import AddExtensionOperation, AssignLicenseOperation, schedule_follow_ups
+from sync.coalesce import trigger_sync, AAD
+from sync.models import PendingFollowUp
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 10
+"""Number of attempts after which a follow-up is given up."""
+
+MAX_DELAY = 3600
+"""Maximum seconds between attempts."""
+
+CONFLICT = 409
+
+
+def _is_done(result: BatchResult) -> bool:
+    # The extension exists already when an earlier attempt did succeed
+    return result.success or (isinstance(result.operation, AddExtensionOperation) and result.status == CONFLICT)
+
+
+def _update(follow_up: PendingFollowUp, results: List[BatchResult], now) -> bool:
+    """Updates the follow-up with the results of its operations, returns whether it is done."""
+    for result in results:
+        if _is_done(result):
+            if isinstance(result.operation, AddExtensionOperation):
+                remember_extension(follow_up.collection, follow_up.directory_id, follow_up.extension)
+                follow_up.extension = None
+            else:
+                follow_up.license_sku_id = ''
+    if follow_up.extension is None and not follow_up.license_sku_id:
+        follow_up.delete()
+        return True
+    follow_up.attempts += 1
+    follow_up.error = '; '.join(str(r.result) for r in results if not _is_done(r))
+    if follow_up.attempts >= MAX_ATTEMPTS:
+        logger.error('Giving up on %s: %s', follow_up, follow_up.error)
+        follow_up.given_up = now
+        follow_up.save()
+        return False
+    delay = min(MAX_DELAY, settings.GRAPH_FOLLOW_UP_DELAY * 2 ** follow_up.attempts)
+    follow_up.next_attempt = now + timedelta(seconds=delay)
+    follow_up.save()
+    return False
+
+
+def process_follow_ups(graph: Graph = None) -> int:
+    """Does the follow-ups that are due, used as Django-Q task.
+
+    Schedules itself again when follow-ups remain.
+
+    Returns:
+        The number of follow-ups that are done.
+    """
+    graph = graph or Graph.from_settings()
+    now = timezone.now()
+    pending = PendingFollowUp.objects.filter(given_up__isnull=True)
+    follow_ups = list(pending.filter(next_attempt__lte=now).order_by('next_attempt'))
+    operations = []
+    for f in follow_ups:
+        ops = []
+        if f.extension is not None:
+            ops.append(AddExtensionOperation(f.collection, f.directory_id, graph.extension_id, f.extension))
+        if f.license_sku_id:
+            ops.append(AssignLicenseOperation(f.directory_id, f.license_sku_id))
+        operations.append(ops)
+
+    results = BatchExecutor(graph).apply([o for ops in operations for o in ops])
+    done = 0
+    for f, ops in zip(follow_ups, operations):
+        done += _update(f, results[:len(ops)], now)
+        results = results[len(ops):]
+    logger.info('Done %d of %d follow-ups', done, len(follow_ups))
+
+    if done:
+        trigger_sync(AAD)
+    next_attempt = pending.aggregate(next_attempt=Min('next_attempt'))['next_attempt']
+    if next_attempt:
+        schedule_follow_ups(next_run=next_attempt)
+    return done
+
+
+def retry_follow_ups(follow_ups: Iterable[PendingFollowUp]):
+    """Tries given up follow-ups again, with new attempts."""
+    for follow_up in follow_ups:
+        follow_up.given_up = None
+        follow_up.attempts = 0
+        follow_up.next_attempt = timezone.now()
+        follow_up.save()
+    schedule_follow_ups()
@@ -1,16 +1,129 @@
 """API for interacting with Microsoft Graph REST API."""
-from time import time
-from typing import List, Dict
+import random
+import threading
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from time import time, perf_counter, sleep, monotonic
+from typing import List, Dict, Mapping, Tuple, Optional
 from uuid import uuid4
 
 import requests
 import logging
 from django.conf import settings
-from requests import Response
-from urllib3.exceptions import HTTPError
+from requests import Response, HTTPError
+from requests.adapters import HTTPAdapter
+
+from sync.metrics import GRAPH_REQUEST_SECONDS, GRAPH_RETRIES
 
 logger = logging.getLogger(__name__)
 
+GraphRequest = namedtuple('GraphRequest', ['method', 'resource', 'body'], defaults=[None])
+"""A single API request, with resource relative to the base URL, e.g. users/{id}."""
+
+RETRY_STATUS = (429, 503, 504)
+"""Status codes of throttled or timed out requests, these are retried, see is_retryable()."""
+
+GATEWAY_TIMEOUT = 504
+
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'PATCH', 'DELETE')
+
+USER_FIELDS = ['id', 'displayName', 'givenName', 'mailNickname', 'preferredLanguage', 'surname', 'userPrincipalName',
+               'onPremisesImmutableId']
+GROUP_FIELDS = ['id', 'displayName', 'description', 'mailNickname']
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limiter = None
+
+
+def get_session() -> requests.Session:
+    """Returns the process-wide HTTP session, which keeps connections alive between requests."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=settings.GRAPH_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+class RateLimiter:
+    """Thread-safe token bucket that limits the number of requests per second."""
+
+    def __init__(self, rate: float, burst: int = None):
+        """Constructs.
+
+        Args:
+            rate: Number of requests per second.
+            burst: Number of requests that can be done at once after being
+                idle, defaults to the rate.
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waits when there are none left."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens are reserved, a negative balance is the wait of the callers that come first
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """Returns the process-wide rate limiter for Graph requests, or None when there is no limit."""
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None and settings.GRAPH_RATE_LIMIT:
+            _rate_limiter = RateLimiter(settings.GRAPH_RATE_LIMIT)
+        return _rate_limiter
+
+
+def is_retryable(method: str, status: int) -> bool:
+    """Returns whether a request can be retried after a response with given status.
+
+    A throttled request was not processed, so it is retried for all methods.
+    A gateway timeout does not mean that the request was not processed, so
+    it is only retried for idempotent methods. Retrying e.g. a create could
+    create the object twice.
+    """
+    if status == GATEWAY_TIMEOUT:
+        return method.upper() in IDEMPOTENT_METHODS
+    return status in RETRY_STATUS
+
+
+def get_retry_delay(headers: Mapping[str, str], attempt: int, backoff=1.0, max_delay=60.0) -> float:
+    """Returns the seconds to wait before retrying a throttled request.
+
+    Uses exponential backoff with full jitter, but waits at least as long as
+    the Retry-After header, which can be in seconds or an HTTP date.
+
+    Args:
+        headers: Response headers.
+        attempt: Number of the retry, starting at 0.
+        backoff: Maximum delay of the first retry when there's no Retry-After.
+        max_delay: Maximum delay of the backoff.
+    """
+    delay = random.uniform(0, min(max_delay, backoff * 2 ** attempt))
+    retry_after = {k.lower(): v for k, v in headers.items()}.get('retry-after')
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            try:
+                delay = max(delay, parsedate_to_datetime(retry_after).timestamp() - time())
+            except (TypeError, ValueError):
+                pass
+    return delay
+
 
 class GraphObject:
     """A Microsoft Graph directory object."""
@@ -153,7 +266,8 @@ class Graph:
     access_token = None
     access_token_expiry = 0
 
-    def __init__(self, tenant: str, client_id: str, client_secret: str, extension_id='nl.esmgquadrivium.tutti'):
+    def __init__(self, tenant: str, client_id: str, client_secret: str, extension_id='nl.esmgquadrivium.tutti',
+                 url='https://graph.microsoft.com/v1.0', login_url='https://login.microsoftonline.com', max_retries=5):
         """Constructs instance using given authorization details.
 
         Docs: https://docs.microsoft.com/en-us/graph/auth-v2-service#token-request
@@ -167,29 +281,44 @@ class Graph:
                 app in the app registration portal.
             extension_id: The Microsoft Graph extension ID for the extension.
                 Should be in reverse DNS, e.g. com.contoso.referral.
+            url: Base URL of the API, including the version.
+            login_url: Base URL of the token endpoint.
+            max_retries: Number of times a throttled request is retried.
         """
         self.tenant = tenant
         self.client_id = client_id
         self.client_secret = client_secret
         self.extension_id = extension_id
+        self.url = url.rstrip('/')
+        self.login_url = login_url.rstrip('/')
+        self.max_retries = max_retries
+        self.session = get_session()
+        self.rate_limiter = get_rate_limiter()
+        self.token_lock = threading.Lock()
 
     @classmethod
     def from_settings(cls):
         """Creates a new instance with access data from Django settings."""
-        return cls(settings.GRAPH_TENANT, settings.GRAPH_CLIENT_ID, settings.GRAPH_CLIENT_SECRET)
+        return cls(settings.GRAPH_TENANT, settings.GRAPH_CLIENT_ID, settings.GRAPH_CLIENT_SECRET,
+                   url=settings.GRAPH_URL, login_url=settings.GRAPH_LOGIN_URL, max_retries=settings.GRAPH_MAX_RETRIES)
 
     def get_access_token(self) -> str:
         """Requests an access token from Microsoft Graph.
 
-        If an access token is cached, it will be returned.
+        If an access token is cached, it will be returned. Can be called
+        from multiple threads, see sync.aad.asyncgraph.
         """
-        if time() < self.access_token_expiry:
-            # Cached access token is not yet expired, return it
-            return self.access_token
-
-        # Get a new one
-        response = requests.post(
-            url="https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token".format(tenant=self.tenant),
+        with self.token_lock:
+            if time() < self.access_token_expiry:
+                # Cached access token is not yet expired, return it
+                return self.access_token
+            # Get a new one
+            return self._request_access_token()
+
+    def _request_access_token(self) -> str:
+        response = self.request(
+            "POST",
+            "{}/{}/oauth2/v2.0/token".format(self.login_url, self.tenant),
             data={
                 "tenant": self.tenant,
                 "client_id": self.client_id,
@@ -212,7 +341,7 @@ class Graph:
              raise_for_status=True) -> Response:
         """Calls a REST API method.
 
-        Handles authorization.
+        Handles authorization, see request().
 
         Args:
             url: The url, can be constructed using self.get_url().
@@ -222,10 +351,7 @@ class Graph:
                 request. The HTTP method should be POST, PATCH or PUT.
             raise_for_status: Raises HTTPError if one occurred.
         """
-        headers = {
-            "Authorization": "Bearer {}".format(self.get_access_token()),
-        }
-        response = requests.request(method, url, params=params, json=json, headers=headers)
+        response = self.request(method, url, authorize=True, params=params, json=json)
         if raise_for_status:
             try:
                 response.raise_for_status()
@@ -235,14 +361,48 @@ class Graph:
 
         return response
 
+    def request(self, method: str, url: str, authorize=False, **kwargs) -> Response:
+        """Sends an HTTP request over the session, retries when throttled, see is_retryable().
+
+        Waits for the rate limiter first, if there is one.
+
+        Args:
+            method: HTTP method.
+            url: The URL.
+            authorize: If True, the access token is sent. It is taken for
+                each attempt, so a retry after a long wait does not use an
+                expired token.
+            kwargs: Passed to requests.Session.request().
+
+        Returns:
+            The response, which is the throttled response when all retries
+                were throttled.
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if authorize:
+                kwargs['headers'] = {"Authorization": "Bearer {}".format(self.get_access_token())}
+            start = perf_counter()
+            response = self.session.request(method, url, **kwargs)
+            GRAPH_REQUEST_SECONDS.observe(perf_counter() - start, method=method, status=response.status_code)
+            if not is_retryable(method, response.status_code) or attempt == self.max_retries:
+                return response
+            delay = get_retry_delay(response.headers, attempt)
+            GRAPH_RETRIES.inc(status=response.status_code)
+            logger.info('%s %s returned %s, retrying in %.1f seconds', method, url, response.status_code, delay)
+            sleep(delay)
+
     def call_resource(self, resource: str, **kwargs) -> Response:
         """Calls a REST API method by resource.
 
         See self.call().
         """
-        version = "v1.0"
-        url = "https://graph.microsoft.com/{version}/{resource}".format(version=version, resource=resource)
-        return self.call(url, **kwargs)
+        return self.call(self.get_url(resource), **kwargs)
+
+    def get_url(self, resource: str) -> str:
+        """Returns the URL of a resource, e.g. users/{id}."""
+        return "{}/{}".format(self.url, resource)
 
     def get_paged(self, resource: str, params: Dict = None) -> List[Dict]:
         """Gets all results for a paged query.
@@ -259,6 +419,32 @@ class Graph:
             result.extend(data["value"])
         return result
 
+    def get_delta(self, url: str, params: Dict = None) -> Tuple[List[Dict], str]:
+        """Gets all pages of a delta query.
+
+        Args:
+            url: The URL of the delta function, or a delta link of an earlier
+                query. Delta links include the query parameters.
+            params: Query parameters, only for the first query.
+
+        Returns:
+            A 2-tuple with the changed objects and the delta link for the next
+                query.
+        """
+        return self.get_delta_pages(self.call(url, params=params).json())
+
+    def get_delta_pages(self, data: Dict) -> Tuple[List[Dict], str]:
+        """Gets the remaining pages of a delta query, see get_delta().
+
+        Args:
+            data: The first page.
+        """
+        result = data["value"]  # type: List
+        while "@odata.nextLink" in data:
+            data = self.call(data["@odata.nextLink"]).json()
+            result.extend(data["value"])
+        return result, data["@odata.deltaLink"]
+
     def get_users(self, include_extension=True) -> List[GraphUser]:
         """Gets users.
 
@@ -266,10 +452,8 @@ class Graph:
             include_extension: If True, the extension will be included as well.
                 Only users with the extension will be returned!
         """
-        fields = ['id', 'displayName', 'givenName', 'mailNickname', 'preferredLanguage', 'surname', 'userPrincipalName',
-                  'onPremisesImmutableId']
         params = {
-            '$select': ','.join(fields),
+            '$select': ','.join(USER_FIELDS),
         }
         if include_extension:
             params['$expand'] = "extensions($filter=id eq '{}')".format(self.extension_id)
@@ -280,9 +464,8 @@ class Graph:
         return [GraphUser.from_object(o) for o in objects]
 
     def get_groups(self, include_extension=True) -> List[GraphGroup]:
-        fields = ["id", "displayName", "description", "mailNickname"]
         params = {
-            "$select": ",".join(fields),
+            "$select": ",".join(GROUP_FIELDS),
         }
         if include_extension:
             params["$expand"] = "extensions($filter=id eq '{}')".format(self.extension_id)
@@ -353,6 +536,13 @@ class Graph:
                            method="POST",
                            json={"@odata.id": "https://graph.microsoft.com/v1.0/users/{}".format(user_id)})
 
+    def add_group_members(self, group_id: str, user_ids: List[str]):
+        """Adds up to 20 members to a group in a single request."""
+        self.call_resource(resource="groups/{}".format(group_id),
+                           method="PATCH",
+                           json={"members@odata.bind": ["https://graph.microsoft.com/v1.0/directoryObjects/{}".format(i)
+                                                        for i in user_ids]})
+
     def remove_group_member(self, group_id: str, user_id: str):
         self.call_resource(resource="groups/{}/members/{}/$ref".format(group_id, user_id),
                            method="DELETE")
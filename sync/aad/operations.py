@@ -1,10 +1,50 @@
 from abc import ABCMeta
-from typing import Dict
-import time
+from datetime import timedelta
+from typing import Dict, Optional, Set, List
 
 from django.conf import settings
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import schedule
 
-from sync.aad.graph import GraphUser, GraphGroup, Graph
+from sync.aad.graph import GraphUser, GraphGroup, Graph, GraphRequest, GraphObject
+from sync.models import PendingFollowUp
+
+MAX_BIND_MEMBERS = 20
+"""Maximum number of members that can be added in a single group update, imposed by the API."""
+
+FOLLOW_UP_SCHEDULE = 'aad-follow-up'
+"""Name of the schedule that processes the pending follow-ups."""
+
+
+def schedule_follow_ups(next_run=None):
+    """Schedules processing of the pending follow-ups, unless it is scheduled already."""
+    if Schedule.objects.filter(name=FOLLOW_UP_SCHEDULE).exists():
+        return
+    if next_run is None:
+        next_run = timezone.now() + timedelta(seconds=settings.GRAPH_FOLLOW_UP_DELAY)
+    schedule('sync.aad.followup.process_follow_ups',
+             name=FOLLOW_UP_SCHEDULE,
+             hook='sync.signals.error_reporting',
+             schedule_type=Schedule.ONCE,
+             next_run=next_run)
+
+
+def queue_follow_up(collection: str, directory_id: str, extension: Dict, license_sku_id: str = None):
+    """Queues adding the extension and license to a newly created object, see sync.aad.followup.
+
+    Args:
+        collection: 'users' or 'groups'.
+        directory_id: ID of the created object.
+        extension: Extension data, includes the tuttiId.
+        license_sku_id: License to assign, optional.
+    """
+    PendingFollowUp.objects.create(collection=collection,
+                                   directory_id=directory_id,
+                                   tutti_id=extension['tuttiId'],
+                                   extension=extension,
+                                   license_sku_id=license_sku_id or '')
+    schedule_follow_ups()
 
 
 class SyncOperation:
@@ -14,31 +54,88 @@ class SyncOperation:
         return repr(self)
 
     def apply(self, graph: Graph):
-        raise NotImplementedError
+        """Applies the operation, see send() and finish()."""
+        self.send(graph)
+        self.finish()
+
+    def send(self, graph: Graph):
+        """Sends the operation to the API, by default the request of get_request().
+
+        This does not access the database, so it can run on another thread.
+        """
+        request = self.get_request()
+        if request is None:
+            raise NotImplementedError
+        graph.call_resource(request.resource, method=request.method, json=request.body)
+
+    def finish(self):
+        """Does the local bookkeeping after the operation has been sent, by default nothing.
+
+        This can access the database, unlike send().
+        """
+
+    def get_request(self) -> Optional[GraphRequest]:
+        """Returns the API request if the operation is a single request, else None.
+
+        Operations with a single request can be sent in a JSON batch, see
+        sync.aad.batch.
+        """
+        return None
+
+    def get_keys(self) -> Set[str]:
+        """Returns keys of what the operation changes.
+
+        Operations with a key in common are applied in their original order.
+        """
+        return set()
+
+    def get_requirements(self) -> Set[str]:
+        """Returns the keys of the objects that need to exist, see get_object_keys().
+
+        The operation is applied after the operation that creates these
+        objects and before an operation that deletes them, see
+        sync.aad.scheduler.
+        """
+        return set()
+
+    def get_created(self) -> Set[str]:
+        """Returns the keys of the objects that the operation creates, see get_object_keys()."""
+        return set()
+
+    def get_deleted(self) -> Set[str]:
+        """Returns the keys of the objects that the operation deletes, see get_object_keys()."""
+        return set()
+
+
+def get_object_keys(collection: str, obj: GraphObject) -> Set[str]:
+    """Returns the key of a synced object for SyncOperation.get_requirements(), e.g. users/{Tutti ID}.
+
+    The key is known before the object is created, unlike the directory ID.
+    Objects without extension have no key.
+    """
+    if not obj.extension:
+        return set()
+    return {'{}/{}'.format(collection, obj.extension['tuttiId'])}
 
 
 class CreateUserOperation(SyncOperation):
     """Create a new user.
 
-    Also adds a license for the user.
+    The extension with the Tutti ID and the license are added later, when
+    the new user is readable, see sync.aad.followup.
     """
 
     def __init__(self, user: GraphUser):
         self.user = user
 
-    def apply(self, graph: Graph):
-        """Creates the user with extension data and assigns the license."""
-        # Create user
-        user_id = graph.create_user(self.user)
+    def send(self, graph: Graph):
+        self.user.directory_id = graph.create_user(self.user)
 
-        # We have issues where sometimes the extensions API call fails with 404. Maybe a time delay helps.
-        time.sleep(30)
+    def finish(self):
+        queue_follow_up('users', self.user.directory_id, self.user.extension, settings.GRAPH_LICENSE_SKU_ID)
 
-        # Add extension data (Tutti database ID)
-        graph.add_user_extension(user_id, self.user.extension)
-        if settings.GRAPH_LICENSE_SKU_ID:
-            # Assign Microsoft 365 license
-            graph.assign_license(user_id=user_id, sku_id=settings.GRAPH_LICENSE_SKU_ID)
+    def get_created(self) -> Set[str]:
+        return get_object_keys('users', self.user)
 
     def __repr__(self):
         return "CreateUser({})".format(repr(self.user))
@@ -51,8 +148,14 @@ class DeleteUserOperation(SyncOperation):
     def __repr__(self) -> str:
         return "DeleteUser({})".format(self.user.user_principal_name)
 
-    def apply(self, graph: Graph):
-        graph.delete_user(self.user.directory_id)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('DELETE', 'users/{}'.format(self.user.directory_id))
+
+    def get_keys(self) -> Set[str]:
+        return {self.user.directory_id}
+
+    def get_deleted(self) -> Set[str]:
+        return get_object_keys('users', self.user)
 
 
 class UpdateUserOperation(SyncOperation):
@@ -63,8 +166,11 @@ class UpdateUserOperation(SyncOperation):
     def __repr__(self) -> str:
         return "UpdateUser({}, {})".format(self.user.user_principal_name, repr(self.changes))
 
-    def apply(self, graph: Graph):
-        graph.update_user(self.user.directory_id, self.changes)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('PATCH', 'users/{}'.format(self.user.directory_id), self.changes)
+
+    def get_keys(self) -> Set[str]:
+        return {self.user.directory_id}
 
 
 class CreateGroupOperation(SyncOperation):
@@ -74,21 +180,29 @@ class CreateGroupOperation(SyncOperation):
     def __repr__(self) -> str:
         return "CreateGroup({})".format(repr(self.group))
 
-    def apply(self, graph: Graph):
-        group_id = graph.create_group(self.group)
+    def send(self, graph: Graph):
+        """Creates the group, the extension is added later, see CreateUserOperation."""
+        self.group.directory_id = graph.create_group(self.group)
 
-        # We have issues where sometimes the extensions API call fails with 404. Maybe a time delay helps.
-        time.sleep(30)
+    def finish(self):
+        queue_follow_up('groups', self.group.directory_id, self.group.extension)
 
-        graph.add_group_extension(group_id, self.group.extension)
+    def get_created(self) -> Set[str]:
+        return get_object_keys('groups', self.group)
 
 
 class DeleteGroupOperation(SyncOperation):
     def __init__(self, group: GraphGroup) -> None:
         self.group = group
 
-    def apply(self, graph: Graph):
-        graph.delete_group(self.group.directory_id)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('DELETE', 'groups/{}'.format(self.group.directory_id))
+
+    def get_keys(self) -> Set[str]:
+        return {self.group.directory_id}
+
+    def get_deleted(self) -> Set[str]:
+        return get_object_keys('groups', self.group)
 
     def __repr__(self) -> str:
         return "DeleteGroup({})".format(self.group.display_name)
@@ -99,8 +213,11 @@ class UpdateGroupOperation(SyncOperation):
         self.group = group
         self.changes = changes
 
-    def apply(self, graph: Graph):
-        graph.update_group(self.group.directory_id, self.changes)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('PATCH', 'groups/{}'.format(self.group.directory_id), self.changes)
+
+    def get_keys(self) -> Set[str]:
+        return {self.group.directory_id}
 
     def __repr__(self) -> str:
         return "UpdateGroup({}, {})".format(self.group.display_name, self.changes)
@@ -111,18 +228,102 @@ class BaseGroupMemberOperation(SyncOperation, metaclass=ABCMeta):
         self.group = group
         self.user = user
 
+    def get_keys(self) -> Set[str]:
+        # Membership changes of different members don't depend on each other
+        return {'{}/members/{}'.format(self.group.directory_id, self.user.directory_id)}
+
+    def get_requirements(self) -> Set[str]:
+        return get_object_keys('groups', self.group) | get_object_keys('users', self.user)
+
 
 class AddGroupMemberOperation(BaseGroupMemberOperation):
     def __repr__(self) -> str:
         return "AddGroupMember({}, {})".format(self.group.display_name, self.user.user_principal_name)
 
-    def apply(self, graph: Graph):
-        graph.add_group_member(self.group.directory_id, self.user.directory_id)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('POST', 'groups/{}/members/$ref'.format(self.group.directory_id),
+                            {'@odata.id': 'https://graph.microsoft.com/v1.0/users/{}'.format(self.user.directory_id)})
+
+
+class AddGroupMembersOperation(SyncOperation):
+    """Add several members to a group in a single request.
+
+    The request fails as a whole when one of the users is already a member.
+    """
+
+    def __init__(self, group: GraphGroup, users: List[GraphUser]):
+        if len(users) > MAX_BIND_MEMBERS:
+            raise ValueError('At most {} members can be added at once'.format(MAX_BIND_MEMBERS))
+        self.group = group
+        self.users = users
+
+    def __repr__(self) -> str:
+        return "AddGroupMembers({}, {})".format(self.group.display_name, [u.user_principal_name for u in self.users])
+
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('PATCH', 'groups/{}'.format(self.group.directory_id), {
+            'members@odata.bind': ['https://graph.microsoft.com/v1.0/directoryObjects/{}'.format(u.directory_id)
+                                   for u in self.users],
+        })
+
+    def get_keys(self) -> Set[str]:
+        return {'{}/members/{}'.format(self.group.directory_id, u.directory_id) for u in self.users}
+
+    def get_requirements(self) -> Set[str]:
+        return get_object_keys('groups', self.group).union(*(get_object_keys('users', u) for u in self.users))
 
 
 class RemoveGroupMemberOperation(BaseGroupMemberOperation):
     def __repr__(self) -> str:
         return "RemoveGroupMember({}, {})".format(self.group.display_name, self.user.user_principal_name)
 
-    def apply(self, graph: Graph):
-        graph.remove_group_member(self.group.directory_id, self.user.directory_id)
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('DELETE', 'groups/{}/members/{}/$ref'.format(self.group.directory_id,
+                                                                         self.user.directory_id))
+
+
+class AddExtensionOperation(SyncOperation):
+    """Add the extension to an object that does not have one yet."""
+
+    def __init__(self, collection: str, directory_id: str, extension_id: str, extension: Dict):
+        """Constructs.
+
+        Args:
+            collection: 'users' or 'groups'.
+            directory_id: The object ID.
+            extension_id: See Graph.extension_id.
+            extension: The extension data.
+        """
+        self.collection = collection
+        self.directory_id = directory_id
+        self.extension_id = extension_id
+        self.extension = extension
+
+    def __repr__(self) -> str:
+        return "AddExtension({}/{}, {})".format(self.collection, self.directory_id, self.extension)
+
+    def get_request(self) -> Optional[GraphRequest]:
+        body = {
+            "@odata.type": "microsoft.graph.openTypeExtension",
+            "extensionName": self.extension_id,
+            **self.extension,
+        }
+        return GraphRequest('POST', '{}/{}/extensions'.format(self.collection, self.directory_id), body)
+
+    def get_keys(self) -> Set[str]:
+        return {self.directory_id}
+
+
+class AssignLicenseOperation(SyncOperation):
+    def __init__(self, user_id: str, sku_id: str):
+        self.user_id = user_id
+        self.sku_id = sku_id
+
+    def __repr__(self) -> str:
+        return "AssignLicense({}, {})".format(self.user_id, self.sku_id)
+
+    def get_request(self) -> Optional[GraphRequest]:
+        return GraphRequest('POST', 'users/{}/assignLicense'.format(self.user_id), {
+            "addLicenses": [{"skuId": self.sku_id, "disabledPlans": []}],
+            "removeLicenses": [],
+        })
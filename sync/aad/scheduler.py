@@ -0,0 +1,133 @@
+"""Applies AAD sync operations in the order of their dependencies.
+
+The operations form a directed acyclic graph. An operation depends on the
+earlier operations that share a key with it (SyncOperation.get_keys()), and on
+the operation that creates an object it requires
+(SyncOperation.get_requirements()). An operation that deletes an object
+depends on the earlier operations that require it, e.g. the membership
+changes of a deleted user are applied before the user is deleted. Instead of
+applying all object operations before any membership operation, the
+scheduler applies in each round all operations of which the dependencies are
+done. The operations that are a single request are sent in JSON batches.
+The batches and the other operations, e.g. creates, of a round are sent
+concurrently, see sync.aad.batch and sync.aad.asyncgraph. The local
+bookkeeping of the sent operations is done afterwards on the calling thread,
+see SyncOperation.finish(). Operations that depend on a failed operation are
+skipped.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import List, Set, Callable
+
+from requests import RequestException
+
+from sync.aad.asyncgraph import AsyncGraph
+from sync.aad.batch import BatchExecutor, BatchResult, MAX_BATCH_SIZE
+from sync.aad.graph import Graph
+from sync.aad.operations import SyncOperation
+
+logger = logging.getLogger(__name__)
+
+
+def get_dependencies(operations: List[SyncOperation]) -> List[Set[int]]:
+    """Returns for each operation the indices of the operations it depends on directly."""
+    last = {}  # Key -> index of the last operation with that key
+    creators = {}  # Object key -> index of the operation that creates it
+    for i, operation in enumerate(operations):
+        creators.update((k, i) for k in operation.get_created())
+    requirers = defaultdict(set)  # Object key -> indices of the operations that require it
+    dependencies = []
+    for i, operation in enumerate(operations):
+        keys = operation.get_keys()
+        depends = {last[k] for k in keys if k in last}
+        depends |= {creators[k] for k in operation.get_requirements() if k in creators}
+        depends = depends.union(*(requirers[k] for k in operation.get_deleted()))
+        depends.discard(i)
+        last.update((k, i) for k in keys)
+        for k in operation.get_requirements():
+            requirers[k].add(i)
+        dependencies.append(depends)
+    return dependencies
+
+
+class Scheduler:
+    """Applies operations as soon as their dependencies are done, see module docstring."""
+
+    def __init__(self,
+                 graph: Graph,
+                 max_size=MAX_BATCH_SIZE,
+                 concurrency: int = None,
+                 max_retries=3,
+                 sleep: Callable[[float], None] = time.sleep):
+        """Constructs.
+
+        Args:
+            graph: The API.
+            max_size: Maximum number of sub-requests per batch.
+            concurrency: Maximum number of batches in flight, defaults to the
+                GRAPH_CONCURRENCY setting.
+            max_retries: Number of times a throttled sub-request is retried.
+            sleep: Function used to wait before a retry.
+        """
+        self.graph = graph
+        self.client = AsyncGraph(graph, concurrency)
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.sleep = sleep
+
+    def apply(self, operations: List[SyncOperation]) -> List[BatchResult]:
+        """Applies operations.
+
+        Returns:
+            A result for each operation, in the order of the operations.
+        """
+        dependencies = get_dependencies(operations)
+        results = [None] * len(operations)  # type: List[BatchResult]
+        waiting = list(range(len(operations)))
+        rounds = 0
+        while waiting:
+            ready, still_waiting = [], []
+            for i in waiting:
+                done = [results[j] for j in dependencies[i]]
+                if any(r and not r.success for r in done):
+                    results[i] = BatchResult(operations[i], False, 'skipped, an operation it depends on failed')
+                elif all(done):
+                    ready.append(i)
+                else:
+                    still_waiting.append(i)
+            if len(still_waiting) == len(waiting):
+                raise ValueError('Operations have cyclic dependencies')
+            if ready:
+                for i, result in zip(ready, self._apply_round([operations[i] for i in ready])):
+                    results[i] = result
+                rounds += 1
+            waiting = still_waiting
+        logger.info('Applied %d operations in %d rounds', len(operations), rounds)
+        return results
+
+    def _apply_round(self, operations: List[SyncOperation]) -> List[BatchResult]:
+        """Applies independent operations."""
+        single = [o for o in operations if o.get_request() is None]
+        batched = [o for o in operations if o.get_request() is not None]
+        chunks = [batched[i:i + self.max_size] for i in range(0, len(batched), self.max_size)]
+        results = {}
+        for chunk_results in asyncio.run(self.client.map(self._send, [[o] for o in single] + chunks)):
+            results.update((r.operation, r) for r in chunk_results)
+        # The bookkeeping uses the database, which can't be used on the worker threads
+        for operation in single:
+            if results[operation].success:
+                operation.finish()
+        return [results[o] for o in operations]
+
+    def _send(self, operations: List[SyncOperation]) -> List[BatchResult]:
+        """Sends a single operation that is not a request, or a batch of requests."""
+        if operations[0].get_request() is not None:
+            return BatchExecutor(self.graph, self.max_size, self.max_retries, self.sleep).apply(operations)
+        operation, = operations
+        try:
+            operation.send(self.graph)
+        except RequestException as e:
+            return [BatchResult(operation, False, str(e))]
+        return [BatchResult(operation, True, None)]
@@ -1,52 +1,88 @@
 """AAD sync methods using the graph and operations modules."""
+import asyncio
+from collections import defaultdict
 from typing import Dict, List, Tuple
 
-from members.models import QGroup, Person
+from members.models import QGroup, Person, User
+from sync.aad.asyncgraph import AsyncGraph
+from sync.aad.batch import get_paged_batch
+from sync.aad.delta import DeltaSnapshot
 from sync.aad.graph import Graph, GraphGroup, GraphUser, GraphObject
 from sync.aad.operations import SyncOperation, CreateUserOperation, DeleteUserOperation, UpdateUserOperation, \
     CreateGroupOperation, DeleteGroupOperation, UpdateGroupOperation, AddGroupMemberOperation, \
-    RemoveGroupMemberOperation
+    RemoveGroupMemberOperation, AddGroupMembersOperation, MAX_BIND_MEMBERS
+from sync.models import PendingFollowUp
 
 
 def aad_sync_objects(graph: Graph) -> List[SyncOperation]:
     """Gets the sync operations for syncing users and groups with AAD.
 
     Group memberships are synced separately and needs to be done after the
-    operations returned here have been applied.
+    operations returned here have been applied. The remote objects are read
+    incrementally, see sync.aad.delta.
     """
     operations = []
+    # Objects that were created but don't have the extension yet are not
+    #  returned by the API, these must not be created again.
+    pending = {(c, i) for c, i in PendingFollowUp.objects.filter(extension__isnull=False)
+               .values_list('collection', 'tutti_id')}
+    # Read remote users and groups concurrently
+    snapshots = [DeltaSnapshot(graph, 'users'), DeltaSnapshot(graph, 'groups')]
+    asyncio.run(AsyncGraph(graph).map(DeltaSnapshot.read, snapshots))
+    for snapshot in snapshots:
+        snapshot.save()
+    aad_users, aad_groups = (snapshot.get_objects() for snapshot in snapshots)
     # Sync users
-    local_users = [convert_local_person(p) for p in Person.objects.filter_members()]
-    aad_users = graph.get_users()
+    local_users = [convert_local_person(p) for p in Person.objects.filter_members()
+                   if ('users', p.id) not in pending]
     operations.extend(sync_users(local_users, aad_users))
     # Sync groups
-    local_groups = [convert_local_group(g) for g in QGroup.objects.all()]
-    aad_groups = graph.get_groups()
+    local_groups = [convert_local_group(g) for g in QGroup.objects.all() if ('groups', g.id) not in pending]
     operations.extend(sync_groups(local_groups, aad_groups))
     return operations
 
 
-def aad_sync_members(graph: Graph) -> List[SyncOperation]:
+def aad_sync_members(graph: Graph, object_operations: List[SyncOperation] = ()) -> List[SyncOperation]:
     """Gets the sync operation for group membership adds/deletes.
 
-    This uses the remote groups as the groups that will be synced, so this must
-    be run after the aad_sync_objects operations have been applied on AAD. This
-    is because the remote groups need to have been created already in order to
-    be able to sync group memberships.
+    The remote users and groups are taken from the snapshots refreshed by
+    aad_sync_objects. The operations can be applied together with the object
+    operations, see sync.aad.scheduler. Member additions of a group are merged,
+    see merge_member_additions().
+
+    Args:
+        graph: The API.
+        object_operations: The object operations of aad_sync_objects that
+            will be applied together with the membership operations. Objects
+            that they delete are skipped.
+            Objects that they create are skipped as well, these are not
+            readable right away. Their memberships are synced after the
+            follow-up, see sync.aad.followup.
     """
     operations = []
-    aad_users = graph.get_users()
+    deleted = {o.user.directory_id for o in object_operations if isinstance(o, DeleteUserOperation)}
+    deleted |= {o.group.directory_id for o in object_operations if isinstance(o, DeleteGroupOperation)}
+    aad_users = [u for u in DeltaSnapshot(graph, 'users').get_objects() if u.directory_id not in deleted]
+    aad_groups = [g for g in DeltaSnapshot(graph, 'groups').get_objects() if g.directory_id not in deleted]
     local_id_map = {u.extension["tuttiId"]: u for u in aad_users}
     remote_id_map = {u.directory_id: u for u in aad_users}
-    for group in graph.get_groups():
-        # Get local and remote group members
-        qs = Person.objects.filter(groups=group.extension['tuttiId'])
+    # Get local group members in a single query
+    local_members = defaultdict(list)
+    memberships = User.groups.through.objects.filter(group_id__in=[g.extension['tuttiId'] for g in aad_groups])
+    for group_id, user_id in memberships.values_list('group_id', 'user_id'):
         # Here we silently ignore local people that don't have a remote account
-        local = [local_id_map[p.id] for p in qs if p.id in local_id_map]
-        remote = [remote_id_map[i] for i in graph.get_group_members(group.directory_id)]
+        if user_id in local_id_map:
+            local_members[group_id].append(local_id_map[user_id])
+    # Get remote group members using JSON batching
+    resources = {g.directory_id: 'groups/{}/members?$select=id&$top=999'.format(g.directory_id) for g in aad_groups}
+    remote_members = get_paged_batch(graph, list(resources.values()))
+    for group in aad_groups:
+        # Members that are not synced users, e.g. devices, are left alone
+        remote = [remote_id_map[o['id']] for o in remote_members[resources[group.directory_id]]
+                  if o['id'] in remote_id_map]
         # Sync
-        operations.extend(sync_members(group, local, remote))
-    return operations
+        operations.extend(sync_members(group, local_members[group.extension['tuttiId']], remote))
+    return merge_member_additions(operations)
 
 
 def convert_local_person(person: Person) -> GraphUser:
@@ -105,6 +141,34 @@ def sync_members(group: GraphGroup, local: List[GraphUser], remote: List[GraphUs
     return operations
 
 
+def merge_member_additions(operations: List[SyncOperation]) -> List[SyncOperation]:
+    """Merges the member additions of each group into requests of up to MAX_BIND_MEMBERS members.
+
+    The merged operations take the place of the first addition of the group,
+    other operations keep their order.
+    """
+    additions = defaultdict(list)  # Group directory ID -> member additions
+    for o in operations:
+        if isinstance(o, AddGroupMemberOperation):
+            additions[o.group.directory_id].append(o)
+    merged = []
+    for o in operations:
+        if not isinstance(o, AddGroupMemberOperation):
+            merged.append(o)
+            continue
+        group_additions = additions.pop(o.group.directory_id, None)
+        if group_additions is None:
+            # Already merged
+            continue
+        if len(group_additions) == 1:
+            merged.append(o)
+            continue
+        for i in range(0, len(group_additions), MAX_BIND_MEMBERS):
+            chunk = group_additions[i:i + MAX_BIND_MEMBERS]
+            merged.append(AddGroupMembersOperation(o.group, [a.user for a in chunk]))
+    return merged
+
+
 def get_create_delete(change_to: List[GraphObject], to_change: List[GraphObject]) -> Tuple[List, List, List[Tuple]]:
     """Returns the needed changes to turn one list into the other.
 
@@ -1,42 +1,71 @@
 """Tasks for running synchronization."""
 from typing import List
 
+from sync.aad.batch import BatchError
+from sync.aad.delta import DeltaSnapshot
 from sync.aad.graph import Graph
 from sync.aad.operations import SyncOperation, DeleteUserOperation, DeleteGroupOperation
+from sync.aad.scheduler import Scheduler
 from sync.aad.sync import aad_sync_objects, aad_sync_members
+from sync.runs import record_run, RunRecorder, SCHEDULE
 
 
-def apply(operations: List[SyncOperation], graph: Graph) -> List[SyncOperation]:
-    for o in operations:
-        o.apply(graph)
+def apply(operations: List[SyncOperation], graph: Graph, run: RunRecorder = None) -> List[SyncOperation]:
+    """Applies operations in the order of their dependencies, see sync.aad.scheduler.
+
+    Raises:
+        BatchError: When an operation failed, after all other operations have
+            been applied.
+    """
+    results = Scheduler(graph).apply(operations)
+    failed = [r for r in results if not r.success]
+    if failed:
+        if run:
+            for r in failed:
+                run.add_failure(r.operation, r.result)
+        raise BatchError(results)
     return operations
 
 
-def aad_sync(apply_deletions=True) -> List[SyncOperation]:
+def aad_sync(apply_deletions=True, trigger=SCHEDULE) -> List[SyncOperation]:
     """Runs full sync with Azure Active Directory.
 
+    The object, membership and delete operations are applied together, the
+    deletions after the operations on the same objects, see
+    sync.aad.scheduler. The run is recorded in the sync run journal.
+
     Args:
         apply_deletions: If True, delete operations will be applied as well.
+        trigger: What caused the sync, for the journal.
 
     Returns:
         The operations that have been applied.
     """
-    graph = Graph.from_settings()
-    applied = []
-    # Sync groups and users
-    object_operations = aad_sync_objects(graph)
-    # Split out delete operations
-    delete_ops = []
-    non_delete_ops = []
-    for o in object_operations:
-        if isinstance(o, DeleteUserOperation) or isinstance(o, DeleteGroupOperation):
-            delete_ops.append(o)
-        else:
-            non_delete_ops.append(o)
-    applied.extend(apply(non_delete_ops, graph))
-    if apply_deletions:
-        applied.extend(apply(delete_ops, graph))
-    # Sync group memberships
-    membership_operations = aad_sync_members(graph)
-    applied.extend(apply(membership_operations, graph))
-    return applied
+    with record_run('aad', trigger) as run:
+        graph = Graph.from_settings()
+        with run.phase('diff'):
+            object_operations = aad_sync_objects(graph)
+            # Split out delete operations
+            delete_ops = []
+            non_delete_ops = []
+            for o in object_operations:
+                if isinstance(o, DeleteUserOperation) or isinstance(o, DeleteGroupOperation):
+                    delete_ops.append(o)
+                else:
+                    non_delete_ops.append(o)
+            if not apply_deletions:
+                delete_ops = []
+            membership_operations = aad_sync_members(graph, non_delete_ops + delete_ops)
+        operations = non_delete_ops + membership_operations + delete_ops
+        run.add_operations(operations)
+        with run.phase('apply'):
+            deleted = delete_ops
+            try:
+                return apply(operations, graph, run)
+            except BatchError as e:
+                deleted = [r.operation for r in e.results if r.success]
+                raise
+            finally:
+                # Deletions that succeeded are dropped from the snapshots, also when others failed
+                for collection in ('users', 'groups'):
+                    DeltaSnapshot(graph, collection).forget(deleted)
@@ -1,8 +1,18 @@
-"""Sets up Django Q (job scheduler) models in the admin site."""
+"""Sets up Django Q (job scheduler) and sync models in the admin site."""
+from datetime import timedelta
+
 from django.contrib import admin
+from django.db.models import Count, Avg, Sum, Max, Q
+from django.db.models.functions import TruncDate
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
 from django_q.admin import ScheduleAdmin, TaskAdmin, FailAdmin, QueueAdmin
 from django_q.models import Schedule, Success, Failure, OrmQ
 
+from sync.aad.followup import retry_follow_ups
+from sync.models import PendingSync, SyncRun, PendingFollowUp
+
 
 class NoPermissionsMixin:
     def has_add_permission(self, request):
@@ -39,3 +49,63 @@ admin.site.register(Schedule, MyScheduleAdmin)
 admin.site.register(Success, MyTaskAdmin)
 admin.site.register(Failure, MyFailAdmin)
 admin.site.register(OrmQ, MyQueueAdmin)
+
+
+@admin.register(PendingSync)
+class PendingSyncAdmin(NoPermissionsMixin, admin.ModelAdmin):
+    list_display = ('target', 'triggers', 'created')
+
+
+@admin.register(PendingFollowUp)
+class PendingFollowUpAdmin(NoPermissionsMixin, admin.ModelAdmin):
+    list_display = ('directory_id', 'collection', 'tutti_id', 'attempts', 'next_attempt', 'given_up')
+    list_filter = (('given_up', admin.EmptyFieldListFilter), 'collection')
+    actions = ['retry']
+
+    @admin.action(description='Retry selected follow-ups')
+    def retry(self, request, queryset):
+        retry_follow_ups(queryset)
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(NoPermissionsMixin, admin.ModelAdmin):
+    list_display = ('started', 'target', 'trigger', 'duration', 'operation_count', 'success')
+    list_filter = ('target', 'trigger', 'success')
+    readonly_fields = ('id', 'target', 'trigger', 'started', 'duration', 'phases', 'operation_count',
+                       'operation_counts', 'failures', 'success')
+    date_hierarchy = 'started'
+    change_list_template = 'admin/sync/syncrun/change_list.html'
+
+    # Number of days shown in the trends view
+    trend_days = 30
+
+    def get_urls(self):
+        return [path('trends/',
+                     self.admin_site.admin_view(self.trends_view),
+                     name='sync_syncrun_trends'),
+                ] + super().get_urls()
+
+    def trends_view(self, request):
+        """Shows the daily throughput per target and the slowest runs."""
+        since = timezone.now() - timedelta(days=self.trend_days)
+        days = SyncRun.objects.filter(started__gte=since).annotate(
+            day=TruncDate('started')
+        ).values('day', 'target').annotate(
+            runs=Count('id'),
+            failed=Count('id', filter=Q(success=False)),
+            operations=Sum('operation_count'),
+            avg_duration=Avg('duration'),
+            max_duration=Max('duration'),
+            total_duration=Sum('duration'),
+        ).order_by('-day', 'target')
+        for d in days:
+            d['throughput'] = d['operations'] / d['total_duration'] if d['total_duration'] else None
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Sync run trends',
+            'days': days,
+            'trend_days': self.trend_days,
+            'slowest': SyncRun.objects.order_by('-duration')[:10],
+        }
+        return TemplateResponse(request, 'admin/sync/syncrun/trends.html', context)
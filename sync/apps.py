@@ -7,3 +7,5 @@ class SyncConfig(AppConfig):
     def ready(self):
         # noinspection PyUnresolvedReferences
         import sync.signals  # noqa: F401
+        # noinspection PyUnresolvedReferences
+        import sync.metrics  # noqa: F401
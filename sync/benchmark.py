@@ -0,0 +1,234 @@
+"""Benchmarks for the LDAP and AAD diff engines on synthetic directories.
+
+The directories are generated from a seed, so runs are repeatable. A drifted
+copy of a directory is used as the remote side, with a configurable fraction
+of the people and groups changed, deleted and added.
+"""
+import random
+import time
+import tracemalloc
+from typing import Dict, List, Callable, Iterable, Tuple
+
+from ldap3 import Server, Connection, MOCK_SYNC
+
+from members.models import Person, QGroup, User
+from sync.aad.graph import GraphUser, GraphGroup
+from sync.aad.sync import get_create_delete, get_update_list
+from sync.ldapentities import LDAPPerson, LDAPGroup
+from sync.sync import sync, remap
+
+FIRST_NAMES = ['Anna', 'Bram', 'Daan', 'Emma', 'Fleur', 'Julia', 'Lars', 'Noah', 'Sanne', 'Thijs']
+LAST_NAMES = ['Bakker', 'de Boer', 'Dekker', 'de Jong', 'Jansen', 'Mulder', 'Smit', 'Visser', 'de Vries']
+
+
+def mock_connection(server: Server, client_strategy=MOCK_SYNC, raise_exceptions=True, collect_usage=False) -> Connection:
+    """Returns a new unbound connection to an in-process mock LDAP server with the test credentials."""
+    return Connection(server, user='cn=admin,dc=esmgquadrivium,dc=nl', password='secret',
+                      client_strategy=client_strategy, raise_exceptions=raise_exceptions, collect_usage=collect_usage)
+
+
+def get_mock_connection(entries, **kwargs) -> Connection:
+    """Returns a bound connection to a new in-process mock LDAP server with given entries.
+
+    The entries are kept by the server, so other connections to the same
+    server, e.g. one for each thread, can be made with
+    mock_connection(conn.server).
+    """
+    conn = mock_connection(Server('mock'), **kwargs)
+    conn.strategy.add_entry('cn=admin,dc=esmgquadrivium,dc=nl', {'userPassword': 'secret'})
+    conn.strategy.add_entry('ou=people,dc=esmgquadrivium,dc=nl', {'objectClass': ['organizationalUnit']})
+    conn.strategy.add_entry('ou=groups,dc=esmgquadrivium,dc=nl', {'objectClass': ['organizationalUnit']})
+    for dn, attributes in entries.items():
+        conn.strategy.add_entry(dn, attributes)
+    conn.bind()
+    return conn
+
+
+class SyntheticDirectory:
+    """A generated set of people, groups and group memberships.
+
+    The people and groups are stored as dictionaries in the format of a
+    values() row, see LDAPEntity.fields.
+    """
+
+    def __init__(self, people: Dict[int, Dict], groups: Dict[int, Dict], members: Dict[int, List[int]]):
+        self.people = people
+        self.groups = groups
+        self.members = members
+
+    @classmethod
+    def generate(cls, size: int, members_per_group: int = 10, seed: int = 0):
+        """Generates a directory with the given number of people and a group per 10 people."""
+        rnd = random.Random(seed)
+        people = {i: _person(i, rnd) for i in range(1, size + 1)}
+        groups = {i: _group(i, rnd) for i in range(1, max(size // 10, 1) + 1)}
+        members = {g: sorted(rnd.sample(list(people), min(members_per_group, size))) for g in groups}
+        return cls(people, groups, members)
+
+    def drift(self, churn: float, seed: int = 1):
+        """Returns a copy with the given fraction of people and groups changed, deleted and added.
+
+        Args:
+            churn: Fraction of the people and groups that are changed. Half
+                this fraction is deleted and also half is added.
+            seed: Random seed.
+        """
+        rnd = random.Random(seed)
+        people = {i: dict(p) for i, p in self.people.items()}
+        groups = {i: dict(g) for i, g in self.groups.items()}
+        members = {g: list(m) for g, m in self.members.items()}
+
+        for i in rnd.sample(list(people), int(len(people) * churn)):
+            people[i]['last_name'] = rnd.choice(LAST_NAMES) + ' ' + people[i]['last_name']
+        for i in rnd.sample(list(groups), int(len(groups) * churn)):
+            groups[i]['description'] = 'Changed'
+            members[i] = members[i][1:] + [rnd.choice(list(people))]
+        for i in rnd.sample(list(people), int(len(people) * churn / 2)):
+            del people[i]
+        for i in rnd.sample(list(groups), int(len(groups) * churn / 2)):
+            del groups[i]
+            del members[i]
+        for i in range(max(people) + 1, max(people) + 1 + int(len(self.people) * churn / 2)):
+            people[i] = _person(i, rnd)
+        for i in range(max(groups) + 1, max(groups) + 1 + int(len(self.groups) * churn / 2)):
+            groups[i] = _group(i, rnd)
+            members[i] = []
+        return SyntheticDirectory(people, groups, members)
+
+    def create_objects(self):
+        """Creates the people, groups and memberships in the database.
+
+        Returns:
+            A copy of the directory with the database primary keys.
+        """
+        people, groups = {}, {}
+        for p in self.people.values():
+            person = Person.objects.create(**{f: p[f] for f in LDAPPerson.fields if f != 'id'})
+            people[p['id']] = dict(p, id=person.id)
+        for g in self.groups.values():
+            group = QGroup.objects.create(**{f: g[f] for f in LDAPGroup.fields if f != 'id'})
+            groups[g['id']] = dict(g, id=group.id)
+        User.groups.through.objects.bulk_create([
+            User.groups.through(user_id=people[m]['id'], group_id=groups[g]['id'])
+            for g, member_ids in self.members.items() for m in member_ids
+        ])
+        return SyntheticDirectory({p['id']: p for p in people.values()},
+                                  {g['id']: g for g in groups.values()},
+                                  {groups[g]['id']: [people[m]['id'] for m in m_ids] for g, m_ids in self.members.items()})
+
+    def ldap_people(self) -> Dict[str, Dict]:
+        """Returns the people as LDAP entries."""
+        return {LDAPPerson.dn_from_values(p['username']): LDAPPerson.attributes_from_values(p)
+                for p in self.people.values()}
+
+    def ldap_groups(self) -> Dict[str, Dict]:
+        """Returns the groups as LDAP entries."""
+        return {LDAPGroup.dn_from_values(g['name']): LDAPGroup.attributes_from_values(
+            g, [LDAPPerson.dn_from_values(self.people[m]['username']) for m in self.members[i] if m in self.people])
+            for i, g in self.groups.items()}
+
+    def graph_users(self) -> List[GraphUser]:
+        """Returns the people as Graph users."""
+        return [GraphUser('{} {}'.format(p['first_name'], p['last_name']), p['first_name'], p['username'],
+                          p['preferred_language'], p['last_name'], '{}@esmgquadrivium.nl'.format(p['username']),
+                          p['azure_immutable_id'], extension={'tuttiId': i})
+                for i, p in self.people.items()]
+
+    def graph_groups(self) -> List[GraphGroup]:
+        """Returns the groups as Graph groups."""
+        return [GraphGroup(g['description'], g['name'], g['name'], extension={'tuttiId': i})
+                for i, g in self.groups.items()]
+
+
+def _person(i: int, rnd: random.Random) -> Dict:
+    return {
+        'id': i,
+        'username': 'user{}'.format(i),
+        'first_name': rnd.choice(FIRST_NAMES),
+        'last_name': rnd.choice(LAST_NAMES),
+        'email': 'user{}@example.com'.format(i),
+        'preferred_language': rnd.choice(['nl', 'en', '']),
+        'ldap_password': '{SSHA}' + '%032x' % rnd.getrandbits(128),
+        'azure_immutable_id': '%032x' % rnd.getrandbits(128),
+    }
+
+
+def _group(i: int, rnd: random.Random) -> Dict:
+    return {
+        'id': i,
+        'name': 'group{}'.format(i),
+        'description': rnd.choice(['', 'A group']),
+        'email': 'group{}@example.com'.format(i),
+    }
+
+
+def measure(func: Callable, repeat: int = 3) -> Dict[str, float]:
+    """Measures the fastest run time and the peak memory allocated by a function.
+
+    The memory is measured in a separate run because tracing slows down the
+    function.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak}
+
+
+def get_benchmarks(local: SyntheticDirectory, remote: SyntheticDirectory) -> Dict[str, Callable]:
+    """Returns the benchmark functions with the inputs prepared up front."""
+    local_people, remote_people = local.ldap_people(), remote.ldap_people()
+    local_groups, remote_groups = local.ldap_groups(), remote.ldap_groups()
+    local_users, remote_users = local.graph_users(), remote.graph_users()
+    _, _, user_pairs = get_create_delete(local_users, remote_users)
+    return {
+        'remap': lambda: remap(remote_people, on='qDBLinkID'),
+        'sync_people': lambda: sync(local_people, remote_people, multi_valued=LDAPPerson.multi_valued),
+        'sync_groups': lambda: sync(local_groups, remote_groups, multi_valued=LDAPGroup.multi_valued),
+        'get_create_delete': lambda: get_create_delete(local_users, remote_users),
+        'get_update_list': lambda: get_update_list(user_pairs),
+    }
+
+
+def run_benchmarks(sizes: Iterable[int], churn: float, repeat: int = 3, seed: int = 0) -> Dict[str, Dict]:
+    """Runs all benchmarks for each directory size.
+
+    Returns:
+        Dictionary from benchmark name and size, e.g. 'sync_people[1000]',
+        onto a dictionary with the seconds and peak_bytes.
+    """
+    results = {}
+    for size in sizes:
+        local = SyntheticDirectory.generate(size, seed=seed)
+        remote = local.drift(churn, seed=seed + 1)
+        for name, func in get_benchmarks(local, remote).items():
+            results['{}[{}]'.format(name, size)] = measure(func, repeat=repeat)
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[Tuple[str, str, float]]:
+    """Returns the measurements that regressed compared to the baseline.
+
+    Args:
+        results: Results of run_benchmarks().
+        baseline: Earlier results of run_benchmarks(). Benchmarks that are
+            missing in either one are skipped.
+        tolerance: Allowed relative increase, e.g. 0.25 for 25%.
+
+    Returns:
+        A list of (benchmark, measurement, relative increase) tuples.
+    """
+    regressions = []
+    for name in sorted(results.keys() & baseline.keys()):
+        for key, value in results[name].items():
+            base = baseline[name].get(key)
+            if base and value > base * (1 + tolerance):
+                regressions.append((name, key, value / base - 1))
+    return regressions
@@ -0,0 +1,104 @@
+"""Canonical representation of LDAP entries for fast comparison.
+
+Attribute values can have different types depending on where they come from,
+e.g. qDBLinkID is an int locally while a server without schema information
+returns a str. The values are normalized once into sorted tuples, so
+comparing two attributes is a single equality check. A digest over the
+canonical values is only computed when asked for, e.g. for the bucket
+digests of sync.reconcile.
+"""
+import hashlib
+import pickle
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple, Union
+
+from sync.ldap import LDAPAttributeType
+
+CanonicalValue = Union[str, bytes]
+CanonicalValues = Tuple[CanonicalValue, ...]
+"""Multiset of canonical values, as a sorted tuple."""
+
+
+def _lower(value: CanonicalValue) -> CanonicalValue:
+    return value.lower()
+
+
+def _to_bytes(value: CanonicalValue) -> bytes:
+    return value.encode() if isinstance(value, str) else value
+
+
+# Normalization per attribute (lowercase name), on top of the type conversion
+# of normalize_value(). Only attributes whose matching rule makes the
+# difference meaningless to us are listed, e.g. a change of case in a name is
+# a real change which needs to be synced.
+SCHEMA = {
+    'objectclass': _lower,
+    'member': _lower,
+    'userpassword': _to_bytes,
+}
+
+
+def _convert(value: LDAPAttributeType) -> CanonicalValue:
+    if isinstance(value, (str, bytes)):
+        return value
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime('%Y%m%d%H%M%SZ')
+    return str(value)
+
+
+def normalize_value(attribute: str, value: LDAPAttributeType) -> CanonicalValue:
+    """Converts an attribute value to its canonical form."""
+    normalizer = SCHEMA.get(attribute.lower())
+    return normalizer(_convert(value)) if normalizer else _convert(value)
+
+
+def normalize_values(attribute: str, values: List[LDAPAttributeType]) -> CanonicalValues:
+    """Converts a list of attribute values into a canonical multiset."""
+    normalizer = SCHEMA.get(attribute.lower())
+    if normalizer is None and len(values) == 1 and type(values[0]) is str:
+        # Fast path for the common case
+        return values[0],
+    converted = [normalizer(_convert(v)) for v in values] if normalizer else [_convert(v) for v in values]
+    try:
+        return tuple(sorted(converted))
+    except TypeError:
+        # Mix of str and bytes values
+        return tuple(sorted(converted, key=repr))
+
+
+class CanonicalEntry:
+    """LDAP entry with canonical attribute values.
+
+    Attributes:
+        dn: The Distinguished Name.
+        attributes: The original attributes dictionary, for constructing
+            operations.
+        values: Dictionary from attribute name to canonical values. Empty
+            attributes are left out, since these are equal to no attribute.
+    """
+
+    __slots__ = ('dn', 'attributes', 'values')
+
+    def __init__(self, dn: str, attributes: Dict[str, List[LDAPAttributeType]]):
+        self.dn = dn
+        self.attributes = attributes
+        self.values = {k: normalize_values(k, v) for k, v in attributes.items() if v}
+
+    def get_digest(self) -> bytes:
+        """Returns a digest of the canonical values of all attributes."""
+        # A fixed pickle protocol keeps the digest stable between processes
+        data = pickle.dumps(sorted(self.values.items()), protocol=4)
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def __eq__(self, other):
+        if not isinstance(other, CanonicalEntry):
+            return NotImplemented
+        return self.dn.lower() == other.dn.lower() and self.values == other.values
+
+    def __hash__(self):
+        return hash((self.dn.lower(), frozenset(self.values.items())))
+
+    def __repr__(self):
+        return 'CanonicalEntry({}, {})'.format(self.dn, self.values)
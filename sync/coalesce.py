@@ -0,0 +1,91 @@
+"""Coalescing of sync triggers.
+
+Saving many objects in a row, e.g. during an import, would otherwise queue a
+sync task for each object. Instead, the first trigger schedules a sync after a
+short debounce window and later triggers are folded into that pending sync.
+"""
+import logging
+from datetime import timedelta
+from typing import Iterable, List
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import schedule
+
+from sync.aad.tasks import aad_sync
+from sync.ldapsync import ldap_sync_changes
+from sync.models import PendingSync
+from sync.runs import SAVE
+
+logger = logging.getLogger(__name__)
+
+LDAP = "ldap"
+"""Target for the LDAP sync, which supports syncing only the changed objects."""
+
+AAD = "aad"
+"""Target for the Azure Active Directory sync, which is always a full sync."""
+
+
+def trigger_sync(target: str, person_ids: Iterable[int] = (), group_ids: Iterable[int] = ()):
+    """Schedules a sync for the target or folds the trigger into a pending one.
+
+    Args:
+        target: LDAP or AAD.
+        person_ids: Primary keys of the changed people.
+        group_ids: Primary keys of the changed groups.
+    """
+    with transaction.atomic():
+        pending, _ = PendingSync.objects.select_for_update().get_or_create(target=target)
+        pending.person_ids = sorted(set(pending.person_ids) | set(person_ids))
+        pending.group_ids = sorted(set(pending.group_ids) | set(group_ids))
+        pending.triggers += 1
+        pending.save()
+        # Not only for a new pending sync, also when the schedule was lost or its task
+        #  died before claiming, else the pending sync would suppress all later syncs
+        name = get_schedule_name(target)
+        if not Schedule.objects.filter(name=name).exists():
+            schedule("sync.coalesce.run_pending_sync",
+                     target,
+                     name=name,
+                     hook='sync.signals.error_reporting',
+                     schedule_type=Schedule.ONCE,
+                     next_run=timezone.now() + timedelta(seconds=settings.SYNC_DEBOUNCE))
+
+
+def get_schedule_name(target: str) -> str:
+    """Returns the name of the schedule that runs the pending sync of the target."""
+    return "pending-sync-{}".format(target)
+
+
+def claim_pending_sync(target: str) -> PendingSync:
+    """Removes and returns the pending sync for the target.
+
+    Triggers arriving after this will schedule a new sync.
+
+    Raises:
+        PendingSync.DoesNotExist: When there is no pending sync.
+    """
+    with transaction.atomic():
+        pending = PendingSync.objects.select_for_update().get(target=target)
+        pending.delete()
+    return pending
+
+
+def run_pending_sync(target: str) -> List:
+    """Runs the pending sync for the target, used as Django-Q task.
+
+    Returns:
+        The applied operations.
+    """
+    try:
+        pending = claim_pending_sync(target)
+    except PendingSync.DoesNotExist:
+        return []
+    logger.info("Running %s sync for %d merged triggers", target, pending.triggers)
+    if target == LDAP:
+        return ldap_sync_changes(pending.person_ids, pending.group_ids)
+    elif target == AAD:
+        return aad_sync(trigger=SAVE)
+    raise ValueError("Unknown sync target {}".format(target))
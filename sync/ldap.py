@@ -1,18 +1,36 @@
 """Module for communication with the LDAP database."""
-from collections import namedtuple
+import logging
+import os
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Union, Iterable
+from time import monotonic, perf_counter
+from typing import List, Dict, Union, Iterable, Tuple, Iterator, Callable, Optional
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from ldap3 import Server, Connection, LEVEL
+from ldap3 import Server, Connection, LEVEL, BASE, SYNC
+from ldap3.core.results import RESULT_SUCCESS
+from ldap3.core.exceptions import LDAPException, LDAPInvalidCredentialsResult
+from ldap3.utils.conv import escape_filter_chars
+
+from sync.metrics import LDAP_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
 
 LDAPAttributeType = Union[str, int, datetime, bool]
 """Possible types for LDAP attribute values."""
 
 
-def get_connection():
-    """Opens a new LDAP connection, use as context manager."""
+def get_connection(client_strategy=SYNC, raise_exceptions=True):
+    """Opens a new LDAP connection, use as context manager.
+
+    Args:
+        client_strategy: ldap3 client strategy, e.g. ASYNC for pipelining.
+        raise_exceptions: Whether operation results other than success raise
+            an exception.
+    """
     # Need to have a host setup
     if not settings.LDAP_HOST:
         raise ImproperlyConfigured("LDAP host not setup.")
@@ -20,14 +38,241 @@ def get_connection():
     conn = Connection(server=server,
                       user=settings.LDAP_USER,
                       password=settings.LDAP_PASSWORD,
-                      raise_exceptions=True)
+                      client_strategy=client_strategy,
+                      raise_exceptions=raise_exceptions)
     if settings.LDAP_START_TLS:
         conn.start_tls(read_server_info=False)
     return conn
 
 
-LDAPSearch = namedtuple('LDAPSearch', ['base_dn', 'object_class', 'attributes'])
-"""Specifies parameters for an LDAP search: base DN, object class and attributes."""
+def get_bound_connection() -> Connection:
+    """Opens a new LDAP connection and binds, used as pool connection factory."""
+    conn = get_connection()
+    conn.bind()
+    return conn
+
+
+def is_healthy(conn: Connection) -> bool:
+    """Checks if the connection still works by reading the root DSE."""
+    try:
+        response = conn.search('', '(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+        if not conn.strategy.sync:
+            # Asynchronous strategies return a message ID
+            _, result = conn.get_response(response)
+            return result['result'] == RESULT_SUCCESS
+        return response
+    except LDAPException:
+        return False
+
+
+class LDAPConnectionPool:
+    """Pool of bound LDAP connections that are reused between calls.
+
+    Connections are bound and TLS-negotiated once, when they are created.
+    A connection is only used by one thread at a time. Connections that have
+    been idle for too long are evicted and connections that have been idle
+    for a while get a health check before they are handed out.
+    """
+
+    def __init__(self,
+                 factory: Callable[[], Connection] = get_bound_connection,
+                 max_size: int = 4,
+                 max_idle: float = 300,
+                 check_after: float = 30,
+                 health_check: Callable[[Connection], bool] = is_healthy):
+        """Constructs an empty pool.
+
+        Args:
+            factory: Returns a new bound connection.
+            max_size: Maximum number of idle connections that are kept. When
+                more connections are in use at the same time, extra
+                connections are created but they are closed after use.
+            max_idle: Idle connections older than this many seconds are
+                closed instead of reused.
+            check_after: Idle connections older than this many seconds are
+                health checked before reuse.
+            health_check: Returns whether a connection can still be used.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.health_check = health_check
+        self._idle = deque()  # Pairs of (connection, time of last use), most recently used on the right
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'evicted': 0, 'unhealthy': 0, 'discarded': 0}
+
+    def _close(self, conn: Connection):
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def _take_idle(self) -> Optional[Connection]:
+        """Returns an idle connection that is usable, or None."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, last_used = self._idle.pop()
+            idle = monotonic() - last_used
+            if idle > self.max_idle or conn.closed:
+                self._close(conn)
+                self._count('evicted')
+                continue
+            if idle > self.check_after and not self.health_check(conn):
+                self._close(conn)
+                self._count('unhealthy')
+                continue
+            return conn
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def acquire(self) -> Connection:
+        """Takes a connection from the pool, or creates a new one.
+
+        Return it with release() after use.
+        """
+        conn = self._take_idle()
+        if conn:
+            self._count('reused')
+        else:
+            conn = self.factory()
+            self._count('created')
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def release(self, conn: Connection, discard=False):
+        """Gives a connection back to the pool.
+
+        Args:
+            conn: Connection from acquire().
+            discard: If True, the connection is closed instead of reused.
+        """
+        with self._lock:
+            self._in_use -= 1
+            keep = not discard and not conn.closed and len(self._idle) < self.max_size
+            if keep:
+                self._idle.append((conn, monotonic()))
+        if not keep:
+            self._close(conn)
+            self._count('discarded')
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Context manager for a pooled connection.
+
+        The connection is discarded when the block raises an exception that
+        did not come from the LDAP server, e.g. a socket error.
+        """
+        conn = self.acquire()
+        discard = True
+        try:
+            yield conn
+            discard = False
+        except LDAPException:
+            # Server results (e.g. no such object) leave the connection usable
+            discard = conn.closed
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns pool statistics."""
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), in_use=self._in_use)
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(name: str = 'default', factory: Callable[[], Connection] = get_bound_connection) -> LDAPConnectionPool:
+    """Returns a process-wide connection pool.
+
+    Pools are not shared with forked processes, since connections can't be.
+
+    Args:
+        name: Separate pools are kept per name. The 'default' pool has
+            connections bound with the service account, the 'credentials'
+            pool is used for checking user credentials.
+        factory: Connection factory, used when the pool is created.
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if name not in _pools:
+            _pools[name] = LDAPConnectionPool(factory=factory,
+                                              max_size=settings.LDAP_POOL_SIZE,
+                                              max_idle=settings.LDAP_POOL_MAX_IDLE)
+        return _pools[name]
+
+
+def pooled_connection():
+    """Context manager for a pooled connection bound with the service account."""
+    return get_pool().connection()
+
+
+def check_credentials(user: str, password: str) -> bool:
+    """Tries to bind (login) on LDAP with given credentials.
+
+    Uses a separate pool so that connections of the service account are never
+    rebound as a user.
+    """
+    pool = get_pool('credentials')
+    conn = pool.acquire()
+    try:
+        with LDAP_REQUEST_SECONDS.time(operation='bind'):
+            conn.rebind(user, password)
+    except LDAPInvalidCredentialsResult:
+        # The connection is in an unknown bind state
+        pool.release(conn, discard=True)
+        return False
+    except Exception:
+        pool.release(conn, discard=True)
+        raise
+    pool.release(conn)
+    return True
+
+
+LDAPSearch = namedtuple('LDAPSearch', ['base_dn', 'object_class', 'attributes', 'filter'], defaults=[None])
+"""Specifies parameters for an LDAP search: base DN, object class and attributes.
+
+Optionally an additional search filter can be given that the entries need to
+match as well.
+"""
+
+
+def any_of(assertions: Iterable[Tuple[str, LDAPAttributeType]]) -> str:
+    """Returns a search filter that matches any of the attribute value assertions.
+
+    Args:
+        assertions: Pairs of attribute name and value. The values are escaped.
+    """
+    return '(|{})'.format(''.join('({}={})'.format(attr, escape_filter_chars(str(value)))
+                                  for attr, value in assertions))
+
+
+def get_search_filter(search: LDAPSearch) -> str:
+    """Returns the full LDAP search filter string for a search."""
+    search_filter = '(objectClass={})'.format(search.object_class)
+    if search.filter:
+        search_filter = '(&{}{})'.format(search_filter, search.filter)
+    return search_filter
 
 
 def _normalize_attrs(attrs: Dict) -> Dict:
@@ -47,6 +292,59 @@ def _normalize_dn(dn: str) -> str:
     return dn.lower()
 
 
+def _timed_pages(response: Iterator[Dict]) -> Iterator[Dict]:
+    """Passes on the entries of a paged search and records the time spent waiting for the server.
+
+    The time the caller spends between entries is not included.
+    """
+    waited = 0.0
+    while True:
+        start = perf_counter()
+        try:
+            entry = next(response)
+        except StopIteration:
+            break
+        finally:
+            waited += perf_counter() - start
+        yield entry
+    LDAP_REQUEST_SECONDS.observe(waited, operation='search')
+
+
+def iter_ldap_entries(conn: Connection,
+                      search: Iterable[LDAPSearch],
+                      page_size: int = None) -> Iterator[Tuple[str, Dict[str, List[LDAPAttributeType]]]]:
+    """Streams data from the LDAP database.
+
+    The entries are retrieved using the simple paged results control (RFC
+    2696), so only one page of entries is held in memory at a time and server
+    size limits are not hit.
+
+    Args:
+        conn: LDAP connection.
+        search: What to get from the database.
+        page_size: Number of entries per page, defaults to the LDAP_PAGE_SIZE
+            setting.
+
+    Returns:
+        A generator of (DN, {attribute -> [values]}) tuples. The entries are
+            normalized, i.e. DNs are all lowercase.
+    """
+    if page_size is None:
+        page_size = settings.LDAP_PAGE_SIZE
+    for s in search:
+        response = conn.extend.standard.paged_search(search_base=s.base_dn,
+                                                     search_filter=get_search_filter(s),
+                                                     search_scope=LEVEL,
+                                                     attributes=s.attributes,
+                                                     paged_size=page_size,
+                                                     generator=True)
+        for response_entry in _timed_pages(response):
+            # Skip search continuation references
+            if response_entry['type'] != 'searchResEntry':
+                continue
+            yield _normalize_dn(response_entry['dn']), _normalize_attrs(response_entry['attributes'])
+
+
 def get_ldap_entries(conn: Connection,
                      search: Iterable[LDAPSearch]) -> Dict[str, Dict[str, List[LDAPAttributeType]]]:
     """Get data from the LDAP database.
@@ -60,16 +358,4 @@ def get_ldap_entries(conn: Connection,
             dictionary is {DN -> {attribute -> [values]}}. The entries are
             normalized, i.e. DNs are all lowercase.
     """
-    entries = {}
-    for s in search:
-        search_filter = '(objectClass={})'.format(s.object_class)
-        conn.search(search_base=s.base_dn,
-                    search_filter=search_filter,
-                    search_scope=LEVEL,
-                    attributes=s.attributes)
-        for response_entry in conn.response:
-            dn = _normalize_dn(response_entry['dn'])
-            attrs = _normalize_attrs(response_entry['attributes'])
-            entries[dn] = attrs
-
-    return entries
+    return dict(iter_ldap_entries(conn, search))
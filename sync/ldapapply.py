@@ -0,0 +1,176 @@
+"""Pipelined apply of LDAP operations over an asynchronous connection.
+
+Operations on different entries are independent, so instead of waiting for
+the response of each operation before sending the next one, multiple
+operations are kept in flight. Operations that share a DN are still applied in
+their original order, e.g. a ModifyDNOperation before the attribute modify on
+the renamed entry.
+
+A modify that only adds and deletes values fails with noSuchAttribute or
+attributeOrValueExists when the remote values differ from the snapshot it was
+computed from. Such an operation is applied again with its fallback, which
+replaces the attribute (LDAPOperation.get_fallback()). The entry gets a new
+modifyTimestamp, so the snapshot reads it again on the next refresh.
+"""
+import logging
+from collections import namedtuple, deque
+from heapq import heappush, heappop
+from time import perf_counter
+from typing import List, Iterable
+
+from django.conf import settings
+from ldap3 import Connection, ASYNC
+from ldap3.core.results import RESULT_SUCCESS, RESULT_NO_SUCH_ATTRIBUTE, RESULT_ATTRIBUTE_OR_VALUE_EXISTS
+from ldap3.core.exceptions import LDAPException
+
+from sync.ldap import get_connection, get_pool
+from sync.ldapoperations import LDAPOperation
+from sync.metrics import LDAP_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Result codes of a modify of which the values are stale
+STALE_RESULTS = {RESULT_NO_SUCH_ATTRIBUTE, RESULT_ATTRIBUTE_OR_VALUE_EXISTS}
+
+OperationResult = namedtuple('OperationResult', ['operation', 'success', 'result'])
+"""Outcome of an applied operation.
+
+The result is the ldap3 result dictionary, or an error message when the
+operation could not be sent or was skipped.
+"""
+
+
+class ApplyError(Exception):
+    """Raised when one or more operations failed to apply."""
+
+    def __init__(self, results: List[OperationResult]):
+        self.results = results
+        failed = [r for r in results if not r.success]
+        super().__init__('{} of {} operations failed: {}'.format(
+            len(failed), len(results), '; '.join('{}: {}'.format(r.operation, r.result) for r in failed)))
+
+
+def get_async_connection() -> Connection:
+    """Opens a new bound LDAP connection with the asynchronous strategy.
+
+    Exceptions are not raised for results, these are collected by
+    apply_pipelined() instead.
+    """
+    conn = get_connection(client_strategy=ASYNC, raise_exceptions=False)
+    conn.bind()
+    return conn
+
+
+def pipelined_connection():
+    """Context manager for a pooled asynchronous connection."""
+    return get_pool('async', factory=get_async_connection).connection()
+
+
+def _get_dependencies(operations: List[LDAPOperation]) -> List[List[int]]:
+    """Returns for each operation the indices of the earlier operations it waits for."""
+    last = {}  # DN -> index of the last operation on that DN
+    dependencies = []
+    for i, operation in enumerate(operations):
+        dns = operation.get_dns()
+        dependencies.append(sorted({last[dn] for dn in dns if dn in last}))
+        for dn in dns:
+            last[dn] = i
+    return dependencies
+
+
+class _Pipeline:
+    """State of a pipelined apply, see apply_pipelined()."""
+
+    def __init__(self, conn: Connection, operations: List[LDAPOperation], window: int):
+        self.conn = conn
+        self.operations = operations
+        self.window = window
+        self.dependencies = _get_dependencies(operations)
+        self.results = [None] * len(operations)  # type: List[OperationResult]
+        # Operations are released when their last dependency is done, instead of scanning all waiting operations
+        self.blockers = [len(d) for d in self.dependencies]
+        self.dependents = [[] for _ in operations]  # type: List[List[int]]
+        for i, dependencies in enumerate(self.dependencies):
+            for j in dependencies:
+                self.dependents[j].append(i)
+        self.ready = [i for i, n in enumerate(self.blockers) if n == 0]  # Heap, sent in order
+        self.in_flight = deque()  # Tuples of (operation index, message ID, send time)
+
+    def _done(self, i: int, success: bool, result):
+        self.results[i] = OperationResult(self.operations[i], success, result)
+        for j in self.dependents[i]:
+            self.blockers[j] -= 1
+            if self.blockers[j] == 0:
+                heappush(self.ready, j)
+
+    def _finish(self, i: int, result: dict):
+        """Completes the operation with its ldap3 result, or sends its fallback when the values were stale."""
+        fallback = self.operations[i].get_fallback()
+        if result['result'] in STALE_RESULTS and fallback:
+            logger.info('%s failed with %s, replacing the values instead', self.operations[i], result.get('description'))
+            self.operations[i] = fallback
+            heappush(self.ready, i)
+            return
+        self._done(i, result['result'] == RESULT_SUCCESS, result)
+
+    def _send(self, i: int):
+        """Sends the operation, or skips it when a dependency failed."""
+        if not all(self.results[j].success for j in self.dependencies[i]):
+            self._done(i, False, 'skipped, an earlier operation on the entry failed')
+            return
+        start = perf_counter()
+        try:
+            message_id = self.operations[i].apply(self.conn)
+        except LDAPException as e:
+            self._done(i, False, str(e))
+            return
+        if self.conn.strategy.sync:
+            # Synchronous strategies return whether the operation succeeded
+            self._observe(i, start)
+            self._finish(i, self.conn.result)
+        else:
+            self.in_flight.append((i, message_id, start))
+
+    def _observe(self, i: int, start: float):
+        LDAP_REQUEST_SECONDS.observe(perf_counter() - start, operation=type(self.operations[i]).__name__)
+
+    def _receive(self):
+        """Waits for the response of the oldest request in flight."""
+        i, message_id, start = self.in_flight.popleft()
+        try:
+            _, result = self.conn.get_response(message_id)
+            self._observe(i, start)
+            self._finish(i, result)
+        except LDAPException as e:
+            self._done(i, False, str(e))
+
+    def run(self) -> List[OperationResult]:
+        while self.ready or self.in_flight:
+            # Send operations that are ready, in order, while there is room in the window
+            while self.ready and len(self.in_flight) < self.window:
+                self._send(heappop(self.ready))
+            if self.in_flight:
+                self._receive()
+        return self.results
+
+
+def apply_pipelined(conn: Connection,
+                    operations: Iterable[LDAPOperation],
+                    window: int = None) -> List[OperationResult]:
+    """Applies operations with multiple requests in flight.
+
+    Args:
+        conn: Connection with an asynchronous strategy (ASYNC or MOCK_ASYNC).
+            Works with synchronous strategies as well, but without pipelining.
+        operations: Operations in the order they would be applied one by one.
+        window: Maximum number of requests in flight, defaults to the
+            LDAP_PIPELINE_WINDOW setting.
+
+    Returns:
+        A result for each operation, in the order of the operations.
+        Operations that depend on a failed operation are skipped and reported
+        as failed.
+    """
+    if window is None:
+        window = settings.LDAP_PIPELINE_WINDOW
+    return _Pipeline(conn, list(operations), window).run()
@@ -1,11 +1,12 @@
 """Module for presenting the local Django data as LDAP entities."""
 
-from typing import Dict, List
+from collections import defaultdict
+from typing import Dict, List, Iterable
 
 from django.db.models import QuerySet
 
 from sync.ldap import LDAPSearch, LDAPAttributeType
-from members.models import QGroup, Person
+from members.models import QGroup, Person, User
 
 
 class LDAPEntity:
@@ -14,6 +15,13 @@ class LDAPEntity:
     # Django model class corresponding to this entity.
     model = None
 
+    # Model fields that are needed to build the LDAP entry.
+    fields = ()
+
+    # Attributes that can have many values, these are synced by adding and
+    #  deleting only the changed values.
+    multi_valued = ()
+
     def __init__(self, instance: model):
         """Constructs instance.
 
@@ -42,9 +50,22 @@ class LDAPEntity:
         raise NotImplementedError()
 
     @classmethod
-    def get_entries(cls) -> Dict[str, Dict[str, List[str]]]:
-        """Gets all the local database entries of this model in LDAP format."""
-        return {i.get_dn(): i.get_attributes() for i in cls.from_queryset(cls.model.objects.all())}
+    def get_entries(cls, ids: Iterable[int] = None) -> Dict[str, Dict[str, List[str]]]:
+        """Gets all the local database entries of this model in LDAP format.
+
+        Args:
+            ids: If given, only the entries with these primary keys are
+                returned.
+        """
+        return {i.get_dn(): i.get_attributes() for i in cls.from_queryset(cls.get_queryset(ids))}
+
+    @classmethod
+    def get_queryset(cls, ids: Iterable[int] = None) -> QuerySet:
+        """Returns the model queryset, optionally limited to the given primary keys."""
+        qs = cls.model.objects.all()
+        if ids is not None:
+            qs = qs.filter(id__in=ids)
+        return qs
 
     @classmethod
     def from_queryset(cls, qs: QuerySet) -> List:
@@ -55,30 +76,68 @@ class LDAPEntity:
 class LDAPGroup(LDAPEntity):
     model = QGroup
 
+    # Model fields that are needed to build the LDAP entry.
+    fields = ('id', 'name', 'description', 'email')
+
+    multi_valued = ('objectClass', 'member')
+
     def get_dn(self):
-        return 'cn={},ou=groups,dc=esmgquadrivium,dc=nl'.format(self.instance.name.lower())
+        return self.dn_from_values(self.instance.name)
 
     def get_attributes(self) -> Dict[str, List[LDAPAttributeType]]:
+        values = {f: getattr(self.instance, f) for f in self.fields}
+        members = LDAPPerson.from_queryset(Person.objects.filter(groups=self.instance))
+        return self.attributes_from_values(values, [m.get_dn() for m in members])
+
+    @staticmethod
+    def dn_from_values(name: str) -> str:
+        """Gets the DN for a group with given name."""
+        return 'cn={},ou=groups,dc=esmgquadrivium,dc=nl'.format(name.lower())
+
+    @staticmethod
+    def attributes_from_values(values: Dict, member_dns: List[str]) -> Dict[str, List[LDAPAttributeType]]:
+        """Builds the LDAP attributes from a values() row and member DNs."""
         # Attributes may only exist if they have a value
 
         # Mandatory attributes
         result = {
             'objectClass': ['esmgqGroup', 'groupOfNames', 'top'],
-            'cn': [self.instance.name],
-            'qDBLinkID': [self.instance.id],
+            'cn': [values['name']],
+            'qDBLinkID': [values['id']],
         }
 
         # Optional
-        if self.instance.description:
-            result['description'] = [self.instance.description]
-        if self.instance.email:
-            result['mail'] = [self.instance.email]
-        members = LDAPPerson.from_queryset(Person.objects.filter(groups=self.instance))
-        if members:
-            result['member'] = [m.get_dn() for m in members]
+        if values['description']:
+            result['description'] = [values['description']]
+        if values['email']:
+            result['mail'] = [values['email']]
+        if member_dns:
+            result['member'] = member_dns
 
         return result
 
+    @classmethod
+    def get_entries(cls, ids: Iterable[int] = None) -> Dict[str, Dict[str, List[str]]]:
+        """Gets the groups in LDAP format using a constant number of queries.
+
+        Instead of a member query per group, the people and the group
+        membership table are each loaded with a single values() projection.
+        """
+        memberships = User.groups.through.objects.order_by('user_id')
+        people = Person.objects.all()
+        if ids is not None:
+            memberships = memberships.filter(group_id__in=ids)
+            people = people.filter(groups__in=ids).distinct()
+        person_dns = {p['id']: LDAPPerson.dn_from_values(p['username'])
+                      for p in people.values('id', 'username')}
+        member_dns = defaultdict(list)
+        for group_id, user_id in memberships.values_list('group_id', 'user_id'):
+            # Users that are not a Person are not in LDAP
+            if user_id in person_dns:
+                member_dns[group_id].append(person_dns[user_id])
+        return {cls.dn_from_values(g['name']): cls.attributes_from_values(g, member_dns[g['id']])
+                for g in cls.get_queryset(ids).values(*cls.fields)}
+
     @classmethod
     def get_search(cls) -> LDAPSearch:
         return LDAPSearch(
@@ -98,34 +157,60 @@ class LDAPGroup(LDAPEntity):
 class LDAPPerson(LDAPEntity):
     model = Person
 
+    # Model fields that are needed to build the LDAP entry.
+    fields = ('id', 'username', 'first_name', 'last_name', 'email', 'preferred_language', 'ldap_password',
+              'azure_immutable_id')
+
+    multi_valued = ('objectClass',)
+
     def get_dn(self) -> str:
-        return 'uid={},ou=people,dc=esmgquadrivium,dc=nl'.format(self.instance.username.lower())
+        return self.dn_from_values(self.instance.username)
 
     def get_attributes(self) -> Dict[str, List[LDAPAttributeType]]:
+        return self.attributes_from_values({f: getattr(self.instance, f) for f in self.fields})
+
+    @staticmethod
+    def dn_from_values(username: str) -> str:
+        """Gets the DN for a person with given username."""
+        return 'uid={},ou=people,dc=esmgquadrivium,dc=nl'.format(username.lower())
+
+    @staticmethod
+    def attributes_from_values(values: Dict) -> Dict[str, List[LDAPAttributeType]]:
+        """Builds the LDAP attributes from a values() row."""
+        # Same as User.get_full_name() and Person.get_azure_upn()
+        full_name = '{} {}'.format(values['first_name'], values['last_name']).strip()
+        azure_upn = '{}@esmgquadrivium.nl'.format(values['username'].lower())
+
         # Empty values are not allowed to be in the dictionary
         result = {
             'objectClass': ['esmgqPerson', 'inetOrgPerson', 'organizationalPerson', 'person', 'top'],
-            'uid': [self.instance.username],
-            'qAzureUPN': [self.instance.get_azure_upn()],
-            'qDBLinkID': [self.instance.id],
+            'uid': [values['username']],
+            'qAzureUPN': [azure_upn],
+            'qDBLinkID': [values['id']],
             # We use 'employeeNumber' to store the Azure immutable ID
-            'employeeNumber': [self.instance.azure_immutable_id],
+            'employeeNumber': [values['azure_immutable_id']],
         }
-        if self.instance.first_name:
-            result['givenName'] = [self.instance.first_name]
-        if self.instance.last_name:
-            result['sn'] = [self.instance.last_name]
-        if self.instance.get_full_name():
-            result['cn'] = [self.instance.get_full_name()]
-        if self.instance.email:
-            result['mail'] = [self.instance.email]
-        if self.instance.preferred_language:
-            result['preferredLanguage'] = [self.instance.preferred_language]
-        if self.instance.ldap_password:
+        if values['first_name']:
+            result['givenName'] = [values['first_name']]
+        if values['last_name']:
+            result['sn'] = [values['last_name']]
+        if full_name:
+            result['cn'] = [full_name]
+        if values['email']:
+            result['mail'] = [values['email']]
+        if values['preferred_language']:
+            result['preferredLanguage'] = [values['preferred_language']]
+        if values['ldap_password']:
             # userPassword is stored as a bytes object in LDAP, we encode with UTF-8
-            result['userPassword'] = [self.instance.ldap_password.encode()]
+            result['userPassword'] = [values['ldap_password'].encode()]
         return result
 
+    @classmethod
+    def get_entries(cls, ids: Iterable[int] = None) -> Dict[str, Dict[str, List[str]]]:
+        """Gets the people in LDAP format from a single values() query."""
+        return {cls.dn_from_values(p['username']): cls.attributes_from_values(p)
+                for p in cls.get_queryset(ids).values(*cls.fields)}
+
     @classmethod
     def get_search(cls) -> LDAPSearch:
         return LDAPSearch(
@@ -1,16 +1,52 @@
 """LDAP add, delete and modify operations."""
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Set
 
-from ldap3 import Connection, MODIFY_REPLACE
+from ldap3 import Connection, MODIFY_REPLACE, MODIFY_ADD, MODIFY_DELETE
+from ldap3.utils.dn import parse_dn
 
 
 class LDAPOperation:
     """Base class for LDAP sync operations (add/delete/modify)."""
 
+    # Distinguished Name of the entry that the operation applies to.
+    dn = None
+
     def apply(self, conn: Connection):
-        """Perform the operation on an LDAP connection."""
+        """Perform the operation on an LDAP connection.
+
+        Returns:
+            The return value of the ldap3 call, which is the message ID for
+            asynchronous connection strategies.
+        """
         raise NotImplementedError()
 
+    def get_dns(self) -> Set[str]:
+        """Returns the (lowercase) DNs of the entries affected by this operation.
+
+        Operations that share a DN need to be applied in order.
+        """
+        return {self.dn.lower()}
+
+    def get_changes(self) -> Optional[Dict[str, List[Tuple[str, List]]]]:
+        """Returns the attribute changes in ldap3 modify format.
+
+        Returns:
+            A dictionary from attribute to list of (change type, values)
+            tuples, or None if this operation does not modify attributes.
+        """
+        return None
+
+    def get_fallback(self) -> Optional['LDAPOperation']:
+        """Returns an operation with the same outcome that doesn't depend on the current remote values.
+
+        Used when this operation failed because the remote values were not
+        as expected, e.g. with noSuchAttribute for a value to delete.
+
+        Returns:
+            The operation or None if there is no fallback.
+        """
+        return None
+
 
 class AddOperation(LDAPOperation):
     """Add a new entry."""
@@ -35,7 +71,7 @@ class AddOperation(LDAPOperation):
 
     def apply(self, conn: Connection):
         # Note! The LDAP server complains if an attribute has an empty list as the value.
-        conn.add(self.dn, attributes=self.attributes)
+        return conn.add(self.dn, attributes=self.attributes)
 
 
 class DeleteOperation(LDAPOperation):
@@ -58,7 +94,7 @@ class DeleteOperation(LDAPOperation):
         return False
 
     def apply(self, conn: Connection):
-        conn.delete(self.dn)
+        return conn.delete(self.dn)
 
 
 class ModifyOperation(LDAPOperation):
@@ -94,7 +130,107 @@ class ModifyOperation(LDAPOperation):
     def apply(self, conn: Connection):
         # if not self.values or not self.values[0]:
         #     self.values = None
-        conn.modify(self.dn, {self.attribute: [(MODIFY_REPLACE, self.values)]})
+        return conn.modify(self.dn, self.get_changes())
+
+    def get_changes(self) -> Dict[str, List[Tuple[str, List]]]:
+        return {self.attribute: [(MODIFY_REPLACE, self.values)]}
+
+
+class ModifyValuesOperation(LDAPOperation):
+    """Add and delete individual values of a multi-valued attribute.
+
+    Unlike ModifyOperation, only the changed values are sent, which matters
+    for attributes with many values like the member list of a large group.
+    """
+
+    def __init__(self, dn: str, attribute: str, add: List[str], delete: List[str], values: List[str] = None):
+        """Add and delete values.
+
+        Args:
+            dn: Distinguished Name.
+            attribute: Attribute name.
+            add: Values to add to the attribute.
+            delete: Values to delete from the attribute. The attribute must
+                keep at least one value.
+            values: All new values of the attribute, if given these replace
+                the attribute when the remote values turn out to differ.
+        """
+        self.dn = dn
+        self.attribute = attribute
+        self.add = add
+        self.delete = delete
+        self.values = values
+
+    def __str__(self) -> str:
+        return 'Modify {}: add {} to and delete {} from {}'.format(self.dn, self.add, self.delete, self.attribute)
+
+    def __eq__(self, o: object) -> bool:
+        if isinstance(o, ModifyValuesOperation):
+            values_equal = sorted(self.add) == sorted(o.add) and sorted(self.delete) == sorted(o.delete)
+            return self.dn == o.dn and self.attribute == o.attribute and values_equal
+        return False
+
+    def apply(self, conn: Connection):
+        return conn.modify(self.dn, self.get_changes())
+
+    def get_changes(self) -> Dict[str, List[Tuple[str, List]]]:
+        # Deletions go first, for when a value is replaced by one that only differs in case
+        changes = []
+        if self.delete:
+            changes.append((MODIFY_DELETE, self.delete))
+        if self.add:
+            changes.append((MODIFY_ADD, self.add))
+        return {self.attribute: changes}
+
+    def get_fallback(self) -> Optional[LDAPOperation]:
+        if self.values is None:
+            return None
+        return ModifyOperation(self.dn, self.attribute, self.values)
+
+
+class ModifyAttributesOperation(LDAPOperation):
+    """Modify multiple attributes of an entry in a single atomic request."""
+
+    def __init__(self,
+                 dn: str,
+                 changes: Dict[str, List[Tuple[str, List]]],
+                 replace: Dict[str, List[Tuple[str, List]]] = None):
+        """Modify multiple attributes.
+
+        Args:
+            dn: Distinguished Name.
+            changes: A dictionary from attribute to a list of (change type,
+                values) tuples, see ldap3 Connection.modify().
+            replace: The same changes with only replaced values, used when
+                the remote values turn out to differ, see get_fallback().
+        """
+        self.dn = dn
+        self.changes = changes
+        self.replace = replace
+
+    def __str__(self) -> str:
+        return 'Modify {}: {}'.format(self.dn, self.changes)
+
+    def __eq__(self, o: object) -> bool:
+        if isinstance(o, ModifyAttributesOperation):
+            # Order of values doesn't matter
+            return self.dn == o.dn and self._sorted_changes() == o._sorted_changes()
+        return False
+
+    def _sorted_changes(self) -> Dict[str, List[Tuple[str, List]]]:
+        return {attr: [(change_type, sorted(values)) for change_type, values in changes]
+                for attr, changes in self.changes.items()}
+
+    def apply(self, conn: Connection):
+        return conn.modify(self.dn, self.changes)
+
+    def get_changes(self) -> Dict[str, List[Tuple[str, List]]]:
+        return self.changes
+
+    def get_fallback(self) -> Optional[LDAPOperation]:
+        if self.replace is None or self.replace == self.changes:
+            return None
+        return ModifyAttributesOperation(self.dn, self.replace)
 
 
 class ModifyDNOperation(LDAPOperation):
@@ -112,22 +248,35 @@ class ModifyDNOperation(LDAPOperation):
             return self.dn == o.dn and self.new_dn == o.new_dn
         return False
 
+    @property
+    def rdn(self) -> str:
+        """The relative DN of the new DN, i.e. its first component."""
+        return split_dn(self.new_dn)[0]
+
+    @property
+    def superior(self) -> Optional[str]:
+        """The parent of the new DN, or None if the entry stays below the same parent."""
+        parent = split_dn(self.new_dn)[1]
+        return parent if parent.lower() != split_dn(self.dn)[1].lower() else None
+
     def apply(self, conn: Connection):
-        dn, relative_dn, new_superior = self._get_modify_dn_args()
-        conn.modify_dn(dn, relative_dn, new_superior=new_superior)
+        # See https://ldap3.readthedocs.io/en/latest/modifydn.html
+        return conn.modify_dn(self.dn, self.rdn, new_superior=self.superior)
 
-    def _get_modify_dn_args(self) -> Tuple[str, str, Optional[str]]:
-        """Returns DNs in the correct format for the modify_dn function.
+    def get_dns(self) -> Set[str]:
+        return {self.dn.lower(), self.new_dn.lower()}
 
-        See https://ldap3.readthedocs.io/en/latest/modifydn.html.
 
-        Returns:
-            A 3 tuple with (old DN | first component of new DN | rest of new DN
-            if different else None).
-        """
-        old_dn_parts = self.dn.partition(",")
-        new_dn_parts = self.new_dn.partition(",")
-        new_superior = None
-        if old_dn_parts[2].lower() != new_dn_parts[2].lower():
-            new_superior = new_dn_parts[2]
-        return self.dn, new_dn_parts[0], new_superior
+def split_dn(dn: str) -> Tuple[str, str]:
+    r"""Splits a DN in the relative DN and the DN of the parent.
+
+    Escaped commas and multi-valued relative DNs are taken into account,
+    e.g. 'cn=Doe\, John+uid=jd,dc=example' is split in 'cn=Doe\, John+uid=jd'
+    and 'dc=example'.
+    """
+    components = parse_dn(dn)
+    # The relative DN ends with the first component that is not followed by a '+'
+    end = next((i + 1 for i, (_, _, separator) in enumerate(components) if separator != '+'), len(components))
+    rdn = '+'.join('{}={}'.format(attribute, value) for attribute, value, _ in components[:end])
+    parent = ''.join('{}={}{}'.format(*component) for component in components[end:])
+    return rdn, parent
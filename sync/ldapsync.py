@@ -1,37 +1,203 @@
 """High level LDAP sync functions."""
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event
+from time import perf_counter
+from typing import List, Iterable, Callable, ContextManager, Tuple, Iterator, Dict
 
+from django.conf import settings
 from ldap3 import Connection
 
-from sync.ldap import get_ldap_entries, get_connection
+from members.models import User
+from sync.ldap import get_ldap_entries, any_of, iter_ldap_entries, pooled_connection, LDAPSearch, LDAPAttributeType
+from sync.ldapapply import apply_pipelined, pipelined_connection, ApplyError
 from sync.ldapentities import LDAPPerson, LDAPGroup
 from sync.ldapoperations import LDAPOperation
+from sync.runs import record_run, SAVE
+from sync.snapshot import RemoteSnapshot
 from sync.sync import sync
+from sync.timing import PhaseTimer
 
 
-def get_ldap_sync_operations(conn: Connection) -> List[LDAPOperation]:
-    """Compares local and remote data and returns sync operations."""
-    # Retrieve local and remote entries
-    local_people = LDAPPerson.get_entries()
-    local_groups = LDAPGroup.get_entries()
-    remote_people = get_ldap_entries(conn, [LDAPPerson.get_search()])
-    remote_groups = get_ldap_entries(conn, [LDAPGroup.get_search()])
-    # The people and groups need to be synced separately because they
-    #  are matched on their primary key, which is only unique within
-    #  people and groups, but not unique if you take those together.
-    operations = sync(local_people, remote_people)
-    operations += sync(local_groups, remote_groups)
+_END = object()
+
+
+class _RemoteStream:
+    """Searches the remote entries on a worker thread and hands them over one by one.
+
+    The hand-over queue holds at most a page of entries, so the entries are
+    diffed on the calling thread while they are read instead of being held in
+    memory all at once. The search runs ahead while the local entries are
+    loaded.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor,
+                 connection: Callable[[], ContextManager[Connection]],
+                 search: LDAPSearch):
+        self.entries = Queue(maxsize=settings.LDAP_PAGE_SIZE)
+        self.closed = Event()
+        self.seconds = 0.0  # Time spent on the search, without waiting for the diff
+        self.future = executor.submit(self._search, connection, search)
+
+    def _search(self, connection: Callable[[], ContextManager[Connection]], search: LDAPSearch):
+        start = perf_counter()
+        waited = 0.0
+        try:
+            with connection() as conn:
+                for entry in iter_ldap_entries(conn, [search]):
+                    waited += self._put(entry)
+                    if self.closed.is_set():
+                        return
+        finally:
+            self.seconds = perf_counter() - start - waited
+            self._put(_END)
+
+    def _put(self, item) -> float:
+        """Puts an item in the queue, unless the stream is closed, and returns the seconds waited."""
+        start = perf_counter()
+        while not self.closed.is_set():
+            try:
+                self.entries.put(item, timeout=0.1)
+                break
+            except Full:
+                pass
+        return perf_counter() - start
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, List[LDAPAttributeType]]]]:
+        while True:
+            entry = self.entries.get()
+            if entry is _END:
+                break
+            yield entry
+        # Raises the exception of the search, if any
+        self.future.result()
+
+    def close(self):
+        """Stops the search, when the entries are not consumed until the end."""
+        self.closed.set()
+
+
+def get_ldap_sync_operations(connection: Callable[[], ContextManager[Connection]],
+                             timer: PhaseTimer = None) -> List[LDAPOperation]:
+    """Compares all local and remote entries and returns sync operations.
+
+    The remote people and groups are searched concurrently on worker threads,
+    each with its own connection, and streamed into the diff, see
+    _RemoteStream. The local entries are loaded on the calling thread, the
+    database is only accessed from the calling thread. The scheduled sync
+    uses the remote snapshot instead, see sync.reconcile.
+
+    Args:
+        connection: Returns a context manager for a new LDAP connection, e.g.
+            sync.ldap.pooled_connection. It is called once for each thread.
+        timer: If given, the local_fetch, remote_fetch and diff phases are
+            recorded. The fetch phases overlap, remote_fetch is the time of
+            the slowest search. The diff includes the remote fetch.
+    """
+    timer = timer or PhaseTimer()
+    entities = (LDAPPerson, LDAPGroup)
+    with ThreadPoolExecutor(max_workers=len(entities)) as executor:
+        streams = {e: _RemoteStream(executor, connection, e.get_search()) for e in entities}
+        try:
+            with timer.phase('local_fetch'):
+                local = {e: e.get_entries() for e in entities}
+
+            with timer.phase('diff'):
+                # The people and groups need to be synced separately because they
+                #  are matched on their primary key, which is only unique within
+                #  people and groups, but not unique if you take those together.
+                operations = []
+                for e in entities:
+                    operations += sync(local[e], streams[e], multi_valued=e.multi_valued)
+        finally:
+            for stream in streams.values():
+                stream.close()
+    timer.record('remote_fetch', max(stream.seconds for stream in streams.values()))
     return operations
 
 
-def ldap_sync() -> List[LDAPOperation]:
-    """Do a full LDAP sync.
+def get_ldap_sync_changes_operations(conn: Connection,
+                                     person_ids: Iterable[int] = (),
+                                     group_ids: Iterable[int] = ()) -> List[LDAPOperation]:
+    """Compares only the given people and groups and returns sync operations.
+
+    Entries are matched on the link attribute, not on DN, so that renamed and
+    deleted objects are found remotely as well. The groups which have one of
+    the given people as member, either locally or remotely, are included
+    because their member lists may have changed.
+
+    Args:
+        conn: LDAP connection.
+        person_ids: Primary keys of changed people, may include deleted ones.
+        group_ids: Primary keys of changed groups, may include deleted ones.
+    """
+    person_ids = set(person_ids)
+    group_ids = set(group_ids)
+
+    # People
+    local_people = LDAPPerson.get_entries(ids=person_ids)
+    remote_people = {}
+    if person_ids:
+        search = LDAPPerson.get_search()._replace(filter=any_of(('qDBLinkID', i) for i in person_ids))
+        remote_people = get_ldap_entries(conn, [search])
+
+    # Groups
+    if person_ids:
+        memberships = User.groups.through.objects.filter(user_id__in=person_ids)
+        group_ids.update(memberships.values_list('group_id', flat=True))
+    assertions = [('qDBLinkID', i) for i in group_ids]
+    assertions += [('member', dn) for dn in local_people.keys() | remote_people.keys()]
+    remote_groups = {}
+    if assertions:
+        search = LDAPGroup.get_search()._replace(filter=any_of(assertions))
+        remote_groups = get_ldap_entries(conn, [search])
+    # Remote groups found by member need to be present locally as well, else they would be deleted
+    for attributes in remote_groups.values():
+        group_ids.update(attributes.get('qDBLinkID', []))
+    local_groups = LDAPGroup.get_entries(ids=group_ids)
+
+    operations = sync(local_people, remote_people, multi_valued=LDAPPerson.multi_valued)
+    operations += sync(local_groups, remote_groups, multi_valued=LDAPGroup.multi_valued)
+    return operations
+
+
+def update_snapshots(applied: List[LDAPOperation]):
+    """Drops the entries deleted or renamed by applied operations from the remote snapshots."""
+    for entity in (LDAPPerson, LDAPGroup):
+        RemoteSnapshot(entity.get_search()).forget(applied)
+
+
+def apply_operations(operations: List[LDAPOperation]) -> List[LDAPOperation]:
+    """Applies operations pipelined over an asynchronous connection.
+
+    Raises:
+        ApplyError: When an operation failed, after all other operations have
+            been applied.
+    """
+    if not operations:
+        return operations
+    with pipelined_connection() as conn:
+        results = apply_pipelined(conn, operations)
+    update_snapshots([r.operation for r in results if r.success])
+    if not all(r.success for r in results):
+        raise ApplyError(results)
+    return operations
+
+
+def ldap_sync_changes(person_ids: Iterable[int] = (),
+                      group_ids: Iterable[int] = (),
+                      trigger=SAVE) -> List[LDAPOperation]:
+    """Do an LDAP sync of only the given people and groups.
+
+    See get_ldap_sync_changes_operations(). The run is recorded in the sync
+    run journal.
 
     Returns:
         The sync operations that have been applied.
     """
-    with get_connection() as conn:
-        operations = get_ldap_sync_operations(conn)
-        for operation in operations:
-            operation.apply(conn)
-    return operations
+    with record_run('ldap', trigger) as run:
+        with run.phase('fetch_diff'), pooled_connection() as conn:
+            operations = get_ldap_sync_changes_operations(conn, person_ids, group_ids)
+        run.add_operations(operations)
+        with run.phase('apply'):
+            return apply_operations(operations)
@@ -0,0 +1,316 @@
+"""Reading and writing LDAP operations as LDIF change records (RFC 2849).
+
+Used to export a sync plan for offline review and to apply it later without
+computing the diff again.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+from itertools import islice
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+from ldap3 import MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE, Connection
+
+from sync.ldapapply import apply_pipelined, ApplyError, OperationResult
+from sync.ldapoperations import LDAPOperation, AddOperation, DeleteOperation, ModifyOperation, \
+    ModifyValuesOperation, ModifyAttributesOperation, ModifyDNOperation, split_dn
+
+
+class LDIFError(Exception):
+    """Raised for LDIF that can't be parsed."""
+
+
+# Attributes with values that are read as bytes instead of str
+BINARY_ATTRIBUTES = {'userpassword'}
+
+# Values that can be written without base64 encoding, see SAFE-STRING in RFC 2849
+_SAFE_STRING = re.compile(r'^[\x01-\x09\x0b-\x0c\x0e-\x1f\x21-\x39\x3b\x3d-\x7f][\x01-\x09\x0b-\x0c\x0e-\x7f]*$')
+
+_CHANGE_TYPES = {MODIFY_ADD: 'add', MODIFY_DELETE: 'delete', MODIFY_REPLACE: 'replace'}
+
+# Maximum line length, longer lines are folded
+_LINE_LENGTH = 76
+
+
+def _fold(line: str) -> List[str]:
+    lines = [line[:_LINE_LENGTH]]
+    for i in range(_LINE_LENGTH, len(line), _LINE_LENGTH - 1):
+        lines.append(' ' + line[i:i + _LINE_LENGTH - 1])
+    return lines
+
+
+def _attr_value(attribute: str, value) -> List[str]:
+    if isinstance(value, bytes):
+        return _fold('{}:: {}'.format(attribute, base64.b64encode(value).decode()))
+    value = str(value)
+    if value and not _SAFE_STRING.match(value) or value.endswith(' '):
+        return _fold('{}:: {}'.format(attribute, base64.b64encode(value.encode()).decode()))
+    return _fold('{}: {}'.format(attribute, value))
+
+
+def _modify_lines(changes: dict) -> List[str]:
+    lines = ['changetype: modify']
+    for attribute, attribute_changes in changes.items():
+        for change_type, values in attribute_changes:
+            lines.append('{}: {}'.format(_CHANGE_TYPES[change_type], attribute))
+            for value in values:
+                lines.extend(_attr_value(attribute, value))
+            lines.append('-')
+    return lines
+
+
+def _change_lines(operation: LDAPOperation) -> List[str]:
+    if isinstance(operation, AddOperation):
+        lines = ['changetype: add']
+        for attribute, values in operation.attributes.items():
+            for value in values:
+                lines.extend(_attr_value(attribute, value))
+        return lines
+    if isinstance(operation, DeleteOperation):
+        return ['changetype: delete']
+    if isinstance(operation, ModifyDNOperation):
+        lines = ['changetype: modrdn'] + _attr_value('newrdn', operation.rdn) + ['deleteoldrdn: 1']
+        if operation.superior:
+            lines.extend(_attr_value('newsuperior', operation.superior))
+        return lines
+    if operation.get_changes() is None:
+        raise ValueError('Operation {} has no LDIF representation'.format(operation))
+    return _modify_lines(operation.get_changes())
+
+
+def to_ldif(operation: LDAPOperation) -> List[str]:
+    """Returns the lines of the LDIF change record for an operation."""
+    return _attr_value('dn', operation.dn) + _change_lines(operation)
+
+
+def write_ldif(operations: Iterable[LDAPOperation], file: TextIO):
+    """Writes operations as LDIF change records."""
+    file.write('version: 1\n')
+    for operation in operations:
+        file.write('\n')
+        file.write('\n'.join(to_ldif(operation)) + '\n')
+
+
+def _parse_line(line: str) -> Tuple[str, object]:
+    if line == '-':
+        # Separator between the changes of a modify record
+        return '-', None
+    attribute, sep, value = line.partition(':')
+    if not sep:
+        raise LDIFError('Expected attribute and value: {}'.format(line))
+    if value.startswith(':'):
+        decoded = base64.b64decode(value[1:].strip())
+        if attribute.lower() in BINARY_ATTRIBUTES:
+            return attribute, decoded
+        try:
+            return attribute, decoded.decode()
+        except UnicodeDecodeError:
+            return attribute, decoded
+    if value.startswith('<'):
+        raise LDIFError('URL values are not supported: {}'.format(line))
+    return attribute, value.lstrip(' ')
+
+
+def _unfolded(file: TextIO) -> Iterator[str]:
+    """Yields the lines with folded lines joined and comments left out."""
+    line = None
+    for raw in file:
+        raw = raw.rstrip('\r\n')
+        if raw.startswith(' ') and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = None if raw.startswith('#') else raw
+    if line is not None:
+        yield line
+
+
+def _records(file: TextIO) -> Iterator[List[Tuple[str, object]]]:
+    """Reads the records as lists of (attribute, value) pairs."""
+    record = []
+    for line in _unfolded(file):
+        if line:
+            record.append(_parse_line(line))
+        elif record:
+            yield record
+            record = []
+    if record:
+        yield record
+
+
+def _modify_operation(dn: str, pairs: List[Tuple[str, object]]) -> LDAPOperation:
+    changes = {}
+    change_types = {v: k for k, v in _CHANGE_TYPES.items()}
+    i = 0
+    while i < len(pairs):
+        change, attribute = pairs[i]
+        if change not in change_types:
+            raise LDIFError('Unknown modify change type: {}'.format(change))
+        values = []
+        i += 1
+        while i < len(pairs) and pairs[i][0] != '-':
+            values.append(pairs[i][1])
+            i += 1
+        i += 1  # Skip the '-' separator
+        changes.setdefault(attribute, []).append((change_types[change], values))
+
+    # Use the simplest operation that has the same changes
+    if len(changes) == 1:
+        attribute, attribute_changes = next(iter(changes.items()))
+        types = [t for t, _ in attribute_changes]
+        if types == [MODIFY_REPLACE]:
+            return ModifyOperation(dn, attribute, attribute_changes[0][1])
+        if types in ([MODIFY_DELETE, MODIFY_ADD], [MODIFY_DELETE], [MODIFY_ADD]):
+            values = dict(attribute_changes)
+            return ModifyValuesOperation(dn, attribute, values.get(MODIFY_ADD, []), values.get(MODIFY_DELETE, []))
+    return ModifyAttributesOperation(dn, changes)
+
+
+def _parse_record(pairs: List[Tuple[str, object]]) -> LDAPOperation:
+    if len(pairs) < 2 or pairs[0][0].lower() != 'dn' or pairs[1][0].lower() != 'changetype':
+        raise LDIFError('Expected a change record starting with dn and changetype: {}'.format(pairs[:2]))
+    dn, change_type, rest = pairs[0][1], pairs[1][1].lower(), pairs[2:]
+    if change_type == 'add':
+        attributes = {}
+        for attribute, value in rest:
+            attributes.setdefault(attribute, []).append(value)
+        return AddOperation(dn, attributes)
+    if change_type == 'delete':
+        return DeleteOperation(dn)
+    if change_type in ('modrdn', 'moddn'):
+        values = dict((k.lower(), v) for k, v in rest)
+        superior = values.get('newsuperior') or split_dn(dn)[1]
+        return ModifyDNOperation(dn, '{},{}'.format(values['newrdn'], superior))
+    if change_type == 'modify':
+        return _modify_operation(dn, rest)
+    raise LDIFError('Unknown changetype: {}'.format(change_type))
+
+
+def read_ldif(file: TextIO) -> Iterator[LDAPOperation]:
+    """Reads LDIF change records as operations, one record at a time.
+
+    Raises:
+        LDIFError: When the file is not valid LDIF or contains content records.
+    """
+    for pairs in _records(file):
+        if pairs[0][0].lower() == 'version':
+            pairs = pairs[1:]
+            if not pairs:
+                continue
+        yield _parse_record(pairs)
+
+
+class Checkpoint:
+    """Progress of applying an LDIF plan, stored as JSON file.
+
+    Attributes:
+        applied: Number of records at the start of the plan that are done.
+        done: Indices of later records that are done, these are records that
+            were applied in the same batch as a failed record.
+    """
+
+    def __init__(self, path: str, digest: str):
+        self.path = path
+        self.digest = digest
+        self.applied = 0
+        self.done = set()
+
+    @classmethod
+    def load(cls, path: str, digest: str) -> 'Checkpoint':
+        """Loads the checkpoint if it exists, else returns a new one.
+
+        Raises:
+            LDIFError: When the checkpoint belongs to a different plan.
+        """
+        checkpoint = cls(path, digest)
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data['digest'] != digest:
+                raise LDIFError('Checkpoint {} belongs to a different plan'.format(path))
+            checkpoint.applied = data['applied']
+            checkpoint.done = set(data['done'])
+        return checkpoint
+
+    def is_done(self, index: int) -> bool:
+        return index < self.applied or index in self.done
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'digest': self.digest, 'applied': self.applied, 'done': sorted(self.done)}, f)
+
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _batches(path: str, checkpoint: Checkpoint, batch_size: int) -> Iterator[List[Tuple[int, LDAPOperation]]]:
+    """Yields batches of (index, operation) of the records that are not done yet."""
+    with open(path) as f:
+        todo = ((i, o) for i, o in enumerate(read_ldif(f)) if not checkpoint.is_done(i))
+        while True:
+            batch = list(islice(todo, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def apply_ldif(conn: Connection, path: str, checkpoint_path: str = None, batch_size: int = 500,
+               on_applied=None, skip_failed=False) -> List[OperationResult]:
+    """Applies an LDIF plan in batches, resuming from a checkpoint.
+
+    The file is read one batch at a time and each batch is applied pipelined,
+    see apply_pipelined(). The checkpoint is saved after each batch. When a
+    batch has failed operations, the next call continues with the first
+    failed record, unless failed records are skipped. The checkpoint is
+    removed when all records are applied or skipped.
+
+    Args:
+        conn: LDAP connection.
+        path: Path of the LDIF file.
+        checkpoint_path: Path of the checkpoint, defaults to the LDIF path
+            with '.checkpoint' appended.
+        batch_size: Number of records that are read and applied at a time.
+        on_applied: Called with the successful operations after each batch.
+        skip_failed: If True, failed records are marked as done and the
+            following batches are applied, e.g. to get past records that
+            failed before and have been looked into.
+
+    Returns:
+        The results of the records that were applied in this call, including
+        the failed records that were skipped.
+
+    Raises:
+        ApplyError: When a record failed and failed records are not skipped,
+            after the rest of its batch has been applied.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = path + '.checkpoint'
+    checkpoint = Checkpoint.load(checkpoint_path, file_digest(path))
+    results = []
+    for batch in _batches(path, checkpoint, batch_size):
+        batch_results = apply_pipelined(conn, [o for _, o in batch])
+        results.extend(batch_results)
+        if on_applied:
+            on_applied([r.operation for r in batch_results if r.success])
+        failed = [i for (i, _), r in zip(batch, batch_results) if not r.success and not skip_failed]
+        if failed:
+            checkpoint.done.update(i for (i, _), r in zip(batch, batch_results) if r.success)
+            checkpoint.applied = failed[0]
+        else:
+            checkpoint.applied = batch[-1][0] + 1
+        checkpoint.done = {i for i in checkpoint.done if i >= checkpoint.applied}
+        checkpoint.save()
+        if failed:
+            raise ApplyError(results)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return results
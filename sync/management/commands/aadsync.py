@@ -1,25 +1,31 @@
 from django.core.management import BaseCommand
 from requests import HTTPError
 
+from sync.aad.delta import DeltaSnapshot
 from sync.aad.graph import Graph
 from sync.aad.operations import DeleteUserOperation, DeleteGroupOperation
 from sync.aad.sync import aad_sync_objects, aad_sync_members
 
 
 def handle_operations(operations, graph, out):
-    """Prints operations to out, asks for confirmation and applies."""
+    """Prints operations to out, asks for confirmation and applies.
+
+    Returns:
+        The operations that have been applied.
+    """
     if not operations:
         out.write('No operations to apply')
-        return
+        return []
     for o in operations:
         out.write(str(o))
     y = input('Apply operations? [y/N] ')
     if y != 'y':
         out.write('Applying operations skipped')
-    else:
-        out.write('Applying operations...')
-        for o in operations:
-            o.apply(graph)
+        return []
+    out.write('Applying operations...')
+    for o in operations:
+        o.apply(graph)
+    return operations
 
 
 class Command(BaseCommand):
@@ -44,7 +50,9 @@ class Command(BaseCommand):
             self.stdout.write('Create and update operations:')
             handle_operations(non_delete_ops, graph, self.stdout)
             self.stdout.write('Delete operations:')
-            handle_operations(delete_ops, graph, self.stdout)
+            deleted = handle_operations(delete_ops, graph, self.stdout)
+            for collection in ('users', 'groups'):
+                DeltaSnapshot(graph, collection).forget(deleted)
 
             self.stdout.write("Comparing group memberships...")
             operations = aad_sync_members(graph)
@@ -0,0 +1,95 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from time import perf_counter
+
+from django.core.management import BaseCommand
+from django.db import transaction, connection
+from django.test.utils import override_settings
+from ldap3 import Connection
+
+from sync.benchmark import SyntheticDirectory, get_mock_connection, mock_connection
+from sync.ldapapply import apply_pipelined
+from sync.ldapsync import get_ldap_sync_operations, update_snapshots
+from sync.timing import PhaseTimer
+
+
+class UsageCounter:
+    """Counts the LDAP round trips and database queries of steps.
+
+    The round trips are counted over the given connection and all connections
+    opened with connect().
+    """
+
+    def __init__(self, conn: Connection):
+        self.connections = [conn]
+        self.round_trips = {}
+        self.queries = {}
+
+    def connect(self) -> Connection:
+        """Opens a new connection to the same mock server, e.g. for a worker thread."""
+        conn = mock_connection(self.connections[0].server, collect_usage=True)
+        self.connections.append(conn)
+        return conn
+
+    def _operations(self) -> int:
+        return sum(c.usage.operations for c in self.connections)
+
+    @contextmanager
+    def count(self, name: str):
+        operations = self._operations()
+        self.queries[name] = 0
+
+        # Counts without keeping the queries, unlike CaptureQueriesContext which is limited to 9000 queries
+        def wrapper(execute, sql, params, many, context):
+            self.queries[name] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            yield
+        self.round_trips[name] = self._operations() - operations
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the LDAP sync against an in-process mock server. '
+            'The synthetic data is created in a transaction that is rolled back.')
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument('--people', type=int, default=1000,
+                            help='Number of people, there is a group for each 10 people.')
+        parser.add_argument('--churn', type=float, default=0.05,
+                            help='Fraction of the remote entries that is changed, deleted and added.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    # Signals would queue a sync for each created object
+    @override_settings(LDAP_SYNC_ON_SAVE=False, GRAPH_SYNC_ON_SAVE=False)
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.stdout.write('Creating synthetic data...')
+            local = SyntheticDirectory.generate(options['people'], seed=options['seed']).create_objects()
+            remote = local.drift(options['churn'], seed=options['seed'] + 1)
+            entries = {**remote.ldap_people(), **remote.ldap_groups()}
+            conn = get_mock_connection(entries, collect_usage=True)
+
+            self.stdout.write('Running sync...')
+            timer = PhaseTimer()
+            usage = UsageCounter(conn)
+            start = perf_counter()
+            with usage.count('compare'):
+                operations = get_ldap_sync_operations(usage.connect, timer=timer)
+            with usage.count('apply'), timer.phase('apply'):
+                results = apply_pipelined(conn, operations)
+                update_snapshots([r.operation for r in results if r.success])
+            total = perf_counter() - start
+            transaction.set_rollback(True)
+
+        # The local and remote fetch overlap, so the phases don't add up to the total
+        for name, seconds in timer.durations.items():
+            self.stdout.write('{:<14} {:>10.4f} s'.format(name, seconds))
+        for name in usage.round_trips:
+            self.stdout.write('{:<14} {:>6} round trips {:>6} queries'.format(
+                name, usage.round_trips[name], usage.queries[name]))
+        local_count = len(local.people) + len(local.groups)
+        self.stdout.write('Entries: {} local, {} remote'.format(local_count, len(entries)))
+        self.stdout.write('Operations: {} applied, {} failed'.format(
+            sum(r.success for r in results), sum(not r.success for r in results)))
+        self.stdout.write('Total: {:.4f} s, {:.0f} entries/s'.format(total, (local_count + len(entries)) / total))
@@ -1,11 +1,15 @@
 import logging
 from argparse import ArgumentParser
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from ldap3.utils.log import set_library_log_detail_level, BASIC
 
 from sync.ldap import get_connection
-from sync.ldapsync import get_ldap_sync_operations
+from sync.ldapapply import ApplyError, pipelined_connection
+from sync.ldapentities import LDAPPerson, LDAPGroup
+from sync.ldapsync import get_ldap_sync_operations, update_snapshots
+from sync.ldif import write_ldif, apply_ldif, LDIFError
+from sync.reconcile import get_reconcile_operations
 
 
 class Command(BaseCommand):
@@ -15,6 +19,33 @@ class Command(BaseCommand):
         parser.add_argument('--debug',
                             action='store_true',
                             help='Enable ldap3 debug output.')
+        parser.add_argument('--reconcile',
+                            action='store_true',
+                            help='Only read and compare the qDBLinkID ranges of which the digests differ, '
+                                 'using the remote snapshot.')
+        parser.add_argument('--export',
+                            metavar='FILE',
+                            help='Write the operations to an LDIF file instead of applying them.')
+        parser.add_argument('--apply-ldif',
+                            metavar='FILE',
+                            help='Apply the operations of an exported LDIF file instead of comparing. '
+                                 'When it fails, running it again continues where it stopped.')
+        parser.add_argument('--checkpoint',
+                            metavar='FILE',
+                            help='Progress file for --apply-ldif, defaults to the LDIF file name '
+                                 'with .checkpoint appended.')
+        parser.add_argument('--skip-failed',
+                            action='store_true',
+                            help='With --apply-ldif, continue past records that fail instead of stopping. '
+                                 'The failed records are listed and not applied again.')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=500,
+                            help='Number of LDIF records that are applied at a time.')
+        parser.add_argument('--noinput', '--no-input',
+                            action='store_false',
+                            dest='interactive',
+                            help='Do not ask for confirmation.')
 
     def handle(self, *args, **options):
         # Setup debug output
@@ -22,25 +53,66 @@ class Command(BaseCommand):
             logging.basicConfig(level=logging.DEBUG)
             set_library_log_detail_level(BASIC)
 
+        if options['apply_ldif']:
+            self.apply_ldif(options)
+            return
+
         # Do sync in interactive style
+        self.stdout.write('Comparing local and remote entries...')
+        if options['reconcile']:
+            with get_connection() as conn:
+                operations = [o for e in (LDAPPerson, LDAPGroup) for o in get_reconcile_operations(conn, e)]
+        else:
+            operations = get_ldap_sync_operations(get_connection)
+        if not operations:
+            self.stdout.write('No differences found, exiting...')
+            return
+
+        if options['export']:
+            with open(options['export'], 'w') as f:
+                write_ldif(operations, f)
+            self.stdout.write('Wrote {} operations to {}'.format(len(operations), options['export']))
+            return
+
+        self.stdout.write('Found the following LDAP operations that need to be applied:')
+        for o in operations:
+            self.stdout.write(str(o))
+
+        # Ask for confirmation
+        if not self.confirm('Apply all operations? [y/N] ', options):
+            return
+
+        # Apply
+        self.stdout.write('Applying operations...')
         with get_connection() as conn:
-            self.stdout.write('Comparing local and remote entries...')
-            operations = get_ldap_sync_operations(conn)
-            if not operations:
-                self.stdout.write('No differences found, exiting...')
-                return
-
-            self.stdout.write('Found the following LDAP operations that need to be applied:')
-            for o in operations:
-                self.stdout.write(str(o))
-
-            # Ask for confirmation
-            y = input('Apply all operations? [y/N] ')
-            if y != 'y':
-                self.stdout.write('Cancelled')
-                return
-
-            # Apply
-            self.stdout.write('Applying operations...')
             for operation in operations:
                 operation.apply(conn)
+        update_snapshots(operations)
+
+    def confirm(self, prompt: str, options) -> bool:
+        if not options['interactive'] or input(prompt) == 'y':
+            return True
+        self.stdout.write('Cancelled')
+        return False
+
+    def apply_ldif(self, options):
+        path = options['apply_ldif']
+        if not self.confirm('Apply the operations in {}? [y/N] '.format(path), options):
+            return
+        self.stdout.write('Applying operations...')
+        try:
+            with pipelined_connection() as conn:
+                results = apply_ldif(conn, path,
+                                     checkpoint_path=options['checkpoint'],
+                                     batch_size=options['batch_size'],
+                                     on_applied=update_snapshots,
+                                     skip_failed=options['skip_failed'])
+        except LDIFError as e:
+            raise CommandError(e)
+        except ApplyError as e:
+            raise CommandError('{}\nRun the command again to continue from the first failed operation, '
+                               'or with --skip-failed to skip it.'.format(e))
+        skipped = [r for r in results if not r.success]
+        for r in skipped:
+            self.stderr.write('Skipped {}: {}'.format(r.operation, r.result))
+        self.stdout.write('Applied {} operations, skipped {}'.format(len(results) - len(skipped), len(skipped)))
@@ -0,0 +1,46 @@
+import json
+from argparse import ArgumentParser
+
+from django.core.management import BaseCommand, CommandError
+
+from sync.benchmark import run_benchmarks, compare
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the LDAP and AAD diff engines on synthetic directories.'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                            help='Number of people in the generated directories, e.g. 1000 10000 100000.')
+        parser.add_argument('--churn', type=float, default=0.05,
+                            help='Fraction of the remote directory that is changed, deleted and added.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of timed runs, the fastest one is reported.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save', metavar='FILE',
+                            help='Save the results as JSON baseline.')
+        parser.add_argument('--compare', metavar='FILE',
+                            help='Compare with a JSON baseline and fail on regressions.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative increase compared to the baseline.')
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(options['sizes'], options['churn'], repeat=options['repeat'], seed=options['seed'])
+        for name, result in results.items():
+            self.stdout.write('{:<28} {:>10.4f} s {:>12.1f} KiB'.format(
+                name, result['seconds'], result['peak_bytes'] / 1024))
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('Saved baseline to {}'.format(options['save']))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, options['tolerance'])
+            for name, key, increase in regressions:
+                self.stderr.write('{} {} regressed by {:.0%}'.format(name, key, increase))
+            if regressions:
+                raise CommandError('{} benchmark regression(s) found'.format(len(regressions)))
+            self.stdout.write('No regressions compared to {}'.format(options['compare']))
@@ -0,0 +1,164 @@
+"""Metrics for the sync and the task queue, see tutti.metrics.
+
+The syncs run in the Django-Q cluster, which is a different process than the
+ones serving the metrics endpoint. Therefore the metrics of each sync run,
+including the latencies of the LDAP and Graph requests it made, are added to
+the SyncMetricTotal rows when the run finishes, see add_run_totals(). The
+totals only go up, like the counters and histograms of a single process. The
+task queue metrics are read from the database as well.
+"""
+import json
+from typing import Dict, List, Tuple
+
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django_q.models import OrmQ
+
+from sync.models import SyncRun, SyncMetricTotal
+from tutti.metrics import register_collector, Histogram, Counter, Metric
+
+# Requests made by this process. These are not exposed by the process itself,
+#  the requests made during a sync run are added to the totals with the run.
+LDAP_REQUEST_SECONDS = Histogram('tutti_ldap_request_seconds', 'Latency of LDAP requests.', ['operation'])
+
+GRAPH_REQUEST_SECONDS = Histogram('tutti_graph_request_seconds', 'Latency of Microsoft Graph API requests.',
+                                  ['method', 'status'])
+
+GRAPH_RETRIES = Counter('tutti_graph_retries', 'Number of Microsoft Graph API requests and batch sub-requests '
+                                               'that were retried because they were throttled.', ['status'])
+
+REQUEST_METRICS = (LDAP_REQUEST_SECONDS, GRAPH_REQUEST_SECONDS, GRAPH_RETRIES)
+
+Series = Tuple[str, str, str]
+"""The metric name, labels as JSON and bucket bound of a SyncMetricTotal."""
+
+
+def _run_metrics() -> Dict[str, Metric]:
+    """Returns new metrics for the totals of sync runs, by name."""
+    metrics = [
+        Counter('tutti_sync_runs', 'Number of sync runs.', ['target', 'success']),
+        Histogram('tutti_sync_run_seconds', 'Duration of sync runs.', ['target']),
+        Histogram('tutti_sync_phase_seconds', 'Duration of sync run phases.', ['target', 'phase']),
+        Counter('tutti_sync_operations', 'Number of sync operations by operation type.', ['target', 'type']),
+        Counter('tutti_sync_failed_operations', 'Number of sync operations that failed.', ['target']),
+        Histogram(LDAP_REQUEST_SECONDS.name, LDAP_REQUEST_SECONDS.documentation, LDAP_REQUEST_SECONDS.labelnames),
+        Histogram(GRAPH_REQUEST_SECONDS.name, GRAPH_REQUEST_SECONDS.documentation, GRAPH_REQUEST_SECONDS.labelnames),
+        Counter(GRAPH_RETRIES.name, GRAPH_RETRIES.documentation, GRAPH_RETRIES.labelnames),
+    ]
+    return {m.name: m for m in metrics}
+
+
+def get_request_values() -> Dict[str, Dict]:
+    """Returns the current values of the request metrics of this process, see get_run_totals()."""
+    return {m.name: m.get_values() for m in REQUEST_METRICS}
+
+
+def _get_increments(metric: Metric, before: Dict) -> Dict[Series, float]:
+    """Returns the values that a metric gained since it had the values before, by series."""
+    increments = {}
+    for key, value in metric.get_values().items():
+        labels = json.dumps(dict(zip(metric.labelnames, key)), sort_keys=True)
+        if isinstance(metric, Histogram):
+            counts, total = value
+            before_counts, before_total = before.get(key, ([0] * len(counts), 0.0))
+            increments.update(((metric.name, labels, str(bound)), c - b)
+                              for bound, c, b in zip(metric.buckets, counts, before_counts) if c > b)
+            value, previous = total, before_total
+        else:
+            previous = before.get(key, 0)
+        if value != previous:
+            increments[metric.name, labels, ''] = value - previous
+    return increments
+
+
+def get_run_totals(run: SyncRun, request_values: Dict[str, Dict]) -> Dict[Series, float]:
+    """Returns the values that a finished sync run adds to the totals.
+
+    Args:
+        run: The run.
+        request_values: The result of get_request_values() when the run
+            started. The requests made by the process since then are
+            attributed to the run, a Django-Q worker runs one task at a time.
+    """
+    metrics = _run_metrics()
+    metrics['tutti_sync_runs'].inc(target=run.target, success=str(run.success).lower())
+    metrics['tutti_sync_run_seconds'].observe(run.duration, target=run.target)
+    for phase, seconds in run.phases.items():
+        metrics['tutti_sync_phase_seconds'].observe(seconds, target=run.target, phase=phase)
+    for operation_type, count in run.operation_counts.items():
+        metrics['tutti_sync_operations'].inc(count, target=run.target, type=operation_type)
+    if run.failures:
+        metrics['tutti_sync_failed_operations'].inc(len(run.failures), target=run.target)
+
+    increments = {}
+    for metric in metrics.values():
+        increments.update(_get_increments(metric, {}))
+    for metric in REQUEST_METRICS:
+        increments.update(_get_increments(metric, request_values.get(metric.name, {})))
+    return increments
+
+
+def add_totals(increments: Dict[Series, float], attempts=3):
+    """Adds values to the SyncMetricTotal rows.
+
+    The existing rows are locked. When a concurrent run inserted one of the
+    new rows first, it is tried again.
+    """
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                rows = SyncMetricTotal.objects.select_for_update().filter(metric__in={m for m, _, _ in increments})
+                existing = {(r.metric, r.labels, r.le): r for r in rows}
+                for series, row in existing.items():
+                    row.value += increments.get(series, 0)
+                SyncMetricTotal.objects.bulk_update([r for s, r in existing.items() if s in increments], ['value'])
+                SyncMetricTotal.objects.bulk_create([
+                    SyncMetricTotal(metric=metric, labels=labels, le=le, value=value)
+                    for (metric, labels, le), value in increments.items() if (metric, labels, le) not in existing
+                ])
+                return
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+def _load_totals(metrics: Dict[str, Metric], rows: List[Tuple[str, str, str, float]]):
+    """Adds total rows of (metric, labels, le, value) to the metrics."""
+    histograms = {}  # (Metric, labels) -> ({bound: count}, sum)
+    for name, labels, le, value in rows:
+        metric = metrics.get(name)
+        if isinstance(metric, Histogram):
+            counts, total = histograms.setdefault((name, labels), ({}, [0.0]))
+            if le:
+                counts[float(le)] = value
+            else:
+                total[0] = value
+        elif metric:
+            metric.inc(value, **json.loads(labels))
+    for (name, labels), (counts, total) in histograms.items():
+        metrics[name].add(counts, total[0], **json.loads(labels))
+
+
+@register_collector
+def collect_sync_runs():
+    """Sync run metrics, totals over all runs."""
+    metrics = _run_metrics()
+    _load_totals(metrics, list(SyncMetricTotal.objects.values_list('metric', 'labels', 'le', 'value')))
+    for metric in metrics.values():
+        yield metric.name, metric.type, metric.documentation, metric.samples()
+
+
+@register_collector
+def collect_task_queue():
+    """Depth of the Django-Q task queue and the age of the oldest queued task."""
+    depth = OrmQ.objects.count()
+    age = 0.0
+    oldest = OrmQ.objects.order_by('id').first()
+    if oldest:
+        try:
+            age = (timezone.now() - oldest.task()['started']).total_seconds()
+        except Exception:  # The payload can't be decoded, e.g. after a secret key change
+            age = float('nan')
+    yield 'tutti_task_queue_depth', 'gauge', 'Number of queued tasks.', [('tutti_task_queue_depth', {}, depth)]
+    yield ('tutti_task_queue_oldest_age_seconds', 'gauge', 'Seconds since the oldest queued task was queued.',
+           [('tutti_task_queue_oldest_age_seconds', {}, age)])
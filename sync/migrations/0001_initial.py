@@ -0,0 +1,26 @@
+# Generated by Django 4.2.27 on 2026-10-18 04:39
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.CharField(max_length=30, unique=True)),
+                ('person_ids', models.JSONField(default=list)),
+                ('group_ids', models.JSONField(default=list)),
+                ('triggers', models.PositiveIntegerField(default=0, help_text='Number of triggers merged into this sync.')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.27 on 2026-10-18 04:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LDAPSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_dn', models.CharField(max_length=255, unique=True)),
+                ('data', models.BinaryField(default=bytes, help_text='Pickled dictionary of entries.')),
+                ('high_water_mark', models.CharField(blank=True, help_text='Newest modifyTimestamp seen, in generalized time format.', max_length=30)),
+                ('full_read', models.DateTimeField(blank=True, help_text='When all entries were last read.', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.27 on 2026-10-18 04:53
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0002_ldapsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, verbose_name='run ID')),
+                ('target', models.CharField(choices=[('ldap', 'LDAP'), ('aad', 'Azure AD')], max_length=30)),
+                ('trigger', models.CharField(choices=[('schedule', 'Schedule'), ('save', 'Object saved')], max_length=30)),
+                ('started', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('duration', models.FloatField(help_text='Total duration in seconds.')),
+                ('phases', models.JSONField(default=dict, help_text='Duration in seconds of each phase.')),
+                ('operation_count', models.PositiveIntegerField(default=0)),
+                ('operation_counts', models.JSONField(default=dict, help_text='Number of operations by operation type.')),
+                ('failures', models.JSONField(default=list, help_text='List of failed operations with error text.')),
+                ('success', models.BooleanField(default=True)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
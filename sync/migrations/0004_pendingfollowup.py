@@ -0,0 +1,28 @@
+# Generated by Django 4.2.27 on 2026-10-18 05:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0003_syncrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingFollowUp',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(choices=[('users', 'User'), ('groups', 'Group')], max_length=30)),
+                ('directory_id', models.CharField(max_length=64, unique=True, verbose_name='directory ID')),
+                ('tutti_id', models.IntegerField(verbose_name='Tutti ID')),
+                ('extension', models.JSONField(blank=True, help_text='Extension to add, empty when added.', null=True)),
+                ('license_sku_id', models.CharField(blank=True, help_text='License to assign, empty when assigned.', max_length=64)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.27 on 2026-10-18 05:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0004_pendingfollowup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AADSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(choices=[('users', 'Users'), ('groups', 'Groups')], max_length=30, unique=True)),
+                ('objects_data', models.JSONField(default=dict, help_text='Dictionary of objects by directory ID.')),
+                ('extensions', models.JSONField(default=dict, help_text='Extension by directory ID, null for objects without extension.')),
+                ('delta_link', models.TextField(blank=True, help_text='URL for the changes since the last read.')),
+                ('full_read', models.DateTimeField(blank=True, help_text='When all objects were last read.', null=True)),
+            ],
+        ),
+    ]
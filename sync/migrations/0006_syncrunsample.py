@@ -0,0 +1,25 @@
+# Generated by Django 4.2.27 on 2026-10-18 05:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0005_aadsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRunSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=100)),
+                ('labels', models.CharField(help_text='Label values as JSON object with sorted keys.', max_length=255)),
+                ('le', models.CharField(blank=True, help_text='Upper bound of a histogram bucket, empty for the sum of a histogram or the value of a counter.', max_length=30)),
+                ('value', models.FloatField(help_text='Number of observations in the bucket, the sum or the counter value.')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='samples', to='sync.syncrun')),
+            ],
+        ),
+    ]
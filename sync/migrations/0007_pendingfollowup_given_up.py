@@ -0,0 +1,23 @@
+# Generated by Django 4.2.27 on 2026-10-18 05:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0006_syncrunsample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingfollowup',
+            name='error',
+            field=models.TextField(blank=True, help_text='Error of the last attempt.'),
+        ),
+        migrations.AddField(
+            model_name='pendingfollowup',
+            name='given_up',
+            field=models.DateTimeField(blank=True, help_text='When the follow-up was given up after too many attempts. The object is not created again while the follow-up exists.', null=True),
+        ),
+    ]
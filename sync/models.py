@@ -0,0 +1,120 @@
+import uuid
+
+from django.db import models
+from django.utils import timezone
+
+
+class PendingSync(models.Model):
+    """A sync task that is waiting for its debounce window to pass.
+
+    There is at most one pending sync per target. Triggers that arrive while a
+    sync is pending are folded into it, see sync.coalesce.
+    """
+    target = models.CharField(max_length=30, unique=True)
+    person_ids = models.JSONField(default=list)
+    group_ids = models.JSONField(default=list)
+    triggers = models.PositiveIntegerField(default=0, help_text="Number of triggers merged into this sync.")
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "PendingSync(target={}, triggers={})".format(self.target, self.triggers)
+
+
+class LDAPSnapshot(models.Model):
+    """Last known state of the remote entries below a base DN, see sync.snapshot."""
+    base_dn = models.CharField(max_length=255, unique=True)
+    data = models.BinaryField(default=bytes, help_text="Pickled dictionary of entries.")
+    high_water_mark = models.CharField(max_length=30,
+                                       blank=True,
+                                       help_text="Newest modifyTimestamp seen, in generalized time format.")
+    full_read = models.DateTimeField(null=True, blank=True, help_text="When all entries were last read.")
+
+    def __str__(self):
+        return "LDAPSnapshot(base_dn={}, high_water_mark={})".format(self.base_dn, self.high_water_mark)
+
+
+class SyncRun(models.Model):
+    """Journal entry of a sync run, see sync.runs."""
+    TARGET_CHOICES = [('ldap', 'LDAP'), ('aad', 'Azure AD')]
+    TRIGGER_CHOICES = [('schedule', 'Schedule'), ('save', 'Object saved')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, verbose_name='run ID')
+    target = models.CharField(max_length=30, choices=TARGET_CHOICES)
+    trigger = models.CharField(max_length=30, choices=TRIGGER_CHOICES)
+    started = models.DateTimeField(default=timezone.now, db_index=True)
+    duration = models.FloatField(help_text="Total duration in seconds.")
+    phases = models.JSONField(default=dict, help_text="Duration in seconds of each phase.")
+    operation_count = models.PositiveIntegerField(default=0)
+    operation_counts = models.JSONField(default=dict, help_text="Number of operations by operation type.")
+    failures = models.JSONField(default=list, help_text="List of failed operations with error text.")
+    success = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['-started']
+
+    def __str__(self):
+        return "SyncRun(target={}, started={})".format(self.target, self.started)
+
+
+class SyncMetricTotal(models.Model):
+    """Total of a sync metric series over all sync runs, see sync.metrics.
+
+    The values of each run are added when it finishes, so the totals only go
+    up, also when old runs are deleted.
+    """
+    metric = models.CharField(max_length=100)
+    labels = models.CharField(max_length=255, help_text="Label values as JSON object with sorted keys.")
+    le = models.CharField(max_length=30,
+                          blank=True,
+                          help_text="Upper bound of a histogram bucket, empty for the sum of a histogram or the value "
+                                    "of a counter.")
+    value = models.FloatField(help_text="Number of observations in the bucket, the sum or the counter value.")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'labels', 'le'], name='unique_sync_metric_series'),
+        ]
+
+    def __str__(self):
+        return "SyncMetricTotal(metric={}, labels={}, le={})".format(self.metric, self.labels, self.le)
+
+
+class PendingFollowUp(models.Model):
+    """Steps that still need to be done for a newly created AAD object, see sync.aad.followup.
+
+    A new object can't be changed until it is readable, which may take a
+    while. The extension and license are therefore added later.
+    """
+    COLLECTION_CHOICES = [('users', 'User'), ('groups', 'Group')]
+
+    collection = models.CharField(max_length=30, choices=COLLECTION_CHOICES)
+    directory_id = models.CharField(max_length=64, unique=True, verbose_name='directory ID')
+    tutti_id = models.IntegerField(verbose_name='Tutti ID')
+    extension = models.JSONField(null=True, blank=True, help_text="Extension to add, empty when added.")
+    license_sku_id = models.CharField(max_length=64, blank=True, help_text="License to assign, empty when assigned.")
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    created = models.DateTimeField(default=timezone.now)
+    given_up = models.DateTimeField(null=True,
+                                    blank=True,
+                                    help_text="When the follow-up was given up after too many attempts. The object "
+                                              "is not created again while the follow-up exists.")
+    error = models.TextField(blank=True, help_text="Error of the last attempt.")
+
+    def __str__(self):
+        return "PendingFollowUp(collection={}, directory_id={})".format(self.collection, self.directory_id)
+
+
+class AADSnapshot(models.Model):
+    """Last known state of the remote AAD users or groups, see sync.aad.delta."""
+    COLLECTION_CHOICES = [('users', 'Users'), ('groups', 'Groups')]
+
+    collection = models.CharField(max_length=30, choices=COLLECTION_CHOICES, unique=True)
+    objects_data = models.JSONField(default=dict, help_text="Dictionary of objects by directory ID.")
+    extensions = models.JSONField(default=dict,
+                                  help_text="Extension by directory ID, null for objects without extension.")
+    delta_link = models.TextField(blank=True, help_text="URL for the changes since the last read.")
+    full_read = models.DateTimeField(null=True, blank=True, help_text="When all objects were last read.")
+
+    def __str__(self):
+        return "AADSnapshot(collection={}, full_read={})".format(self.collection, self.full_read)
@@ -0,0 +1,167 @@
+"""Anti-entropy check between the local entries and LDAP using bucket digests.
+
+Instead of reading all remote entries to catch changes that the on save syncs
+missed, the entries are divided in buckets by qDBLinkID range. For each
+bucket a digest is computed over the canonical local entries and over the
+entries in the remote snapshot (see sync.snapshot). The snapshot itself is
+checked against LDAP with a search that only returns the DN and qDBLinkID of
+each entry. Only buckets with a differing digest are read in full and
+compared.
+
+For a directory that is in sync, this costs a search for the entries changed
+since the last refresh and the small DN search, for each of people and
+groups.
+"""
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+from django.conf import settings
+from ldap3 import Connection
+
+from sync.canonical import CanonicalEntry
+from sync.ldap import LDAPAttributeType, any_of, iter_ldap_entries, pooled_connection
+from sync.ldapentities import LDAPEntity, LDAPPerson, LDAPGroup
+from sync.ldapoperations import LDAPOperation
+from sync.ldapsync import apply_operations
+from sync.runs import record_run, SCHEDULE
+from sync.snapshot import RemoteSnapshot
+from sync.sync import sync
+from sync.timing import PhaseTimer
+
+logger = logging.getLogger(__name__)
+
+LINK_ATTRIBUTE = 'qDBLinkID'
+
+Entries = Dict[str, Dict[str, List[LDAPAttributeType]]]
+
+
+def get_link_id(attributes: Dict[str, List[LDAPAttributeType]]) -> Optional[int]:
+    """Returns the qDBLinkID of an entry, or None if it is missing or invalid."""
+    values = attributes.get(LINK_ATTRIBUTE, [])
+    try:
+        return int(values[0]) if len(values) == 1 else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_bucket(attributes: Dict[str, List[LDAPAttributeType]], bucket_size: int) -> Optional[int]:
+    """Returns the bucket of an entry, None for entries without a valid qDBLinkID."""
+    link_id = get_link_id(attributes)
+    return None if link_id is None else link_id // bucket_size
+
+
+def split_buckets(entries: Entries, bucket_size: int) -> Dict[Optional[int], Entries]:
+    """Divides entries in buckets by qDBLinkID range."""
+    buckets = {}
+    for dn, attributes in entries.items():
+        buckets.setdefault(get_bucket(attributes, bucket_size), {})[dn] = attributes
+    return buckets
+
+
+def content_digest(entries: Entries) -> bytes:
+    """Digest of the DNs and canonical attributes of the entries, independent of order."""
+    digests = sorted(dn.lower().encode() + CanonicalEntry(dn, attributes).get_digest()
+                     for dn, attributes in entries.items())
+    return hashlib.blake2b(b'\0'.join(digests), digest_size=16).digest()
+
+
+def index_digest(entries: Iterable[Tuple[str, Dict[str, List[LDAPAttributeType]]]]) -> bytes:
+    """Digest of the DNs and qDBLinkIDs of the entries, independent of order."""
+    keys = sorted('{}\0{}'.format(dn.lower(), get_link_id(attributes)) for dn, attributes in entries)
+    return hashlib.blake2b('\n'.join(keys).encode(), digest_size=16).digest()
+
+
+def differing_buckets(a: Dict[Optional[int], bytes], b: Dict[Optional[int], bytes]) -> set:
+    """Returns the buckets of which the digests differ or that are missing on one side."""
+    return {k for k in a.keys() | b.keys() if a.get(k) != b.get(k)}
+
+
+def _read_index(conn: Connection, entity: Type[LDAPEntity]) -> Entries:
+    """Reads only the DN and qDBLinkID of all remote entries."""
+    search = entity.get_search()._replace(attributes=[LINK_ATTRIBUTE])
+    return dict(iter_ldap_entries(conn, [search]))
+
+
+def _read_bucket(conn: Connection, snapshot: RemoteSnapshot, index: Entries, local: Entries) -> List:
+    """Reads the remote entries of a bucket with the qDBLinkIDs found locally or remotely."""
+    ids = {get_link_id(a) for a in index.values()} | {get_link_id(a) for a in local.values()}
+    if not ids:
+        return []
+    return snapshot.read_filtered(conn, any_of((LINK_ATTRIBUTE, i) for i in sorted(ids)))
+
+
+def get_reconcile_operations(conn: Connection,
+                             entity: Type[LDAPEntity],
+                             bucket_size: int = None,
+                             timer: PhaseTimer = None) -> List[LDAPOperation]:
+    """Compares local and remote entries of an entity bucket by bucket and returns sync operations.
+
+    The remote snapshot is updated with the buckets that are read again.
+
+    Args:
+        conn: LDAP connection.
+        entity: LDAPPerson or LDAPGroup.
+        bucket_size: Number of qDBLinkIDs per bucket, defaults to the
+            LDAP_RECONCILE_BUCKET_SIZE setting.
+        timer: If given, the phases are recorded.
+    """
+    if bucket_size is None:
+        bucket_size = settings.LDAP_RECONCILE_BUCKET_SIZE
+    timer = timer or PhaseTimer()
+    snapshot = RemoteSnapshot(entity.get_search())
+
+    with timer.phase('remote_fetch'):
+        # Patches the entries changed since the last refresh into the snapshot, or reads all when a full read is due
+        snapshot.refresh(conn)
+        index = split_buckets(_read_index(conn, entity), bucket_size)
+    with timer.phase('local_fetch'):
+        local = split_buckets(entity.get_entries(), bucket_size)
+
+    with timer.phase('digest'):
+        remote = split_buckets(snapshot.entries, bucket_size)
+        # Buckets where the snapshot is not the same as LDAP, e.g. because of deleted entries
+        stale = differing_buckets({k: index_digest(v.items()) for k, v in index.items()},
+                                  {k: index_digest(v.items()) for k, v in remote.items()})
+        # Buckets where the local entries are not the same as the snapshot
+        changed = differing_buckets({k: content_digest(v) for k, v in local.items()},
+                                    {k: content_digest(v) for k, v in remote.items()})
+        # Entries without qDBLinkID are always deleted, they don't need to be read
+        stale.discard(None)
+        changed.discard(None)
+    logger.info('%s: %d of %d buckets are stale, %d have changes', entity.__name__, len(stale),
+                len(index.keys() | local.keys()), len(changed))
+
+    with timer.phase('bucket_fetch'):
+        dns, entries = set(), []
+        for bucket in sorted(stale | changed):
+            dns.update(remote.get(bucket, {}).keys() | index.get(bucket, {}).keys())
+            entries += _read_bucket(conn, snapshot, index.get(bucket, {}), local.get(bucket, {}))
+        # All other buckets have been verified
+        snapshot.replace(dns, entries)
+        remote = split_buckets(snapshot.entries, bucket_size)
+
+    with timer.phase('diff'):
+        local_entries, remote_entries = {}, dict(index.get(None, {}))
+        for bucket in changed | stale:
+            local_entries.update(local.get(bucket, {}))
+            remote_entries.update(remote.get(bucket, {}))
+        return sync(local_entries, remote_entries, multi_valued=entity.multi_valued)
+
+
+def ldap_reconcile(trigger=SCHEDULE) -> List[LDAPOperation]:
+    """Do an LDAP sync that only reads the buckets that differ, see module docstring.
+
+    The run is recorded in the sync run journal.
+
+    Returns:
+        The sync operations that have been applied.
+    """
+    with record_run('ldap', trigger) as run:
+        operations = []
+        with pooled_connection() as conn:
+            for entity in (LDAPPerson, LDAPGroup):
+                operations += get_reconcile_operations(conn, entity, timer=run)
+        run.add_operations(operations)
+        with run.phase('apply'):
+            return apply_operations(operations)
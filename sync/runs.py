@@ -0,0 +1,101 @@
+"""Journal of sync runs.
+
+Each run is written as a single SyncRun row when it finishes, including the
+phase durations, the number of operations by type and the failed operations.
+The metrics of the run are added to the metric totals, see sync.metrics.
+Runs older than SYNC_RUN_RETENTION days are deleted.
+"""
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+from time import perf_counter
+from typing import Iterable
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from sync.ldapapply import ApplyError
+from sync.metrics import get_request_values, get_run_totals, add_totals
+from sync.models import SyncRun
+from sync.timing import PhaseTimer
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE = "schedule"
+"""Trigger for the periodic sync."""
+
+SAVE = "save"
+"""Trigger for the sync after objects were saved."""
+
+
+class RunRecorder(PhaseTimer):
+    """Collects the details of a sync run.
+
+    Attributes:
+        operations: The operations of the run.
+        failures: List of dictionaries with the failed operation and error.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.operations = []
+        self.failures = []
+
+    def add_operations(self, operations: Iterable):
+        """Adds operations that are going to be applied."""
+        self.operations.extend(operations)
+
+    def add_failure(self, operation, error):
+        """Adds an operation that could not be applied."""
+        self.failures.append({'operation': str(operation), 'error': str(error)})
+
+
+def _save_run(run: RunRecorder, target: str, trigger: str, started, duration: float, request_values):
+    """Saves a finished run, adds its metrics to the totals and deletes old runs."""
+    counts = Counter(type(o).__name__ for o in run.operations)
+    with transaction.atomic():
+        sync_run = SyncRun.objects.create(target=target,
+                                          trigger=trigger,
+                                          started=started,
+                                          duration=duration,
+                                          phases=run.durations,
+                                          operation_count=len(run.operations),
+                                          operation_counts=dict(counts),
+                                          failures=run.failures,
+                                          success=not run.failures)
+        add_totals(get_run_totals(sync_run, request_values))
+        SyncRun.objects.filter(started__lt=started - timedelta(days=settings.SYNC_RUN_RETENTION)).delete()
+
+
+@contextmanager
+def record_run(target: str, trigger: str):
+    """Context manager that records a sync run, yields a RunRecorder.
+
+    The run is saved when the context exits, also when an exception is raised.
+    Failed operations of an ApplyError are recorded separately. Any other
+    exception is recorded as failure without operation, unless a failure was
+    added already. When the run can't be saved, the error is logged, it does
+    not replace the exception of the sync.
+    """
+    run = RunRecorder()
+    started = timezone.now()
+    request_values = get_request_values()
+    start = perf_counter()
+    try:
+        yield run
+    except ApplyError as e:
+        for result in e.results:
+            if not result.success:
+                run.add_failure(result.operation, result.result)
+        raise
+    except Exception as e:
+        if not run.failures:
+            run.add_failure('', '{}: {}'.format(type(e).__name__, e))
+        raise
+    finally:
+        try:
+            _save_run(run, target, trigger, started, perf_counter() - start, request_values)
+        except Exception:
+            logger.exception('Could not record %s sync run', target)
@@ -4,9 +4,10 @@ from django.core.mail import mail_admins
 from django.db.models.signals import post_save, post_delete, post_migrate
 from django.dispatch import receiver
 from django_q.models import Schedule, Task
-from django_q.tasks import schedule, async_task
+from django_q.tasks import schedule
 
 from members.models import Person, QGroup, User
+from sync.coalesce import trigger_sync, LDAP, AAD
 
 
 @receiver(post_save, sender=User)
@@ -15,12 +16,17 @@ from members.models import Person, QGroup, User
 @receiver(post_delete, sender=User)
 @receiver(post_delete, sender=Person)
 @receiver(post_delete, sender=QGroup)
-def queue_sync(sender, **kwargs):
-    """Queues a sync task to be run immediately."""
+def queue_sync(sender, instance, **kwargs):
+    """Queues a sync task to be run after a short debounce window."""
     if settings.LDAP_SYNC_ON_SAVE:
-        async_task("sync.ldapsync.ldap_sync", hook='sync.signals.error_reporting')
+        # Only the changed object needs to be synced. A Person shares its
+        #  primary key with the User it extends.
+        if sender is QGroup:
+            trigger_sync(LDAP, group_ids=[instance.pk])
+        else:
+            trigger_sync(LDAP, person_ids=[instance.pk])
     if settings.GRAPH_SYNC_ON_SAVE:
-        async_task("sync.aad.tasks.aad_sync", hook='sync.signals.error_reporting')
+        trigger_sync(AAD)
 
 
 def error_reporting(task: Task):
@@ -56,10 +62,10 @@ def setup_sync_tasks(sender, **kwargs):
     #  use a daily schedule instead of something shorter. The daily task is
     #  just to catch some missed object changes.
 
-    # Schedule for LDAP
-    migrate_schedule(func="sync.ldapsync.ldap_sync",
+    # Schedule for LDAP, only reads the parts of the directory that differ
+    migrate_schedule(func="sync.reconcile.ldap_reconcile",
                      name="ldapsync",
-                     version=2,
+                     version=3,
                      schedule_type=Schedule.DAILY)
     # Schedule for AAD
     migrate_schedule(func="sync.aad.tasks.aad_sync",
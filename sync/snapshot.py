@@ -0,0 +1,134 @@
+"""Persisted snapshot of the remote LDAP entries.
+
+Instead of reading all entries on each sync, only the entries with a
+modifyTimestamp at or after the newest timestamp seen before (the high-water
+mark) are read and patched into the snapshot. Deleted entries can't be found
+this way, so the operations applied by the sync itself are used to drop
+entries from the snapshot. A full read is done periodically to catch anything
+that was missed, e.g. entries deleted by someone else.
+"""
+import pickle
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, List, Iterable, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+from ldap3 import Connection
+
+from sync.ldap import LDAPSearch, LDAPAttributeType, iter_ldap_entries
+from sync.ldapoperations import LDAPOperation, DeleteOperation, ModifyDNOperation
+from sync.models import LDAPSnapshot
+
+MODIFY_TIMESTAMP = 'modifyTimestamp'
+
+
+def _generalized_time(value) -> str:
+    """Converts a modifyTimestamp value to generalized time, e.g. 20200101120000Z."""
+    if isinstance(value, datetime):
+        return value.astimezone(dt_timezone.utc).strftime('%Y%m%d%H%M%SZ')
+    # Strip fractional seconds, the filter needs to be valid for the server
+    return str(value)[:14] + 'Z'
+
+
+class RemoteSnapshot:
+    """Snapshot of the remote entries of an LDAP search."""
+
+    def __init__(self, search: LDAPSearch):
+        self.search = search
+        self.model, _ = LDAPSnapshot.objects.get_or_create(base_dn=search.base_dn.lower())
+        self.entries = pickle.loads(self.model.data) if self.model.data else {}
+
+    def needs_full_read(self) -> bool:
+        """Whether the snapshot is missing or older than the full read interval."""
+        if not self.model.high_water_mark or not self.model.full_read:
+            return True
+        interval = timedelta(hours=settings.LDAP_SNAPSHOT_FULL_INTERVAL)
+        return timezone.now() - self.model.full_read > interval
+
+    def refresh(self, conn: Connection, full=False) -> Dict[str, Dict[str, List[LDAPAttributeType]]]:
+        """Updates the snapshot from LDAP and saves it.
+
+        Args:
+            conn: LDAP connection.
+            full: If True all entries are read, else only the entries that
+                have changed since the last refresh, unless a full read is
+                due.
+
+        Returns:
+            The remote entries in the format of sync.ldap.get_ldap_entries().
+        """
+        full = full or self.needs_full_read()
+        changed = None if full else '({}>={})'.format(MODIFY_TIMESTAMP, self.model.high_water_mark)
+        return self.update(full, self.read_filtered(conn, changed))
+
+    def read_filtered(self, conn: Connection, search_filter: str = None) -> List[Tuple[str, Dict]]:
+        """Reads the entries that match an additional filter, for patching with update().
+
+        Without filter all entries are read.
+        """
+        search = self.search._replace(attributes=list(self.search.attributes) + [MODIFY_TIMESTAMP])
+        if search_filter and search.filter:
+            search = search._replace(filter='(&{}{})'.format(search_filter, search.filter))
+        elif search_filter:
+            search = search._replace(filter=search_filter)
+        return list(iter_ldap_entries(conn, [search]))
+
+    def update(self, full: bool, entries: List[Tuple[str, Dict]]) -> Dict[str, Dict[str, List[LDAPAttributeType]]]:
+        """Patches the entries read by read_filtered() into the snapshot and saves it.
+
+        Args:
+            full: Whether all entries were read, the other entries are
+                dropped.
+            entries: The entries read.
+
+        Returns:
+            The remote entries in the format of sync.ldap.get_ldap_entries().
+        """
+        if full:
+            self.entries = {}
+            mark = ''
+        else:
+            mark = self.model.high_water_mark
+        for dn, attributes in entries:
+            # The timestamp is not part of the synced attributes
+            for key in [k for k in attributes if k.lower() == MODIFY_TIMESTAMP.lower()]:
+                mark = max(mark, _generalized_time(attributes.pop(key)[0]))
+            self.entries[dn] = attributes
+
+        self.model.high_water_mark = mark
+        if full:
+            self.model.full_read = timezone.now()
+        self.save()
+        return self.entries
+
+    def replace(self, dns: Iterable[str], entries: List[Tuple[str, Dict]]):
+        """Replaces entries with entries that were read again and saves.
+
+        This does not count as a full read. The entries are only verified
+        with the digests of sync.reconcile, so the periodic full read is still
+        needed to catch what the digests don't cover.
+
+        Args:
+            dns: The entries that are dropped.
+            entries: The entries read by read_filtered().
+        """
+        for dn in dns:
+            self.entries.pop(dn, None)
+        self.update(False, entries)
+
+    def forget(self, operations: Iterable[LDAPOperation]):
+        """Drops the entries that have been deleted or renamed by given operations.
+
+        Added and modified entries don't need to be handled, they get a new
+        modifyTimestamp and are read again on the next refresh.
+        """
+        changed = False
+        for operation in operations:
+            if isinstance(operation, (DeleteOperation, ModifyDNOperation)):
+                changed |= self.entries.pop(operation.dn.lower(), None) is not None
+        if changed:
+            self.save()
+
+    def save(self):
+        self.model.data = pickle.dumps(self.entries)
+        self.model.save()
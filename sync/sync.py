@@ -1,16 +1,31 @@
 """Module for one-way sync between two datasets."""
-from typing import List, Dict, Tuple
+from collections.abc import Mapping
+from typing import List, Dict, Tuple, Iterable, Union
 
+from sync.canonical import CanonicalEntry, normalize_value, CanonicalValue
 from sync.ldap import LDAPAttributeType
-from sync.ldapoperations import LDAPOperation, AddOperation, DeleteOperation, ModifyDNOperation, ModifyOperation
+from sync.ldapoperations import LDAPOperation, AddOperation, DeleteOperation, ModifyDNOperation, ModifyOperation, \
+    ModifyAttributesOperation, ModifyValuesOperation
 
+LDAPEntries = Union[Dict[str, Dict[str, List[LDAPAttributeType]]],
+                    Iterable[Tuple[str, Dict[str, List[LDAPAttributeType]]]]]
+"""LDAP dataset, either a dictionary or an iterable of (DN, attributes) tuples."""
 
-def remap(entries: Dict[str, Dict[str, List[LDAPAttributeType]]],
-          on: str) -> Dict[LDAPAttributeType, Tuple[str, Dict]]:
+
+def _items(entries: LDAPEntries) -> Iterable[Tuple[str, Dict[str, List[LDAPAttributeType]]]]:
+    """Returns the (DN, attributes) tuples of an LDAP dataset."""
+    if isinstance(entries, Mapping):
+        return entries.items()
+    return entries
+
+
+def remap(entries: LDAPEntries,
+          on: str) -> Dict[CanonicalValue, Tuple[str, Dict]]:
     """Remap LDAP dataset into one which maps on the given attribute.
 
     Args:
-        entries: LDAP dataset.
+        entries: LDAP dataset, may be a stream of entries which is consumed
+            only once.
         on: Attribute that will be used as key for the new mapping.
 
     Raises:
@@ -18,30 +33,36 @@ def remap(entries: Dict[str, Dict[str, List[LDAPAttributeType]]],
         ValueError: If another issue arose with the mapping attribute value.
 
     Returns:
-        A dictionary which maps from the value of the given attribute onto a
-        2-tuple with Distinguished Name and attributes dictionary.
+        A dictionary which maps from the canonical value of the given
+        attribute onto a 2-tuple with Distinguished Name and attributes
+        dictionary.
     """
     d = {}
-    for dn, attributes in entries.items():
+    for dn, attributes in _items(entries):
         key_values = attributes[on]
         if len(key_values) != 1:
             raise ValueError('Mapping attribute does not have exactly 1 value.')
-        key = key_values[0]
+        key = normalize_value(on, key_values[0])
         if key in d:
             raise ValueError('Mapping attribute value is not unique.')
         d[key] = dn, attributes
     return d
 
 
-def sync(change_to: Dict[str, Dict[str, List[LDAPAttributeType]]],
-         to_change: Dict[str, Dict[str, List[LDAPAttributeType]]],
-         on: str = "qDBLinkID") -> List[LDAPOperation]:
+def sync(change_to: LDAPEntries,
+         to_change: LDAPEntries,
+         on: str = "qDBLinkID",
+         multi_valued: Iterable[str] = ()) -> List[LDAPOperation]:
     """Get operations to perform to change the second dataset into the first.
 
     The datasets are dictionaries of LDAP entries. The dictionary key is the
     Distinguished Name of an entry, the value is a dictionary of entry
     attributes to list of values.
 
+    Both datasets may also be given as a stream of (DN, attributes) tuples,
+    e.g. from sync.ldap.iter_ldap_entries(). Streams are consumed only once
+    and not copied.
+
     Note: empty lists in the attribute dictionary are not supported and results
     in undefined behavior!
 
@@ -53,25 +74,28 @@ def sync(change_to: Dict[str, Dict[str, List[LDAPAttributeType]]],
             however it does not need to be present for entries in the to_change
             dataset! Entries which do not have a value for this attribute will
             be removed!
+        multi_valued: Attributes for which only the added and deleted values
+            are sent, instead of replacing the full list of values.
 
     Returns:
         A list of add, delete, modify operations. Order matters for applying.
+        All attribute changes of an entry are merged into a single modify
+        operation, see merge_modifications().
     """
     ops = []
 
     # Delete entries in to_change which do not have the matching attribute.
     # Since we'll later use this attribute as a (hashed) key it will wreak havoc if present
-    delete = []
-    for dn, attributes in to_change.items():
-        if not attributes.get(on):
-            delete.append(dn)
-    for dn in delete:
-        ops.append(DeleteOperation(dn))
-        del to_change[dn]
+    def with_matching_attribute(entries):
+        for dn, attributes in _items(entries):
+            if not attributes.get(on):
+                ops.append(DeleteOperation(dn))
+            else:
+                yield dn, attributes
 
     # Remap so that the dictionaries are hashed based on the matching attribute
     change_to = remap(change_to, on=on)
-    to_change = remap(to_change, on=on)
+    to_change = remap(with_matching_attribute(to_change), on=on)
 
     # Get add/delete operations
     to_add = change_to.keys() - to_change.keys()
@@ -83,24 +107,96 @@ def sync(change_to: Dict[str, Dict[str, List[LDAPAttributeType]]],
     # Check for value/DN changes
     in_both = change_to.keys() - to_add
     for k in in_both:
-        new_dn, new_attrs = change_to[k]
-        cur_dn, cur_attrs = to_change[k]
-
-        # DN
-        # Modify DN needs to be performed before attribute modify!
-        # Otherwise the DN for the attribute modify can't be found in LDAP
-        # (it will still have the old value)
-        if new_dn.lower() != cur_dn.lower():
-            ops.append(ModifyDNOperation(cur_dn, new_dn))
-
-        # Attribute deletions
-        attr_delete = cur_attrs.keys() - new_attrs.keys()
-        for attr in attr_delete:
-            ops.append(ModifyOperation(new_dn, attr, []))
-
-        # Attribute changes and additions
-        for key, new_values in new_attrs.items():
-            cur_values = cur_attrs.get(key, [])
-            if sorted(new_values) != sorted(cur_values):  # Need to sort because the value order does not matter
-                ops.append(ModifyOperation(new_dn, key, new_values))
+        # Identical entries are skipped without normalizing
+        if change_to[k] == to_change[k]:
+            continue
+        new = CanonicalEntry(*change_to[k])
+        cur = CanonicalEntry(*to_change[k])
+        if new == cur:
+            continue
+        ops.extend(get_entry_operations(new, cur, multi_valued))
+    return merge_modifications(ops)
+
+
+def get_entry_operations(new: CanonicalEntry,
+                         cur: CanonicalEntry,
+                         multi_valued: Iterable[str]) -> List[LDAPOperation]:
+    """Returns the operations that change an entry from the current to the new state."""
+    ops = []
+    # DN
+    # Modify DN needs to be performed before attribute modify!
+    # Otherwise the DN for the attribute modify can't be found in LDAP
+    # (it will still have the old value)
+    if new.dn.lower() != cur.dn.lower():
+        ops.append(ModifyDNOperation(cur.dn, new.dn))
+
+    if new.values == cur.values:
+        return ops
+
+    # Attribute deletions
+    attr_delete = cur.values.keys() - new.values.keys()
+    for attr in attr_delete:
+        ops.append(ModifyOperation(new.dn, attr, []))
+
+    # Attribute changes and additions
+    for key, new_values in new.values.items():
+        if new_values != cur.values.get(key):
+            ops.append(get_modify_operation(new.dn, key, new.attributes[key], cur.attributes.get(key, []),
+                                            multi_valued))
     return ops
+
+
+def get_modify_operation(dn: str,
+                         attribute: str,
+                         new_values: List[LDAPAttributeType],
+                         cur_values: List[LDAPAttributeType],
+                         multi_valued: Iterable[str]) -> LDAPOperation:
+    """Returns the operation that changes an attribute from the current to the new values.
+
+    For multi-valued attributes only the difference is sent, unless the
+    attribute is created or removed. Values are compared in canonical form.
+    When the remote values turn out to differ from the current values, the
+    attribute is replaced instead, see LDAPOperation.get_fallback().
+    """
+    if attribute in multi_valued and new_values and cur_values:
+        new_set = {normalize_value(attribute, v) for v in new_values}
+        cur_set = {normalize_value(attribute, v) for v in cur_values}
+        add = [v for v in new_values if normalize_value(attribute, v) not in cur_set]
+        delete = [v for v in cur_values if normalize_value(attribute, v) not in new_set]
+        return ModifyValuesOperation(dn, attribute, add, delete, values=new_values)
+    return ModifyOperation(dn, attribute, new_values)
+
+
+def merge_modifications(operations: List[LDAPOperation]) -> List[LDAPOperation]:
+    """Merges consecutive attribute modifications of the same entry.
+
+    Each run of modify operations on the same DN is replaced by a single
+    ModifyAttributesOperation, which is applied as one atomic LDAP modify
+    request. Runs of one operation are kept as is.
+    """
+    result = []
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            result.append(run[0])
+        elif run:
+            changes = {}
+            replace = {}
+            for op in run:
+                for attr, attr_changes in op.get_changes().items():
+                    changes.setdefault(attr, []).extend(attr_changes)
+                for attr, attr_changes in (op.get_fallback() or op).get_changes().items():
+                    replace.setdefault(attr, []).extend(attr_changes)
+            result.append(ModifyAttributesOperation(run[0].dn, changes, replace=replace))
+        run.clear()
+
+    for op in operations:
+        if op.get_changes() is None or (run and run[0].dn.lower() != op.dn.lower()):
+            flush()
+        if op.get_changes() is None:
+            result.append(op)
+        else:
+            run.append(op)
+    flush()
+    return result
@@ -0,0 +1 @@
+from sync.benchmark import get_mock_connection, mock_connection  # noqa: F401
@@ -0,0 +1,116 @@
+import json
+import threading
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from sync.aad.graph import Graph
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: 'ThreadingHTTPServer'
+    # Supports keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        fake = self.server.fake  # type: FakeGraphServer
+        fake.clients.add(self.client_address)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        body = json.loads(data) if data and self.headers.get('Content-Type') == 'application/json' else None
+        if self.path.endswith('/oauth2/v2.0/token'):
+            self._reply(200, {'access_token': 'token', 'expires_in': 3600})
+        elif self.path == '/v1.0/$batch':
+            fake.batches.append(body['requests'])
+            self._reply(200, {'responses': fake.handle_batch(body['requests'])})
+        else:
+            fake.requests.append((self.command, self.path, body))
+            self._reply(*fake.next_response(self.command, urlsplit(self.path).path[len('/v1.0'):]))
+
+    def do_GET(self):  # noqa: N802
+        self._handle()
+
+    def do_POST(self):  # noqa: N802
+        self._handle()
+
+    def do_PATCH(self):  # noqa: N802
+        self._handle()
+
+    def do_DELETE(self):  # noqa: N802
+        self._handle()
+
+
+class FakeGraphServer:
+    """Local HTTP server that answers like Microsoft Graph, for tests.
+
+    Responses can be queued per method and URL with respond(), by default
+    requests succeed with 204 No Content. The query string is not part of
+    the URL that responses are queued for.
+
+    Attributes:
+        requests: The (method, path, body) of requests that were not a batch.
+        batches: The sub-requests of each batch request.
+        clients: The client addresses of the connections that were used.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.batches = []
+        self.clients = set()
+        self.responses = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'FakeGraphServer':
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def graph(self) -> Graph:
+        """Returns a Graph instance that uses this server."""
+        return Graph('tenant', 'client', 'secret', url=self.base_url + '/v1.0', login_url=self.base_url)
+
+    def respond(self, method: str, url: str, status: int, body=None, headers=None):
+        """Queues a response for a request, url is relative to the version, e.g. /users/1."""
+        with self.lock:
+            self.responses[method, url].append((status, body, headers or {}))
+
+    def next_response(self, method: str, url: str):
+        with self.lock:
+            queue = self.responses[method, url]
+            return queue.popleft() if queue else (204, None, {})
+
+    def handle_batch(self, requests):
+        statuses = {}
+        responses = []
+        for request in requests:
+            dependencies = request.get('dependsOn', [])
+            if any(not 200 <= statuses[d] < 300 for d in dependencies):
+                status, body, headers = 424, {'error': {'code': 'FailedDependency'}}, {}
+            else:
+                status, body, headers = self.next_response(request['method'], urlsplit(request['url']).path)
+            statuses[request['id']] = status
+            responses.append({'id': request['id'], 'status': status, 'headers': headers, 'body': body})
+        return responses
@@ -1,8 +1,17 @@
+import asyncio
+import threading
+from email.utils import formatdate
+from time import time, sleep
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from requests import HTTPError
 
-from sync.aad.graph import Graph, GraphUser, GraphGroup
+from sync.aad.asyncgraph import AsyncGraph
+from sync.aad.graph import Graph, GraphUser, GraphGroup, get_retry_delay, RateLimiter
+from sync.metrics import GRAPH_RETRIES
+from sync.tests.fakegraph import FakeGraphServer
 
 
 class AADTestCase(TestCase):
@@ -79,3 +88,101 @@ class AADTestCase(TestCase):
         except HTTPError as e:
             print(e.response.text)
             raise e
+
+
+class GraphClientTestCase(SimpleTestCase):
+    """Tests the HTTP handling of the Graph client against a local fake server."""
+
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.graph = self.server.graph()
+        patcher = patch('sync.aad.graph.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keep_alive(self):
+        """Requests reuse the connection."""
+        for _ in range(3):
+            self.graph.delete_user('u1')
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, len(self.server.clients))
+
+    def test_throttled(self):
+        """Throttled requests are retried after Retry-After."""
+        retries = GRAPH_RETRIES.samples()
+        self.server.respond('DELETE', '/users/u1', 429, headers={'Retry-After': '7'})
+        self.server.respond('DELETE', '/users/u1', 503)
+        self.graph.delete_user('u1')
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(7, self.sleep.call_args_list[0][0][0])
+        self.assertNotEqual(retries, GRAPH_RETRIES.samples())
+
+    def test_give_up(self):
+        """The error is raised when all retries are throttled."""
+        for _ in range(6):
+            self.server.respond('DELETE', '/users/u1', 429)
+        with self.assertRaises(HTTPError):
+            self.graph.delete_user('u1')
+        self.assertEqual(5, self.sleep.call_count)
+
+    def test_gateway_timeout(self):
+        """A timed out request is only retried when it is idempotent."""
+        self.server.respond('DELETE', '/users/u1', 504)
+        self.graph.delete_user('u1')
+        self.server.respond('POST', '/groups', 504)
+        with self.assertRaises(HTTPError):
+            self.graph.create_group(GraphGroup(None, 'Group', 'group'))
+        self.assertEqual(['DELETE', 'DELETE', 'POST'], [r[0] for r in self.server.requests])
+
+    def test_retry_token(self):
+        """The access token is taken again for a retry, it can expire while waiting."""
+        self.server.respond('DELETE', '/users/u1', 429, headers={'Retry-After': '3600'})
+
+        def expire(seconds):
+            self.graph.access_token_expiry = 0
+
+        self.sleep.side_effect = expire
+        with patch.object(self.graph, '_request_access_token', wraps=self.graph._request_access_token) as request:
+            self.graph.delete_user('u1')
+        self.assertEqual(2, request.call_count)
+
+    def test_retry_delay(self):
+        self.assertLessEqual(get_retry_delay({}, 0), 1)
+        self.assertLessEqual(get_retry_delay({}, 20), 60)
+        self.assertEqual(2, get_retry_delay({'retry-after': '2'}, 0, backoff=0))
+        date = formatdate(time() + 30, usegmt=True)
+        self.assertAlmostEqual(30, get_retry_delay({'Retry-After': date}, 0, backoff=0), delta=2)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(2)
+        for _ in range(4):
+            limiter.acquire()
+        # The burst of 2 requests goes right away, the others wait for a token
+        waits = [c[0][0] for c in self.sleep.call_args_list]
+        self.assertEqual(2, len(waits))
+        self.assertAlmostEqual(0.5, waits[0], delta=0.1)
+        self.assertAlmostEqual(1.0, waits[1], delta=0.1)
+
+    def test_async(self):
+        """Methods run concurrently, up to the concurrency limit."""
+        client = AsyncGraph(self.graph, concurrency=2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(i):
+            with lock:
+                running.append(i)
+                peak.append(len(running))
+            sleep(0.05)
+            with lock:
+                running.remove(i)
+            return i
+
+        self.assertEqual(list(range(6)), asyncio.run(client.map(work, range(6))))
+        self.assertEqual(2, max(peak))
+
+        asyncio.run(client.gather(client.delete_user('u1'), client.delete_group('g1')))
+        self.assertEqual({('DELETE', '/v1.0/users/u1', None), ('DELETE', '/v1.0/groups/g1', None)},
+                         set(self.server.requests))
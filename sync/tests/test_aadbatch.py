@@ -0,0 +1,98 @@
+from django.test import SimpleTestCase
+
+from sync.aad.batch import BatchExecutor, BatchError, get_paged_batch
+from sync.aad.graph import GraphUser, GraphGroup
+from sync.aad.operations import AddGroupMemberOperation, UpdateUserOperation, DeleteUserOperation, SyncOperation
+from sync.aad.tasks import apply
+from sync.tests.fakegraph import FakeGraphServer
+
+
+def user(i):
+    return GraphUser('User {}'.format(i), None, 'user{}'.format(i), None, None, 'user{}@example.com'.format(i), None,
+                     directory_id='u{}'.format(i))
+
+
+GROUP = GraphGroup(None, 'Group', 'group', directory_id='g')
+
+
+class GetUsers(SyncOperation):
+    """Operation that is not a single request."""
+
+    def send(self, graph):
+        graph.call_resource('users')
+
+
+class BatchExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.sleeps = []
+        self.executor = BatchExecutor(self.server.graph(), sleep=self.sleeps.append)
+
+    def test_batches(self):
+        """Operations are sent in batches of at most 20."""
+        operations = [AddGroupMemberOperation(GROUP, user(i)) for i in range(45)]
+        results = self.executor.apply(operations)
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual([20, 20, 5], [len(b) for b in self.server.batches])
+        self.assertEqual({'id': '0', 'method': 'POST', 'url': '/groups/g/members/$ref',
+                          'body': {'@odata.id': 'https://graph.microsoft.com/v1.0/users/u0'},
+                          'headers': {'Content-Type': 'application/json'}}, self.server.batches[0][0])
+
+    def test_dependencies(self):
+        """Operations on the same object depend on the earlier one."""
+        self.executor.apply([UpdateUserOperation(user(1), {'surname': 'X'}), UpdateUserOperation(user(2), {}),
+                             DeleteUserOperation(user(1))])
+        batch, = self.server.batches
+        self.assertNotIn('dependsOn', batch[1])
+        self.assertEqual(['0'], batch[2]['dependsOn'])
+
+    def test_retry(self):
+        """Throttled sub-requests and the ones depending on them are retried after Retry-After."""
+        self.server.respond('PATCH', '/users/u1', 429, headers={'Retry-After': '3'})
+        results = self.executor.apply([UpdateUserOperation(user(1), {'surname': 'X'}), UpdateUserOperation(user(2), {}),
+                                       DeleteUserOperation(user(1))])
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual([3.0], self.sleeps)
+        retried = self.server.batches[1]
+        self.assertEqual(['0', '2'], [r['id'] for r in retried])
+        self.assertEqual(['0'], retried[1]['dependsOn'])
+
+    def test_give_up(self):
+        for _ in range(4):
+            self.server.respond('DELETE', '/users/u1', 503)
+        result, = self.executor.apply([DeleteUserOperation(user(1))])
+        self.assertFalse(result.success)
+        # Exponential backoff with jitter
+        self.assertEqual(3, len(self.sleeps))
+        self.assertTrue(all(0 <= s <= 2 ** i for i, s in enumerate(self.sleeps)))
+
+    def test_gateway_timeout(self):
+        """Timed out sub-requests are only retried when idempotent."""
+        self.server.respond('DELETE', '/users/u1', 504)
+        self.server.respond('POST', '/groups/g/members/$ref', 504)
+        results = self.executor.apply([DeleteUserOperation(user(1)), AddGroupMemberOperation(GROUP, user(2))])
+        self.assertEqual([True, False], [r.success for r in results])
+        self.assertEqual([['0', '1'], ['0']], [[r['id'] for r in b] for b in self.server.batches])
+
+    def test_failure(self):
+        """Failures are collected and later operations on the object are skipped."""
+        self.server.respond('PATCH', '/users/u1', 404, body={'error': {'code': 'NotFound'}})
+        operations = [UpdateUserOperation(user(1), {}), GetUsers(), DeleteUserOperation(user(1)),
+                      DeleteUserOperation(user(2))]
+        with self.assertRaises(BatchError) as cm:
+            apply(operations, self.server.graph())
+        self.assertEqual([False, True, False, True], [r.success for r in cm.exception.results])
+        self.assertIn('skipped', cm.exception.results[2].result)
+        # Independent operations are applied in the first round, the one that is not a request on its own
+        self.assertEqual([['/users/u1', '/users/u2']], [[r['url'] for r in b] for b in self.server.batches])
+        self.assertEqual([('GET', '/v1.0/users', None)], self.server.requests)
+
+    def test_paged_retry(self):
+        """Throttled queries are retried in the next batch."""
+        self.server.respond('GET', '/groups/g/members', 429, headers={'Retry-After': '2'})
+        self.server.respond('GET', '/groups/g/members', 200, {'value': [{'id': 'u1'}]})
+        result = get_paged_batch(self.server.graph(), ['groups/g/members'], sleep=self.sleeps.append)
+        self.assertEqual({'groups/g/members': [{'id': 'u1'}]}, result)
+        self.assertEqual([2.0], self.sleeps)
+        self.assertEqual(2, len(self.server.batches))
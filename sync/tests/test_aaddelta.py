@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+from django.test import TestCase
+
+from sync.aad.delta import DeltaSnapshot, remember_extension, DeltaError
+from sync.models import AADSnapshot
+from sync.tests.fakegraph import FakeGraphServer
+
+EXTENSION_ID = 'nl.esmgquadrivium.tutti'
+
+
+def user(directory_id, surname='Surname'):
+    return {'id': directory_id, 'displayName': 'Name', 'givenName': None, 'mailNickname': directory_id,
+            'preferredLanguage': None, 'surname': surname, 'userPrincipalName': directory_id + '@example.com',
+            'onPremisesImmutableId': None}
+
+
+class DeltaSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.graph = self.server.graph()
+
+    def delta_link(self, token):
+        return '{}/v1.0/users/delta?$deltatoken={}'.format(self.server.base_url, token)
+
+    def full_read(self):
+        """Reads u1 with extension and u2 without, in 2 pages."""
+        self.server.respond('GET', '/users/delta', 200, {
+            'value': [user('u1'), user('u2')],
+            '@odata.nextLink': '{}/v1.0/users/delta?$skiptoken=1'.format(self.server.base_url),
+        })
+        self.server.respond('GET', '/users/delta', 200, {'value': [], '@odata.deltaLink': self.delta_link('a')})
+        self.server.respond('GET', '/users', 200, {'value': [
+            {'id': 'u1', 'extensions': [{'id': EXTENSION_ID, 'tuttiId': 1}]},
+            {'id': 'u2'},
+        ]})
+        return DeltaSnapshot(self.graph, 'users').refresh()
+
+    def test_full(self):
+        u1, = self.full_read()
+        self.assertEqual(('u1', 1, 'Surname'), (u1.directory_id, u1.extension['tuttiId'], u1.surname))
+        self.assertEqual(self.delta_link('a'), AADSnapshot.objects.get(collection='users').delta_link)
+        self.assertEqual([], self.server.batches)
+
+    def test_delta(self):
+        """Only changes are read, the extensions of new objects are read in a batch."""
+        self.full_read()
+        self.server.requests.clear()
+        self.server.respond('GET', '/users/delta', 200, {
+            'value': [{'id': 'u1', 'surname': 'Changed'}, {'id': 'u2', '@removed': {'reason': 'deleted'}},
+                      user('u3'), user('u4')],
+            '@odata.deltaLink': self.delta_link('b'),
+        })
+        self.server.respond('GET', '/users/u3/extensions/' + EXTENSION_ID, 200,
+                            {'@odata.context': 'x', 'id': EXTENSION_ID, 'tuttiId': 3})
+        self.server.respond('GET', '/users/u4/extensions/' + EXTENSION_ID, 404)
+        users = DeltaSnapshot(self.graph, 'users').refresh()
+
+        self.assertEqual([('GET', '/v1.0/users/delta?$deltatoken=a', None)], self.server.requests)
+        batch, = self.server.batches
+        self.assertEqual(['/users/u3/extensions/' + EXTENSION_ID, '/users/u4/extensions/' + EXTENSION_ID],
+                         [r['url'] for r in batch])
+        self.assertEqual([('u1', 'Changed', 'u1@example.com'), ('u3', 'Surname', 'u3@example.com')],
+                         [(u.directory_id, u.surname, u.user_principal_name) for u in users])
+        self.assertEqual({'id': EXTENSION_ID, 'tuttiId': 3}, users[1].extension)
+        snapshot = AADSnapshot.objects.get(collection='users')
+        self.assertEqual({'u1', 'u3', 'u4'}, snapshot.objects_data.keys())
+        self.assertIsNone(snapshot.extensions['u4'])
+
+        # An extension added later on is recorded
+        remember_extension('users', 'u4', {'tuttiId': 4})
+        self.assertEqual(['u1', 'u3', 'u4'], [u.directory_id for u in DeltaSnapshot(self.graph, 'users').get_objects()])
+
+    def test_expired(self):
+        """All objects are read again when the delta link has expired or the full read interval passed."""
+        self.full_read()
+        self.server.respond('GET', '/users/delta', 410, {'error': {'code': 'resyncRequired'}})
+        with self.assertLogs('sync.aad', 'INFO') as logs:
+            self.assertEqual(1, len(self.full_read()))
+        self.assertEqual(['INFO'], [r.levelname for r in logs.records])
+        self.assertEqual(['/v1.0/users/delta?$deltatoken=a'],
+                         [p for _, p, _ in self.server.requests if 'deltatoken' in p])
+
+        AADSnapshot.objects.update(full_read=AADSnapshot.objects.get().full_read - timedelta(days=2))
+        self.server.requests.clear()
+        self.full_read()
+        self.assertEqual([], [p for _, p, _ in self.server.requests if 'deltatoken' in p])
+
+    def test_extension_error(self):
+        """The snapshot is not saved when an extension can't be read."""
+        self.full_read()
+        self.server.respond('GET', '/users/delta', 200, {'value': [user('u3')], '@odata.deltaLink': self.delta_link('b')})
+        self.server.respond('GET', '/users/u3/extensions/' + EXTENSION_ID, 500)
+        with self.assertRaises(DeltaError):
+            DeltaSnapshot(self.graph, 'users').refresh()
+        self.assertEqual(self.delta_link('a'), AADSnapshot.objects.get().delta_link)
+
+    def test_extension_throttled(self):
+        """A throttled extension read is retried in a next batch."""
+        self.full_read()
+        self.server.respond('GET', '/users/delta', 200, {'value': [user('u3')], '@odata.deltaLink': self.delta_link('b')})
+        self.server.respond('GET', '/users/u3/extensions/' + EXTENSION_ID, 429, headers={'Retry-After': '2'})
+        self.server.respond('GET', '/users/u3/extensions/' + EXTENSION_ID, 200, {'id': EXTENSION_ID, 'tuttiId': 3})
+        delays = []
+        u1, u3 = DeltaSnapshot(self.graph, 'users', sleep=delays.append).refresh()
+        self.assertEqual({'id': EXTENSION_ID, 'tuttiId': 3}, u3.extension)
+        self.assertEqual(2, len(self.server.batches))
+        self.assertEqual([2.0], delays)
@@ -0,0 +1,92 @@
+import threading
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from sync.aad.graph import GraphUser, GraphGroup
+from sync.aad.operations import CreateGroupOperation, AddGroupMemberOperation, UpdateUserOperation, \
+    DeleteUserOperation, CreateUserOperation, RemoveGroupMemberOperation
+from sync.aad.scheduler import Scheduler, get_dependencies
+from sync.models import PendingFollowUp
+from sync.tests.fakegraph import FakeGraphServer
+
+
+def user(i):
+    return GraphUser('User', None, 'user', None, None, 'user{}@example.com'.format(i), None,
+                     directory_id='u{}'.format(i), extension={'tuttiId': i})
+
+
+@override_settings(GRAPH_LICENSE_SKU_ID='sku')
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.scheduler = Scheduler(self.server.graph(), concurrency=3)
+        group = GraphGroup(None, 'Group', 'group', directory_id='g0', extension={'tuttiId': 10})
+        self.operations = [CreateGroupOperation(GraphGroup(None, 'New', 'new', extension={'tuttiId': 11})),
+                           UpdateUserOperation(user(1), {'surname': 'X'}), AddGroupMemberOperation(group, user(1)),
+                           DeleteUserOperation(user(1)), UpdateUserOperation(user(2), {})]
+
+    def test_dependencies(self):
+        """Operations on the same object keep their order, a deletion waits for the memberships of the object."""
+        self.assertEqual([set(), set(), set(), {1, 2}, set()], get_dependencies(self.operations))
+
+    def test_requirements(self):
+        """Membership operations on a new object are applied after its creation."""
+        new = self.operations[0].group
+        operations = self.operations + [AddGroupMemberOperation(new, user(2))]
+        self.assertEqual({0}, get_dependencies(operations)[5])
+
+    def test_deletion(self):
+        """A deletion is applied after the other operations on the object."""
+        group = self.operations[2].group
+        operations = [RemoveGroupMemberOperation(group, user(3)), UpdateUserOperation(user(3), {}),
+                      DeleteUserOperation(user(3))]
+        self.assertEqual([set(), set(), {0, 1}], get_dependencies(operations))
+
+    def test_apply(self):
+        """Independent operations are applied right away, the others when their dependencies are done."""
+        self.server.respond('POST', '/groups', 201, {'id': 'g1'})
+        with self.assertLogs('sync.aad.scheduler', 'INFO') as logs:
+            results = self.scheduler.apply(self.operations)
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(['INFO:sync.aad.scheduler:Applied 5 operations in 2 rounds'], logs.output)
+        self.assertEqual([['/users/u1', '/groups/g0/members/$ref', '/users/u2'], ['/users/u1']],
+                         [[r['url'] for r in b] for b in self.server.batches])
+        # The follow-up of the create is queued on this thread
+        self.assertEqual('g1', PendingFollowUp.objects.get().directory_id)
+
+    def test_failure(self):
+        """Operations that depend on a failed operation are skipped."""
+        self.server.respond('POST', '/groups', 201, {'id': 'g1'})
+        self.server.respond('PATCH', '/users/u1', 500)
+        results = self.scheduler.apply(self.operations)
+        self.assertEqual([True, False, True, False, True], [r.success for r in results])
+        self.assertIn('skipped', results[3].result)
+
+    def test_failed_create(self):
+        """No follow-up is queued when the create failed."""
+        self.server.respond('POST', '/groups', 500)
+        result, = self.scheduler.apply(self.operations[:1])
+        self.assertFalse(result.success)
+        self.assertFalse(PendingFollowUp.objects.exists())
+
+    def test_concurrent_creates(self):
+        """Creates are sent concurrently, the barrier is broken when they are sent one by one."""
+        barrier = threading.Barrier(2, timeout=5)
+
+        def create(obj):
+            barrier.wait()
+            return 'new{}'.format(obj.extension['tuttiId'])
+
+        graph = self.scheduler.graph
+        with mock.patch.object(graph, 'create_user', create), mock.patch.object(graph, 'create_group', create):
+            results = self.scheduler.apply([CreateUserOperation(user(3)), self.operations[0]])
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(['new3', 'new11'], list(PendingFollowUp.objects.order_by('id').values_list(
+            'directory_id', flat=True)))
+
+    def test_concurrent(self):
+        """The batches of a round are sent concurrently."""
+        self.scheduler.apply([UpdateUserOperation(user(i), {}) for i in range(45)])
+        self.assertEqual([5, 20, 20], sorted(len(b) for b in self.server.batches))
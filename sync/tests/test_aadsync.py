@@ -0,0 +1,187 @@
+from unittest import mock
+
+from django.test import TestCase, SimpleTestCase
+from requests import RequestException
+
+from members.models import Person, QGroup
+from sync.aad.batch import BatchError
+from sync.aad.delta import DeltaSnapshot
+from sync.aad.operations import AddGroupMemberOperation, RemoveGroupMemberOperation, DeleteUserOperation, \
+    CreateGroupOperation, UpdateUserOperation, AddGroupMembersOperation
+from sync.aad.graph import GraphGroup, GraphUser
+from sync.aad.sync import aad_sync_members, aad_sync_objects, merge_member_additions
+from sync.aad.tasks import aad_sync
+from sync.models import AADSnapshot, PendingFollowUp, SyncRun
+from sync.tests.fakegraph import FakeGraphServer
+
+
+def user(directory_id):
+    return {'displayName': 'Name', 'givenName': None, 'mailNickname': directory_id, 'preferredLanguage': None,
+            'surname': None, 'userPrincipalName': directory_id + '@example.com', 'onPremisesImmutableId': None}
+
+
+class SyncMembersTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.graph = self.server.graph()
+        self.people = [Person.objects.create(username='p{}'.format(i)) for i in range(3)]
+        self.groups = [QGroup.objects.create(name='g{}'.format(i)) for i in range(2)]
+        self.people[0].groups.set(self.groups)
+        self.people[1].groups.set([self.groups[1]])
+        AADSnapshot.objects.create(
+            collection='users',
+            objects_data={'u{}'.format(i): user('u{}'.format(i)) for i in range(4)},
+            # u3 is not a synced user
+            extensions={'u{}'.format(i): {'tuttiId': p.id} for i, p in enumerate(self.people)},
+        )
+        AADSnapshot.objects.create(
+            collection='groups',
+            objects_data={'g{}'.format(i): {'displayName': g.name, 'description': None, 'mailNickname': g.name}
+                          for i, g in enumerate(self.groups)},
+            extensions={'g{}'.format(i): {'tuttiId': g.id} for i, g in enumerate(self.groups)},
+        )
+
+    def test_members(self):
+        """Remote members of all groups are read in one batch, following next pages."""
+        self.server.respond('GET', '/groups/g0/members', 200, {
+            'value': [{'id': 'u2'}],
+            '@odata.nextLink': '{}/v1.0/groups/g0/members?$skiptoken=x'.format(self.server.base_url),
+        })
+        self.server.respond('GET', '/groups/g0/members', 200, {'value': [{'id': 'u3'}]})
+        self.server.respond('GET', '/groups/g1/members', 200, {'value': [{'id': 'u0'}]})
+        with self.assertNumQueries(3):
+            operations = aad_sync_members(self.graph)
+        self.assertEqual([[r['url'] for r in b] for b in self.server.batches], [
+            ['/groups/g0/members?$select=id&$top=999', '/groups/g1/members?$select=id&$top=999'],
+            ['/groups/g0/members?$skiptoken=x'],
+        ])
+        self.assertEqual([], self.server.requests)
+        self.assertEqual({(AddGroupMemberOperation, 'g0', 'u0'), (RemoveGroupMemberOperation, 'g0', 'u2'),
+                          (AddGroupMemberOperation, 'g1', 'u1')},
+                         {(type(o), o.group.directory_id, o.user.directory_id) for o in operations})
+
+    def test_forget(self):
+        """Users deleted in the object phase are not used."""
+        snapshot = DeltaSnapshot(self.graph, 'users')
+        snapshot.forget([DeleteUserOperation(snapshot.get_objects()[1])])
+        for g in ('g0', 'g1'):
+            self.server.respond('GET', '/groups/{}/members'.format(g), 200, {'value': [{'id': 'u0'}]})
+        self.assertEqual([], aad_sync_members(self.graph))
+
+    def test_deleted(self):
+        """Objects that the object operations delete are skipped, without applying them first."""
+        users = DeltaSnapshot(self.graph, 'users').get_objects()
+        for g in ('g0', 'g1'):
+            self.server.respond('GET', '/groups/{}/members'.format(g), 200, {'value': [{'id': 'u0'}]})
+        self.assertEqual([], aad_sync_members(self.graph, [DeleteUserOperation(users[1])]))
+        self.assertEqual(3, len(DeltaSnapshot(self.graph, 'users').get_objects()))
+
+
+class SyncObjectsTestCase(TestCase):
+    def test_objects(self):
+        """Users and groups are read concurrently into the snapshots."""
+        person = Person.objects.create(username='p', first_name='First', last_name='Last')
+        group = QGroup.objects.create(name='group')
+        with FakeGraphServer() as server:
+            for collection, obj in [('users', {'id': 'u', **user('p')}), ('groups', {'id': 'g'})]:
+                server.respond('GET', '/{}/delta'.format(collection), 200, {
+                    'value': [obj],
+                    '@odata.deltaLink': '{}/v1.0/{}/delta?$deltatoken=a'.format(server.base_url, collection),
+                })
+            server.respond('GET', '/users', 200, {'value': [{'id': 'u', 'extensions': [{'tuttiId': person.id}]}]})
+            server.respond('GET', '/groups', 200, {'value': []})
+            server.respond('GET', '/groups/g/extensions/nl.esmgquadrivium.tutti', 404)
+            Person.groups.through.objects.create(user_id=person.id, group_id=group.id)
+            with self.settings(MEMBERS_GROUP=group.id):
+                operations = aad_sync_objects(server.graph())
+        update, create = sorted(operations, key=lambda o: type(o).__name__, reverse=True)
+        self.assertIsInstance(update, UpdateUserOperation)
+        self.assertEqual('First Last', update.changes['displayName'])
+        self.assertIsInstance(create, CreateGroupOperation)
+        self.assertEqual(2, AADSnapshot.objects.exclude(delta_link='').count())
+
+
+class AADSyncTestCase(TestCase):
+    def setUp(self):
+        self.group = QGroup.objects.create(name='group')
+        self.people = [Person.objects.create(username='p{}'.format(i), last_name='Last') for i in range(2)]
+        self.group.user_set.set(self.people)
+
+    def sync(self, **kwargs):
+        """Runs the task against a fake server with a user to update, one to create and one to delete."""
+        with FakeGraphServer() as server:
+            for collection, objects in [('users', [{'id': 'u0', **user('p0')}, {'id': 'ux', **user('px')}]),
+                                        ('groups', [{'id': 'g0', 'displayName': 'group', 'description': None,
+                                                     'mailNickname': 'group'}])]:
+                server.respond('GET', '/{}/delta'.format(collection), 200, {
+                    'value': objects,
+                    '@odata.deltaLink': '{}/v1.0/{}/delta?$deltatoken=a'.format(server.base_url, collection),
+                })
+            server.respond('GET', '/users', 200, {'value': [
+                {'id': 'u0', 'extensions': [{'tuttiId': self.people[0].id}]},
+                {'id': 'ux', 'extensions': [{'tuttiId': self.people[1].id + 1}]},
+            ]})
+            server.respond('GET', '/groups', 200, {'value': [{'id': 'g0', 'extensions': [{'tuttiId': self.group.id}]}]})
+            server.respond('GET', '/groups/g0/members', 200, {'value': [{'id': 'ux'}]})
+            server.respond('POST', '/users', 201, {'id': 'u1'})
+            with self.settings(MEMBERS_GROUP=self.group.id, GRAPH_TENANT='tenant', GRAPH_CLIENT_ID='client',
+                               GRAPH_CLIENT_SECRET='secret', GRAPH_URL=server.base_url + '/v1.0',
+                               GRAPH_LOGIN_URL=server.base_url, GRAPH_LICENSE_SKU_ID='sku'):
+                applied = aad_sync(**kwargs)
+        return server, applied
+
+    def test_sync(self):
+        """The task diffs and applies the object, membership and delete operations together."""
+        server, applied = self.sync()
+        self.assertEqual(['AddGroupMember', 'CreateUser', 'DeleteUser', 'UpdateUser'],
+                         sorted(type(o).__name__[:-len('Operation')] for o in applied))
+        # The create is sent in the same round as the batch, the deleted user is not removed as member
+        self.assertEqual(['p1'], [b['mailNickname'] for m, p, b in server.requests if (m, p) == ('POST', '/v1.0/users')])
+        self.assertEqual([['/groups/g0/members?$select=id&$top=999'],
+                          ['/users/u0', '/groups/g0/members/$ref', '/users/ux']],
+                         [[r['url'] for r in b] for b in server.batches])
+        self.assertEqual([('users', 'u1', self.people[1].id)],
+                         list(PendingFollowUp.objects.values_list('collection', 'directory_id', 'tutti_id')))
+        self.assertEqual({'u0'}, AADSnapshot.objects.get(collection='users').objects_data.keys())
+        run = SyncRun.objects.get()
+        self.assertTrue(run.success)
+        self.assertEqual(4, run.operation_count)
+
+    def test_without_deletions(self):
+        """The memberships of a user that is not deleted are synced."""
+        server, applied = self.sync(apply_deletions=False)
+        self.assertEqual(['AddGroupMember', 'CreateUser', 'RemoveGroupMember', 'UpdateUser'],
+                         sorted(type(o).__name__[:-len('Operation')] for o in applied))
+        self.assertEqual(['/users/u0', '/groups/g0/members/$ref', '/groups/g0/members/ux/$ref'],
+                         [r['url'] for r in server.batches[1]])
+        self.assertEqual({'u0', 'ux'}, AADSnapshot.objects.get(collection='users').objects_data.keys())
+
+    def test_failure(self):
+        """A deletion that succeeded is dropped from the snapshot when another operation failed."""
+        with self.assertRaises(BatchError):
+            with mock.patch('sync.aad.graph.Graph.create_user', side_effect=RequestException('failed')):
+                self.sync()
+        self.assertEqual({'u0'}, AADSnapshot.objects.get(collection='users').objects_data.keys())
+        self.assertFalse(SyncRun.objects.get().success)
+
+
+class MergeMemberAdditionsTestCase(SimpleTestCase):
+    def test_merge(self):
+        """Additions are merged per group in chunks of 20, removals are kept."""
+        g1 = GraphGroup(None, 'G1', 'g1', directory_id='g1')
+        g2 = GraphGroup(None, 'G2', 'g2', directory_id='g2')
+        users = [GraphUser('U', None, 'u', None, None, 'u{}'.format(i), None, directory_id='u{}'.format(i))
+                 for i in range(45)]
+        remove = RemoveGroupMemberOperation(g1, users[0])
+        single = AddGroupMemberOperation(g2, users[0])
+        operations = [AddGroupMemberOperation(g1, u) for u in users[:20]] + [remove, single]
+        operations += [AddGroupMemberOperation(g1, u) for u in users[20:]]
+        merged = merge_member_additions(operations)
+        self.assertEqual([AddGroupMembersOperation] * 3 + [RemoveGroupMemberOperation, AddGroupMemberOperation],
+                         [type(o) for o in merged])
+        self.assertEqual([20, 20, 5], [len(o.users) for o in merged[:3]])
+        self.assertEqual(users, [u for o in merged[:3] for u in o.users])
+        method, resource, body = merged[2].get_request()
+        self.assertEqual(('PATCH', 'groups/g1'), (method, resource))
+        self.assertEqual('https://graph.microsoft.com/v1.0/directoryObjects/u40', body['members@odata.bind'][0])
@@ -0,0 +1,63 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+
+from members.models import Person
+from sync.benchmark import SyntheticDirectory, compare
+
+
+class SyntheticDirectoryTestCase(TestCase):
+    def test_repeatable(self):
+        a = SyntheticDirectory.generate(100, seed=3)
+        b = SyntheticDirectory.generate(100, seed=3)
+        self.assertEqual(a.ldap_people(), b.ldap_people())
+        self.assertEqual(a.ldap_groups(), b.ldap_groups())
+
+    def test_drift(self):
+        local = SyntheticDirectory.generate(100)
+        remote = local.drift(0.2)
+        self.assertEqual(90, len(remote.people.keys() & local.people.keys()))
+        self.assertEqual(10, len(remote.people.keys() - local.people.keys()))
+        changed = [i for i in local.people.keys() & remote.people.keys() if local.people[i] != remote.people[i]]
+        self.assertTrue(changed)
+
+
+class CompareTestCase(TestCase):
+    def test_compare(self):
+        baseline = {'a[10]': {'seconds': 1.0, 'peak_bytes': 100}, 'b[10]': {'seconds': 1.0, 'peak_bytes': 100}}
+        results = {'a[10]': {'seconds': 1.2, 'peak_bytes': 200}, 'c[10]': {'seconds': 5.0, 'peak_bytes': 100}}
+        self.assertEqual([('a[10]', 'peak_bytes', 1.0)], compare(results, baseline, 0.25))
+
+
+class CommandTestCase(TestCase):
+    def test_save_compare(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'baseline.json')
+            call_command('syncbenchmark', sizes=[50], repeat=1, save=path, stdout=io.StringIO())
+            with open(path) as f:
+                baseline = json.load(f)
+            self.assertIn('sync_people[50]', baseline)
+
+            # Make the baseline impossibly fast
+            for result in baseline.values():
+                result['seconds'] = 1e-12
+            with open(path, 'w') as f:
+                json.dump(baseline, f)
+            with self.assertRaises(CommandError):
+                call_command('syncbenchmark', sizes=[50], repeat=1, compare=path,
+                             stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class LDAPBenchmarkCommandTestCase(TestCase):
+    def test_rollback(self):
+        """The phases are reported and the synthetic data is removed."""
+        out = io.StringIO()
+        call_command('ldapbenchmark', people=50, stdout=out)
+        for phase in ('local_fetch', 'remote_fetch', 'diff', 'apply'):
+            self.assertIn(phase, out.getvalue())
+        self.assertIn('0 failed', out.getvalue())
+        self.assertFalse(Person.objects.exists())
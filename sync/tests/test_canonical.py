@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+
+from django.test import TestCase
+
+from sync.canonical import CanonicalEntry, normalize_value
+
+
+class CanonicalEntryTestCase(TestCase):
+    def test_equal(self):
+        """Value order, value types and empty attributes don't matter."""
+        a = CanonicalEntry('uid=test', {'id': [4], 'objectClass': ['top', 'person'], 'sn': []})
+        b = CanonicalEntry('UID=test', {'id': ['4'], 'objectClass': ['Person', 'top']})
+        self.assertEqual(a, b)
+        self.assertEqual(a.get_digest(), b.get_digest())
+
+    def test_multiset(self):
+        """Duplicate values are counted."""
+        a = CanonicalEntry('uid=test', {'mail': ['a', 'a']})
+        b = CanonicalEntry('uid=test', {'mail': ['a']})
+        self.assertNotEqual(a, b)
+        self.assertNotEqual(a.get_digest(), b.get_digest())
+
+    def test_attribute_boundary(self):
+        """Values can't be moved between attributes without changing the digest."""
+        a = CanonicalEntry('uid=test', {'a': ['x', 'y'], 'b': ['z']})
+        b = CanonicalEntry('uid=test', {'a': ['x'], 'b': ['y', 'z']})
+        self.assertNotEqual(a.get_digest(), b.get_digest())
+
+    def test_str_bytes(self):
+        """Str and bytes are different, unless the schema says otherwise."""
+        self.assertNotEqual(CanonicalEntry('uid=test', {'a': ['x']}).get_digest(),
+                            CanonicalEntry('uid=test', {'a': [b'x']}).get_digest())
+        self.assertEqual(normalize_value('userPassword', 'x'), b'x')
+
+    def test_normalize_value(self):
+        self.assertEqual('4', normalize_value('qDBLinkID', 4))
+        self.assertEqual('FALSE', normalize_value('x', False))
+        self.assertEqual('20200101120000Z', normalize_value('x', datetime(2020, 1, 1, 12, tzinfo=timezone.utc)))
@@ -0,0 +1,58 @@
+from django.test import TestCase, override_settings
+from django_q.models import Schedule
+
+from members.models import Person, QGroup
+from sync.coalesce import trigger_sync, claim_pending_sync, LDAP, AAD, get_schedule_name
+from sync.models import PendingSync
+
+
+class CoalesceTestCase(TestCase):
+    """Test folding of sync triggers into a pending sync."""
+
+    def test_fold(self):
+        """Later triggers are merged into the pending sync."""
+        trigger_sync(LDAP, person_ids=[1, 2])
+        trigger_sync(LDAP, person_ids=[2, 3], group_ids=[5])
+        trigger_sync(LDAP, group_ids=[4])
+        pending = PendingSync.objects.get(target=LDAP)
+        self.assertEqual([1, 2, 3], pending.person_ids)
+        self.assertEqual([4, 5], pending.group_ids)
+        self.assertEqual(3, pending.triggers)
+        # Only the first trigger schedules a task
+        self.assertEqual(1, Schedule.objects.filter(func='sync.coalesce.run_pending_sync').count())
+
+    def test_targets(self):
+        """There is one pending sync per target."""
+        trigger_sync(LDAP, person_ids=[1])
+        trigger_sync(AAD)
+        self.assertEqual(2, PendingSync.objects.count())
+        self.assertEqual(2, Schedule.objects.filter(func='sync.coalesce.run_pending_sync').count())
+
+    def test_claim(self):
+        """After claiming, a new trigger schedules a new sync."""
+        trigger_sync(LDAP, person_ids=[1])
+        pending = claim_pending_sync(LDAP)
+        self.assertEqual([1], pending.person_ids)
+        self.assertFalse(PendingSync.objects.exists())
+        with self.assertRaises(PendingSync.DoesNotExist):
+            claim_pending_sync(LDAP)
+        trigger_sync(LDAP, person_ids=[2])
+        self.assertEqual([2], PendingSync.objects.get(target=LDAP).person_ids)
+
+    def test_lost_schedule(self):
+        """A pending sync of which the schedule is gone, e.g. because the task died, is scheduled again."""
+        trigger_sync(LDAP, person_ids=[1])
+        Schedule.objects.all().delete()
+        trigger_sync(LDAP, person_ids=[2])
+        self.assertTrue(Schedule.objects.filter(name=get_schedule_name(LDAP)).exists())
+        self.assertEqual([1, 2], PendingSync.objects.get(target=LDAP).person_ids)
+
+    @override_settings(LDAP_SYNC_ON_SAVE=True)
+    def test_bulk_save(self):
+        """Saving many objects results in a single pending sync."""
+        group = QGroup.objects.create(name='group')
+        people = [Person.objects.create(username='test{}'.format(i)) for i in range(10)]
+        pending = PendingSync.objects.get(target=LDAP)
+        self.assertEqual(11, pending.triggers)
+        self.assertEqual([group.pk], pending.group_ids)
+        self.assertEqual(sorted(p.pk for p in people), pending.person_ids)
@@ -0,0 +1,87 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django_q.models import Schedule
+
+from sync.aad.followup import process_follow_ups, MAX_ATTEMPTS
+from sync.aad.graph import GraphUser, GraphGroup
+from sync.aad.operations import CreateUserOperation, CreateGroupOperation, FOLLOW_UP_SCHEDULE
+from sync.models import PendingFollowUp, PendingSync
+from sync.tests.fakegraph import FakeGraphServer
+
+
+@override_settings(GRAPH_LICENSE_SKU_ID='sku', GRAPH_FOLLOW_UP_DELAY=10)
+class FollowUpTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeGraphServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.graph = self.server.graph()
+        self.server.respond('POST', '/users', 201, {'id': 'u1'})
+        user = GraphUser('Name', None, 'name', None, None, 'name@example.com', None, extension={'tuttiId': 1})
+        CreateUserOperation(user).apply(self.graph)
+
+    def test_create(self):
+        """Creating returns right away and queues the follow-up."""
+        self.server.respond('POST', '/groups', 201, {'id': 'g1'})
+        CreateGroupOperation(GraphGroup(None, 'Group', 'group', extension={'tuttiId': 2})).apply(self.graph)
+        self.assertEqual([('users', 'u1', {'tuttiId': 1}, 'sku'), ('groups', 'g1', {'tuttiId': 2}, '')],
+                         list(PendingFollowUp.objects.order_by('id').values_list(
+                             'collection', 'directory_id', 'extension', 'license_sku_id')))
+        self.assertEqual(1, Schedule.objects.filter(name=FOLLOW_UP_SCHEDULE).count())
+
+    def test_process(self):
+        """Extension and license are added in a single batch, then a sync is triggered."""
+        Schedule.objects.all().delete()
+        self.assertEqual(1, process_follow_ups(self.graph))
+        batch, = self.server.batches
+        self.assertEqual(['/users/u1/extensions', '/users/u1/assignLicense'], [r['url'] for r in batch])
+        self.assertFalse(PendingFollowUp.objects.exists())
+        self.assertTrue(PendingSync.objects.filter(target='aad').exists())
+        self.assertFalse(Schedule.objects.filter(name=FOLLOW_UP_SCHEDULE).exists())
+
+    def test_not_readable(self):
+        """A new object that is not readable yet is tried again later."""
+        Schedule.objects.all().delete()
+        self.server.respond('POST', '/users/u1/extensions', 404)
+        self.assertEqual(0, process_follow_ups(self.graph))
+        follow_up = PendingFollowUp.objects.get()
+        self.assertEqual(1, follow_up.attempts)
+        self.assertGreater(follow_up.next_attempt, timezone.now() + timedelta(seconds=15))
+        self.assertEqual(follow_up.next_attempt, Schedule.objects.get(name=FOLLOW_UP_SCHEDULE).next_run)
+
+        # Not due yet
+        self.assertEqual(0, process_follow_ups(self.graph))
+        self.assertEqual(1, len(self.server.batches))
+
+        # The extension was added after all, but the response got lost
+        PendingFollowUp.objects.update(next_attempt=timezone.now())
+        self.server.respond('POST', '/users/u1/extensions', 409)
+        self.assertEqual(1, process_follow_ups(self.graph))
+
+    def test_give_up(self):
+        """A follow-up is kept after the last attempt, the object is not created again."""
+        Schedule.objects.all().delete()
+        PendingFollowUp.objects.update(attempts=MAX_ATTEMPTS - 1)
+        self.server.respond('POST', '/users/u1/extensions', 404)
+        self.assertEqual(0, process_follow_ups(self.graph))
+        follow_up = PendingFollowUp.objects.get()
+        self.assertIsNotNone(follow_up.given_up)
+        self.assertIn('404', follow_up.error)
+        self.assertFalse(Schedule.objects.filter(name=FOLLOW_UP_SCHEDULE).exists())
+
+        # Not tried again
+        PendingFollowUp.objects.update(next_attempt=timezone.now() - timedelta(hours=1))
+        self.assertEqual(0, process_follow_ups(self.graph))
+        self.assertEqual(1, len(self.server.batches))
+
+        # Until retried from the admin site
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+        response = self.client.get(reverse('admin:sync_pendingfollowup_changelist'), {'given_up__isempty': '0'})
+        self.assertContains(response, 'u1')
+        self.client.post(reverse('admin:sync_pendingfollowup_changelist'),
+                         {'action': 'retry', '_selected_action': [follow_up.pk]})
+        self.assertEqual(1, process_follow_ups(self.graph))
@@ -0,0 +1,109 @@
+from django.test import TestCase
+from ldap3.core.exceptions import LDAPNoSuchObjectResult
+
+from sync.ldap import iter_ldap_entries, get_ldap_entries, LDAPSearch, LDAPConnectionPool, get_pool, \
+    check_credentials, get_bound_connection
+from sync.tests import get_mock_connection
+
+SEARCH = LDAPSearch(base_dn='ou=people,dc=esmgquadrivium,dc=nl', object_class='esmgqPerson', attributes=['uid'])
+
+
+class LDAPEntriesTestCase(TestCase):
+    def setUp(self):
+        self.conn = get_mock_connection({
+            'uid=a{},ou=people,dc=esmgquadrivium,dc=nl'.format(i): {'objectClass': ['esmgqPerson'],
+                                                                    'uid': 'a{}'.format(i)}
+            for i in range(5)
+        })
+
+    def test_paged(self):
+        """All entries are returned when they span multiple pages."""
+        entries = list(iter_ldap_entries(self.conn, [SEARCH], page_size=2))
+        self.assertEqual(5, len(entries))
+        self.assertIn(('uid=a3,ou=people,dc=esmgquadrivium,dc=nl', {'uid': ['a3']}), entries)
+
+    def test_get_ldap_entries(self):
+        entries = get_ldap_entries(self.conn, [SEARCH])
+        self.assertEqual(5, len(entries))
+        self.assertEqual({'uid': ['a0']}, entries['uid=a0,ou=people,dc=esmgquadrivium,dc=nl'])
+
+
+class LDAPConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.pool = LDAPConnectionPool(factory=lambda: get_mock_connection({}), max_size=2,
+                                       health_check=lambda conn: True)
+
+    def test_reuse(self):
+        """A released connection is reused."""
+        with self.pool.connection() as conn1:
+            pass
+        with self.pool.connection() as conn2:
+            self.assertEqual({'created': 1, 'reused': 1, 'evicted': 0, 'unhealthy': 0, 'discarded': 0,
+                              'idle': 0, 'in_use': 1},
+                             self.pool.stats())
+        self.assertIs(conn1, conn2)
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_max_size(self):
+        """Connections beyond the maximum size are closed after use."""
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+        stats = self.pool.stats()
+        self.assertEqual(2, stats['idle'])
+        self.assertEqual(1, stats['discarded'])
+        self.assertTrue(conns[2].closed)
+
+    def test_idle_eviction(self):
+        """Connections idle for too long are closed instead of reused."""
+        self.pool.max_idle = 0
+        with self.pool.connection() as conn1:
+            pass
+        with self.pool.connection() as conn2:
+            self.assertIsNot(conn1, conn2)
+        self.assertTrue(conn1.closed)
+        self.assertEqual(1, self.pool.stats()['evicted'])
+
+    def test_health_check(self):
+        """Unhealthy connections are not reused."""
+        self.pool.check_after = 0
+        self.pool.health_check = lambda conn: False
+        with self.pool.connection() as conn1:
+            pass
+        with self.pool.connection() as conn2:
+            self.assertIsNot(conn1, conn2)
+        self.assertEqual(1, self.pool.stats()['unhealthy'])
+
+    def test_discard_on_error(self):
+        """Non-LDAP errors discard the connection, LDAP results don't."""
+        with self.assertRaises(LDAPNoSuchObjectResult):
+            with self.pool.connection() as conn:
+                conn.delete('uid=nobody,ou=people,dc=esmgquadrivium,dc=nl')
+        self.assertEqual(1, self.pool.stats()['idle'])
+        with self.assertRaises(ValueError):
+            with self.pool.connection():
+                raise ValueError()
+        self.assertEqual(0, self.pool.stats()['idle'])
+        self.assertEqual(1, self.pool.stats()['discarded'])
+
+
+class CheckCredentialsTestCase(TestCase):
+    def setUp(self):
+        self.pool = get_pool('credentials')
+        self.pool.clear()
+        self.pool.factory = lambda: get_mock_connection({
+            'uid=test,ou=people,dc=esmgquadrivium,dc=nl': {'uid': 'test', 'userPassword': 'password'},
+        })
+
+    def tearDown(self):
+        self.pool.clear()
+        self.pool.factory = get_bound_connection
+
+    def test_check_credentials(self):
+        self.assertTrue(check_credentials('uid=test,ou=people,dc=esmgquadrivium,dc=nl', 'password'))
+        self.assertFalse(check_credentials('uid=test,ou=people,dc=esmgquadrivium,dc=nl', 'wrong'))
+        self.assertTrue(check_credentials('uid=test,ou=people,dc=esmgquadrivium,dc=nl', 'password'))
+        # The connection is reused after success, but not after a failed bind
+        stats = self.pool.stats()
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(1, stats['reused'])
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+from django.test import TestCase
+from ldap3 import MOCK_ASYNC
+from ldap3.core.results import RESULT_SUCCESS
+
+from sync.ldapapply import apply_pipelined, _get_dependencies
+from sync.ldapoperations import AddOperation, DeleteOperation, ModifyOperation, ModifyDNOperation, \
+    ModifyValuesOperation
+from sync.tests import get_mock_connection
+
+
+class FakeAsyncConnection:
+    """Records the number of requests in flight."""
+
+    strategy = SimpleNamespace(sync=False)
+
+    def __init__(self):
+        self.in_flight = set()
+        self.max_in_flight = 0
+        self.next_id = 0
+        self.sent = []
+
+    def _send(self, *args, **kwargs):
+        self.sent.append(args)
+        self.next_id += 1
+        self.in_flight.add(self.next_id)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return self.next_id
+
+    add = delete = modify = modify_dn = _send
+
+    def get_response(self, message_id):
+        self.in_flight.remove(message_id)
+        return [], {'result': RESULT_SUCCESS}
+
+
+class ApplyPipelinedTestCase(TestCase):
+    def setUp(self):
+        self.conn = get_mock_connection({
+            'uid=a,ou=people,dc=esmgquadrivium,dc=nl': {'objectClass': ['esmgqPerson'], 'uid': 'a'},
+        }, client_strategy=MOCK_ASYNC, raise_exceptions=False)
+
+    def test_apply(self):
+        """Operations on different and renamed entries are applied."""
+        operations = [
+            ModifyDNOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl', 'uid=b,ou=people,dc=esmgquadrivium,dc=nl'),
+            AddOperation('uid=c,ou=people,dc=esmgquadrivium,dc=nl', {'objectClass': ['esmgqPerson'], 'uid': ['c']}),
+            ModifyOperation('uid=b,ou=people,dc=esmgquadrivium,dc=nl', 'uid', ['b']),
+        ]
+        results = apply_pipelined(self.conn, operations, window=2)
+        self.assertEqual(operations, [r.operation for r in results])
+        self.assertTrue(all(r.success for r in results))
+        response, _ = self.conn.get_response(self.conn.search('ou=people,dc=esmgquadrivium,dc=nl', '(uid=b)'))
+        self.assertEqual(['uid=b,ou=people,dc=esmgquadrivium,dc=nl'], [e['dn'] for e in response])
+
+    def test_failure(self):
+        """Failures are collected and dependent operations are skipped."""
+        operations = [
+            DeleteOperation('uid=missing,ou=people,dc=esmgquadrivium,dc=nl'),
+            AddOperation('uid=c,ou=people,dc=esmgquadrivium,dc=nl', {'objectClass': ['esmgqPerson'], 'uid': ['c']}),
+            ModifyOperation('uid=missing,ou=people,dc=esmgquadrivium,dc=nl', 'uid', ['missing']),
+        ]
+        results = apply_pipelined(self.conn, operations)
+        self.assertEqual([False, True, False], [r.success for r in results])
+        self.assertIn('skipped', results[2].result)
+
+    def test_stale(self):
+        """A modify of values that differ remotely is applied again by replacing the attribute."""
+        operations = [
+            ModifyValuesOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl', 'cn', ['B'], ['A'], values=['B']),
+            ModifyOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl', 'sn', ['S']),
+        ]
+        results = apply_pipelined(self.conn, operations)
+        self.assertEqual([True, True], [r.success for r in results])
+        self.assertEqual(ModifyOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl', 'cn', ['B']), results[0].operation)
+        response, _ = self.conn.get_response(self.conn.search('ou=people,dc=esmgquadrivium,dc=nl', '(uid=a)',
+                                                              attributes=['cn']))
+        self.assertEqual(['B'], response[0]['attributes']['cn'])
+
+        # Without all values there is no fallback
+        operation = ModifyValuesOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl', 'cn', ['C'], ['A'])
+        result, = apply_pipelined(self.conn, [operation])
+        self.assertFalse(result.success)
+
+    def test_dependencies(self):
+        """Operations wait for the last earlier operation on the same DN."""
+        operations = [
+            ModifyDNOperation('uid=a', 'uid=b'),
+            ModifyOperation('uid=c', 'cn', ['C']),
+            ModifyOperation('uid=B', 'cn', ['B']),
+            DeleteOperation('uid=a'),
+            ModifyOperation('uid=b', 'sn', ['B']),
+        ]
+        self.assertEqual([[], [], [0], [0], [2]], _get_dependencies(operations))
+
+    def test_window(self):
+        """No more than the window size of requests are in flight."""
+        conn = FakeAsyncConnection()
+        operations = [DeleteOperation('uid={}'.format(i)) for i in range(10)]
+        results = apply_pipelined(conn, operations, window=3)
+        self.assertEqual(3, conn.max_in_flight)
+        self.assertTrue(all(r.success for r in results))
+
+    def test_chains(self):
+        """Operations on the same entry are released in order when the previous one completes."""
+        conn = FakeAsyncConnection()
+        operations = [ModifyOperation('uid={}'.format(i % 3), 'cn', [str(i)]) for i in range(3000)]
+        results = apply_pipelined(conn, operations, window=16)
+        self.assertTrue(all(r.success for r in results))
+        # At most one request per entry can be in flight
+        self.assertEqual(3, conn.max_in_flight)
+        self.assertEqual([str(i) for i in range(0, 3000, 3)],
+                         [args[1]['cn'][0][1][0] for args in conn.sent if args[0] == 'uid=0'])
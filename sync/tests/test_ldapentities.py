@@ -1,6 +1,6 @@
 from django.test import TestCase
 
-from sync.ldapentities import LDAPGroup
+from sync.ldapentities import LDAPGroup, LDAPPerson
 from members.models import Person, QGroup
 
 
@@ -19,3 +19,34 @@ class ModelsTestCase(TestCase):
         QGroup.objects.create(name='group')
         ldap_attrs = LDAPGroup(QGroup.objects.first()).get_attributes()
         self.assertNotIn('member', ldap_attrs)
+
+    def test_get_entries_equal(self):
+        """Bulk built entries are equal to the per-instance entries."""
+        p1 = Person.objects.create(username='test', first_name='Test', last_name='Person', email='t@example.com')
+        p2 = Person.objects.create(username='Other', preferred_language='nl-nl')
+        p2.set_password('secret')
+        p2.save()
+        g1 = QGroup.objects.create(name='Group', description='A group', email='g@example.com')
+        g2 = QGroup.objects.create(name='Empty')
+        p1.groups.add(g1)
+        p2.groups.add(g1, g2)
+        self.assertEqual({LDAPPerson(p).get_dn(): LDAPPerson(p).get_attributes() for p in Person.objects.all()},
+                         LDAPPerson.get_entries())
+        expect = {LDAPGroup(g).get_dn(): LDAPGroup(g).get_attributes() for g in QGroup.objects.all()}
+        actual = LDAPGroup.get_entries()
+        self.assertEqual(expect.keys(), actual.keys())
+        for dn in expect:
+            self.assertEqual(expect[dn].keys(), actual[dn].keys())
+            for attr in expect[dn]:
+                self.assertCountEqual(expect[dn][attr], actual[dn][attr])
+
+    def test_get_entries_constant_queries(self):
+        """The number of queries does not depend on the number of groups."""
+        people = [Person.objects.create(username='test{}'.format(i)) for i in range(5)]
+        for i in range(10):
+            QGroup.objects.create(name='group{}'.format(i)).user_set.set(people)
+        with self.assertNumQueries(3):
+            entries = LDAPGroup.get_entries()
+        self.assertEqual(10, len(entries))
+        with self.assertNumQueries(1):
+            LDAPPerson.get_entries()
@@ -1,27 +1,30 @@
 from django.test import TestCase
 
-from sync.ldapoperations import ModifyDNOperation
+from sync.ldapoperations import ModifyDNOperation, split_dn
 
 
 class ModifyDNOperationTestCase(TestCase):
 
-    def test_get_modify_dn_args(self):
+    def test_rdn(self):
         op = ModifyDNOperation("cn=hi,dc=example,dc=com", "cn=bye,dc=example,dc=com")
-        dn, relative_dn, new_superior = op._get_modify_dn_args()
-        self.assertEqual("cn=hi,dc=example,dc=com", dn)
-        self.assertEqual("cn=bye", relative_dn)
-        self.assertIs(None, new_superior)
+        self.assertEqual("cn=bye", op.rdn)
+        self.assertIs(None, op.superior)
 
-    def test_get_modify_dn_args_new_superior(self):
+    def test_new_superior(self):
         op = ModifyDNOperation("cn=hi,dc=example,dc=com", "cn=bye,dc=gone,dc=com")
-        dn, relative_dn, new_superior = op._get_modify_dn_args()
-        self.assertEqual("cn=hi,dc=example,dc=com", dn)
-        self.assertEqual("cn=bye", relative_dn)
-        self.assertEqual("dc=gone,dc=com", new_superior)
+        self.assertEqual("cn=bye", op.rdn)
+        self.assertEqual("dc=gone,dc=com", op.superior)
 
-    def test_get_modify_dn_args_case_insensitive(self):
+    def test_case_insensitive(self):
         op = ModifyDNOperation("cn=hi,dc=ExAmPlE,dc=com", "cn=bye,dc=example,dc=com")
-        dn, relative_dn, new_superior = op._get_modify_dn_args()
-        self.assertEqual("cn=hi,dc=ExAmPlE,dc=com", dn)
-        self.assertEqual("cn=bye", relative_dn)
-        self.assertIs(new_superior, None)
+        self.assertEqual("cn=bye", op.rdn)
+        self.assertIs(op.superior, None)
+
+    def test_escaped_comma(self):
+        op = ModifyDNOperation(r"cn=Doe\, John,dc=example,dc=com", r"cn=Doe\, Jane,dc=example,dc=com")
+        self.assertEqual(r"cn=Doe\, Jane", op.rdn)
+        self.assertIs(op.superior, None)
+
+    def test_split_dn(self):
+        self.assertEqual((r"cn=Doe\, John+uid=jd", "ou=a+dc=b,dc=c"), split_dn(r"cn=Doe\, John+uid=jd,ou=a+dc=b,dc=c"))
+        self.assertEqual(("dc=com", ""), split_dn("dc=com"))
@@ -0,0 +1,110 @@
+
+from django.test import TestCase, override_settings
+from ldap3.core.exceptions import LDAPException
+
+from members.models import Person, QGroup
+from sync.ldapentities import LDAPPerson, LDAPGroup
+from sync.ldapoperations import AddOperation, DeleteOperation
+from sync.ldapsync import get_ldap_sync_changes_operations, get_ldap_sync_operations
+from sync.tests import get_mock_connection, mock_connection
+from sync.timing import PhaseTimer
+
+
+class SyncChangesTestCase(TestCase):
+    """Test the targeted sync of only changed objects."""
+
+    def test_other_entries_untouched(self):
+        """Only the given person is compared, other stale entries are not touched."""
+        p = Person.objects.create(username='new')
+        conn = get_mock_connection({
+            'uid=stale,ou=people,dc=esmgquadrivium,dc=nl': {'objectClass': ['esmgqPerson'], 'uid': 'stale',
+                                                            'qDBLinkID': p.id + 1},
+        })
+        operations = get_ldap_sync_changes_operations(conn, person_ids=[p.id])
+        p.refresh_from_db()
+        self.assertEqual([AddOperation(LDAPPerson(p).get_dn(), LDAPPerson(p).get_attributes())], operations)
+
+    def test_deleted(self):
+        """A deleted person is found remotely by link attribute and deleted."""
+        conn = get_mock_connection({
+            'uid=gone,ou=people,dc=esmgquadrivium,dc=nl': {'objectClass': ['esmgqPerson'], 'uid': 'gone',
+                                                           'qDBLinkID': 42},
+        })
+        operations = get_ldap_sync_changes_operations(conn, person_ids=[42])
+        self.assertEqual([DeleteOperation('uid=gone,ou=people,dc=esmgquadrivium,dc=nl')], operations)
+
+    def test_groups_of_person(self):
+        """Groups with the person as member, locally or remotely, are included."""
+        p = Person.objects.create(username='test')
+        local = QGroup.objects.create(name='local')
+        remote = QGroup.objects.create(name='remote')
+        untouched = QGroup.objects.create(name='untouched')
+        p.groups.add(local)
+        conn = get_mock_connection({
+            'cn=remote,ou=groups,dc=esmgquadrivium,dc=nl': {
+                'objectClass': ['esmgqGroup'], 'cn': 'remote', 'qDBLinkID': remote.id,
+                'member': ['uid=test,ou=people,dc=esmgquadrivium,dc=nl'],
+            },
+        })
+        operations = get_ldap_sync_changes_operations(conn, person_ids=[p.id])
+        dns = {o.dn for o in operations}
+        self.assertIn(LDAPGroup(local).get_dn(), dns)
+        self.assertIn(LDAPGroup(remote).get_dn(), dns)
+        self.assertNotIn(LDAPGroup(untouched).get_dn(), dns)
+        # The remote group must not be deleted, it still exists locally. The
+        # qDBLinkID is returned as str by the mock, which still matches.
+        self.assertNotIn(DeleteOperation(LDAPGroup(remote).get_dn()), operations)
+        self.assertNotIn(AddOperation(LDAPGroup(remote).get_dn(), LDAPGroup(remote).get_attributes()), operations)
+
+    def test_nothing(self):
+        """No changed objects means no operations."""
+        conn = get_mock_connection({})
+        with self.assertNumQueries(0):
+            self.assertEqual([], get_ldap_sync_changes_operations(conn))
+
+
+class SyncOperationsTestCase(TestCase):
+    """Test the full sync with concurrent fetches."""
+
+    def setUp(self):
+        self.person = Person.objects.create(username='new')
+        self.conn = get_mock_connection({
+            'uid=stale,ou=people,dc=esmgquadrivium,dc=nl': {'objectClass': ['esmgqPerson'], 'uid': 'stale',
+                                                            'qDBLinkID': 42},
+        })
+
+    def test_operations(self):
+        self.person.refresh_from_db()
+        timer = PhaseTimer()
+        operations = get_ldap_sync_operations(lambda: mock_connection(self.conn.server), timer=timer)
+        self.assertCountEqual([
+            AddOperation(LDAPPerson(self.person).get_dn(), LDAPPerson(self.person).get_attributes()),
+            DeleteOperation('uid=stale,ou=people,dc=esmgquadrivium,dc=nl'),
+        ], operations)
+        self.assertEqual({'local_fetch', 'remote_fetch', 'diff'}, timer.durations.keys())
+
+    @override_settings(LDAP_PAGE_SIZE=2)
+    def test_stream(self):
+        """The entries are streamed, with a connection for each thread."""
+        for i in range(10):
+            self.conn.strategy.add_entry('uid=stale{},ou=people,dc=esmgquadrivium,dc=nl'.format(i), {
+                'objectClass': ['esmgqPerson'], 'uid': 'stale{}'.format(i), 'qDBLinkID': 100 + i})
+        connections = []
+
+        def connect():
+            connections.append(mock_connection(self.conn.server))
+            return connections[-1]
+
+        operations = get_ldap_sync_operations(connect)
+        self.assertEqual(11, sum(isinstance(o, DeleteOperation) for o in operations))
+        self.assertEqual(2, len(set(map(id, connections))))
+
+    def test_stream_error(self):
+        """An error of the search is raised on the calling thread."""
+        def connect():
+            conn = mock_connection(self.conn.server)
+            conn.password = 'wrong'
+            return conn
+
+        with self.assertRaises(LDAPException):
+            get_ldap_sync_operations(connect)
@@ -0,0 +1,127 @@
+import io
+import os
+import tempfile
+
+from django.test import TestCase
+from ldap3 import MODIFY_REPLACE, MODIFY_ADD
+
+from sync.ldapapply import ApplyError
+from sync.ldapoperations import AddOperation, DeleteOperation, ModifyOperation, ModifyValuesOperation, \
+    ModifyAttributesOperation, ModifyDNOperation
+from sync.ldif import write_ldif, read_ldif, apply_ldif, LDIFError
+from sync.tests import get_mock_connection
+
+PEOPLE = 'ou=people,dc=esmgquadrivium,dc=nl'
+
+
+class LDIFTestCase(TestCase):
+    def round_trip(self, operations):
+        f = io.StringIO()
+        write_ldif(operations, f)
+        f.seek(0)
+        return list(read_ldif(f))
+
+    def test_round_trip(self):
+        """All operation types are read back the same."""
+        operations = [
+            AddOperation('uid=a,' + PEOPLE, {'objectClass': ['esmgqPerson', 'inetOrgPerson'], 'uid': ['a'],
+                                             'cn': ['Åsa Öberg'], 'userPassword': [b'{SSHA}\x00\xff']}),
+            DeleteOperation('uid=b,' + PEOPLE),
+            ModifyOperation('uid=c,' + PEOPLE, 'sn', ['Last']),
+            ModifyOperation('uid=c,' + PEOPLE, 'mail', []),
+            ModifyValuesOperation('cn=g,ou=groups,dc=esmgquadrivium,dc=nl', 'member', ['uid=a,' + PEOPLE],
+                                  ['uid=b,' + PEOPLE]),
+            ModifyAttributesOperation('uid=c,' + PEOPLE, {'sn': [(MODIFY_REPLACE, ['X'])],
+                                                          'mail': [(MODIFY_ADD, ['c@example.com'])]}),
+            ModifyDNOperation('uid=c,' + PEOPLE, 'uid=d,' + PEOPLE),
+            ModifyDNOperation('uid=d,' + PEOPLE, 'uid=d,ou=archive,dc=esmgquadrivium,dc=nl'),
+            ModifyDNOperation(r'cn=Doe\, John,' + PEOPLE, r'cn=Doe\, Jane,' + PEOPLE),
+        ]
+        self.assertEqual(operations, self.round_trip(operations))
+
+    def test_unsafe_values(self):
+        """Values that are not safe strings are base64 encoded and long lines are folded."""
+        values = [' leading space', 'trailing space ', ':colon', '<less', 'line\nbreak', 'x' * 200]
+        operations = [ModifyOperation('uid=a,' + PEOPLE, 'description', values)]
+        f = io.StringIO()
+        write_ldif(operations, f)
+        self.assertTrue(all(len(line) <= 76 for line in f.getvalue().splitlines()))
+        self.assertIn('description:: IGxlYWRpbmcgc3BhY2U=', f.getvalue())
+        f.seek(0)
+        self.assertEqual(operations, list(read_ldif(f)))
+
+    def test_invalid(self):
+        with self.assertRaises(LDIFError):
+            list(read_ldif(io.StringIO('dn: uid=a\nuid: a\n')))
+
+
+class ApplyLDIFTestCase(TestCase):
+    def setUp(self):
+        self.conn = get_mock_connection({
+            'uid=a,' + PEOPLE: {'objectClass': ['esmgqPerson'], 'uid': 'a'},
+        }, raise_exceptions=False)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'plan.ldif')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, operations):
+        with open(self.path, 'w') as f:
+            write_ldif(operations, f)
+
+    def exists(self, uid):
+        self.conn.search(PEOPLE, '(uid={})'.format(uid))
+        return bool(self.conn.entries)
+
+    def test_apply(self):
+        """Records are applied in batches and the checkpoint is removed when done."""
+        self.write([AddOperation('uid={},{}'.format(uid, PEOPLE), {'objectClass': ['esmgqPerson'], 'uid': [uid]})
+                    for uid in 'bcdef'])
+        applied = []
+        results = apply_ldif(self.conn, self.path, batch_size=2, on_applied=applied.append)
+        self.assertEqual(5, len(results))
+        self.assertEqual([2, 2, 1], [len(a) for a in applied])
+        self.assertTrue(self.exists('f'))
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def test_resume(self):
+        """After a failure, the next apply continues with the failed record."""
+        self.write([
+            AddOperation('uid=b,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': ['b']}),
+            ModifyOperation('uid=x,' + PEOPLE, 'sn', ['X']),
+            AddOperation('uid=c,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': ['c']}),
+            AddOperation('uid=d,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': ['d']}),
+        ])
+        with self.assertRaises(ApplyError):
+            apply_ldif(self.conn, self.path, batch_size=3)
+        self.assertTrue(self.exists('c'))
+        self.assertFalse(self.exists('d'))
+
+        # Fix the failure, uid=b and uid=c are not added again
+        self.conn.strategy.add_entry('uid=x,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': 'x'})
+        results = apply_ldif(self.conn, self.path, batch_size=3)
+        self.assertEqual(['uid=x,' + PEOPLE, 'uid=d,' + PEOPLE], [r.operation.dn for r in results])
+        self.assertTrue(all(r.success for r in results))
+
+    def test_skip_failed(self):
+        """Failed records are skipped and not applied again."""
+        self.write([
+            ModifyOperation('uid=x,' + PEOPLE, 'sn', ['X']),
+            AddOperation('uid=b,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': ['b']}),
+            AddOperation('uid=c,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': ['c']}),
+        ])
+        with self.assertRaises(ApplyError):
+            apply_ldif(self.conn, self.path, batch_size=1)
+        results = apply_ldif(self.conn, self.path, batch_size=1, skip_failed=True)
+        self.assertEqual([False, True, True], [r.success for r in results])
+        self.assertTrue(self.exists('c'))
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def test_other_plan(self):
+        """A checkpoint of a different plan is refused."""
+        with open(self.path + '.checkpoint', 'w') as f:
+            f.write('{"digest": "other", "applied": 1, "done": []}')
+        self.write([DeleteOperation('uid=a,' + PEOPLE)])
+        with self.assertRaises(LDIFError):
+            apply_ldif(self.conn, self.path)
@@ -0,0 +1,86 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from members.models import Person
+from sync.ldapentities import LDAPPerson
+from sync.ldapoperations import AddOperation, DeleteOperation
+from sync.models import LDAPSnapshot
+from sync.reconcile import get_reconcile_operations, split_buckets, content_digest
+from sync.tests import get_mock_connection
+
+PEOPLE = 'ou=people,dc=esmgquadrivium,dc=nl'
+
+
+class ReconcileTestCase(TestCase):
+    def setUp(self):
+        for i in range(10):
+            Person.objects.create(username='p{}'.format(i))
+        entries = {dn: dict({k: [str(v) for v in values] for k, values in attributes.items()},
+                            modifyTimestamp='20240101120000Z')
+                   for dn, attributes in LDAPPerson.get_entries().items()}
+        self.conn = get_mock_connection(entries)
+        # First run reads all entries into the snapshot
+        self.assertEqual([], self.reconcile())
+
+    def reconcile(self):
+        return get_reconcile_operations(self.conn, LDAPPerson, bucket_size=3)
+
+    def count_searches(self):
+        return patch.object(self.conn, 'search', wraps=self.conn.search)
+
+    def test_in_sync(self):
+        """Only the changed entries and the DNs are read."""
+        with self.count_searches() as search:
+            self.assertEqual([], self.reconcile())
+        self.assertEqual(2, search.call_count)
+
+    def test_full_read(self):
+        """Reconciling does not count as a full read, a full read is done when it is due."""
+        full_read = LDAPSnapshot.objects.get().full_read
+        self.reconcile()
+        self.assertEqual(full_read, LDAPSnapshot.objects.get().full_read)
+
+        LDAPSnapshot.objects.update(full_read=full_read - timedelta(days=8))
+        self.reconcile()
+        self.assertGreater(LDAPSnapshot.objects.get().full_read, full_read)
+
+    def test_daily(self):
+        """Daily runs, with some delay, on an in-sync directory only do the delta and DN searches."""
+        for _ in range(2):
+            LDAPSnapshot.objects.update(full_read=LDAPSnapshot.objects.get().full_read - timedelta(days=1, hours=1))
+            with self.count_searches() as search:
+                self.assertEqual([], self.reconcile())
+            self.assertEqual(2, search.call_count)
+
+    def test_local_change(self):
+        """Only the bucket with the local change is read."""
+        p = Person.objects.get(username='p4')
+        p.first_name = 'Changed'
+        p.save()
+        with self.count_searches() as search:
+            operations = self.reconcile()
+        self.assertEqual(3, search.call_count)
+        self.assertEqual(['uid=p4,' + PEOPLE], [o.dn for o in operations])
+
+    def test_remote_delete(self):
+        """An entry that was deleted remotely without the snapshot knowing is added again."""
+        p = Person.objects.get(username='p7')
+        dn = 'uid=p7,' + PEOPLE
+        del self.conn.strategy.connection.server.dit[dn]
+        operations = self.reconcile()
+        p.refresh_from_db()
+        self.assertEqual([AddOperation(dn, LDAPPerson(p).get_attributes())], operations)
+
+    def test_no_link(self):
+        """Remote entries without qDBLinkID are deleted."""
+        self.conn.strategy.add_entry('uid=x,' + PEOPLE, {'objectClass': ['esmgqPerson'], 'uid': 'x'})
+        self.assertEqual([DeleteOperation('uid=x,' + PEOPLE)], self.reconcile())
+
+    def test_digest(self):
+        """The bucket digest does not depend on value types, order or case."""
+        a = {'uid=A,' + PEOPLE: {'qDBLinkID': [1], 'objectClass': ['a', 'b']}}
+        b = {'uid=a,' + PEOPLE: {'objectClass': ['B', 'a'], 'qDBLinkID': ['1']}}
+        self.assertEqual(content_digest(a), content_digest(b))
+        self.assertEqual({0: a}, split_buckets(a, bucket_size=2))
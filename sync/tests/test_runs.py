@@ -0,0 +1,91 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from sync.ldapapply import ApplyError, OperationResult
+from sync.ldapoperations import AddOperation, DeleteOperation
+from sync.models import SyncRun, SyncMetricTotal
+from sync.runs import record_run, SCHEDULE
+
+
+class RecordRunTestCase(TestCase):
+    def test_success(self):
+        with record_run('ldap', SCHEDULE) as run:
+            with run.phase('diff'):
+                run.add_operations([DeleteOperation('uid=a'), DeleteOperation('uid=b'), AddOperation('uid=c', {})])
+        r = SyncRun.objects.get()
+        self.assertTrue(r.success)
+        self.assertEqual('ldap', r.target)
+        self.assertEqual(3, r.operation_count)
+        self.assertEqual({'DeleteOperation': 2, 'AddOperation': 1}, r.operation_counts)
+        self.assertEqual(['diff'], list(r.phases))
+
+    def test_apply_error(self):
+        """Failed operations are recorded with their error."""
+        results = [OperationResult(DeleteOperation('uid=a'), True, {}),
+                   OperationResult(DeleteOperation('uid=b'), False, 'noSuchObject')]
+        with self.assertRaises(ApplyError):
+            with record_run('ldap', SCHEDULE):
+                raise ApplyError(results)
+        r = SyncRun.objects.get()
+        self.assertFalse(r.success)
+        self.assertEqual([{'operation': str(DeleteOperation('uid=b')), 'error': 'noSuchObject'}], r.failures)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            with record_run('aad', SCHEDULE):
+                raise ValueError('oops')
+        self.assertEqual([{'operation': '', 'error': 'ValueError: oops'}], SyncRun.objects.get().failures)
+
+    def test_save_error(self):
+        """An error while saving the run is logged, the exception of the sync is raised."""
+        with mock.patch.object(SyncMetricTotal.objects, 'bulk_create', side_effect=RuntimeError('database')):
+            with self.assertRaises(ValueError), self.assertLogs('sync.runs', 'ERROR'):
+                with record_run('aad', SCHEDULE):
+                    raise ValueError('oops')
+        # The run is saved with its metrics or not at all
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_queries(self):
+        """The run is inserted, the metric totals are updated and old runs are deleted, in a savepoint."""
+        with record_run('ldap', SCHEDULE):
+            pass
+        with self.assertNumQueries(8):
+            with record_run('ldap', SCHEDULE):
+                pass
+        self.assertEqual(2.0, SyncMetricTotal.objects.get(metric='tutti_sync_runs').value)
+        self.assertEqual(2.0, sum(SyncMetricTotal.objects.filter(metric='tutti_sync_run_seconds').exclude(le='')
+                                  .values_list('value', flat=True)))
+
+    @override_settings(SYNC_RUN_RETENTION=7)
+    def test_retention(self):
+        old = SyncRun.objects.create(target='ldap', trigger=SCHEDULE, duration=1.0,
+                                     started=timezone.now() - timedelta(days=8))
+        SyncMetricTotal.objects.create(metric='tutti_sync_runs', labels='{"success": "true", "target": "ldap"}',
+                                       le='', value=1.0)
+        with record_run('ldap', SCHEDULE):
+            pass
+        self.assertFalse(SyncRun.objects.filter(pk=old.pk).exists())
+        # The totals keep the deleted runs
+        self.assertEqual(2.0, SyncMetricTotal.objects.get(metric='tutti_sync_runs').value)
+
+
+class SyncRunAdminTestCase(TestCase):
+    def setUp(self):
+        SyncRun.objects.create(target='ldap', trigger=SCHEDULE, duration=2.0, operation_count=10)
+        SyncRun.objects.create(target='ldap', trigger=SCHEDULE, duration=0.0, operation_count=0)
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+
+    def test_changelist(self):
+        response = self.client.get(reverse('admin:sync_syncrun_changelist'))
+        self.assertContains(response, reverse('admin:sync_syncrun_trends'))
+
+    def test_trends(self):
+        response = self.client.get(reverse('admin:sync_syncrun_trends'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(5.0, response.context['days'][0]['throughput'])
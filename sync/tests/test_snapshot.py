@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from sync.ldap import LDAPSearch
+from sync.ldapoperations import DeleteOperation, ModifyDNOperation, ModifyOperation
+from sync.models import LDAPSnapshot
+from sync.snapshot import RemoteSnapshot
+from sync.tests import get_mock_connection
+
+SEARCH = LDAPSearch(base_dn='ou=people,dc=esmgquadrivium,dc=nl', object_class='esmgqPerson', attributes=['uid'])
+
+
+def person(uid, timestamp):
+    return 'uid={},ou=people,dc=esmgquadrivium,dc=nl'.format(uid), {
+        'objectClass': ['esmgqPerson'], 'uid': uid, 'modifyTimestamp': timestamp,
+    }
+
+
+class RemoteSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.conn = get_mock_connection(dict([person('a', '20240101120000Z'), person('b', '20240102120000Z')]))
+
+    def test_full_read(self):
+        """The first refresh reads all entries, without the timestamp."""
+        entries = RemoteSnapshot(SEARCH).refresh(self.conn)
+        self.assertEqual({'uid=a,ou=people,dc=esmgquadrivium,dc=nl': {'uid': ['a']},
+                          'uid=b,ou=people,dc=esmgquadrivium,dc=nl': {'uid': ['b']}}, entries)
+        model = LDAPSnapshot.objects.get()
+        self.assertEqual('20240102120000Z', model.high_water_mark)
+        self.assertIsNotNone(model.full_read)
+
+    def test_delta(self):
+        """Later refreshes only read changed entries and patch them in."""
+        RemoteSnapshot(SEARCH).refresh(self.conn)
+        # Change a directly on the mock server, the snapshot doesn't know about it
+        self.conn.strategy.connection.server.dit['uid=a,ou=people,dc=esmgquadrivium,dc=nl']['uid'] = [b'changed']
+        dn, attributes = person('c', '20240103120000Z')
+        self.conn.strategy.add_entry(dn, attributes)
+        entries = RemoteSnapshot(SEARCH).refresh(self.conn)
+        self.assertEqual({'uid': ['a']}, entries['uid=a,ou=people,dc=esmgquadrivium,dc=nl'])
+        self.assertEqual({'uid': ['c']}, entries['uid=c,ou=people,dc=esmgquadrivium,dc=nl'])
+        self.assertEqual('20240103120000Z', LDAPSnapshot.objects.get().high_water_mark)
+
+    def test_full_read_interval(self):
+        """A full read is done when the interval has passed."""
+        RemoteSnapshot(SEARCH).refresh(self.conn)
+        LDAPSnapshot.objects.update(full_read=timezone.now() - timedelta(days=8))
+        self.conn.strategy.connection.server.dit['uid=a,ou=people,dc=esmgquadrivium,dc=nl']['uid'] = [b'changed']
+        entries = RemoteSnapshot(SEARCH).refresh(self.conn)
+        self.assertEqual({'uid': ['changed']}, entries['uid=a,ou=people,dc=esmgquadrivium,dc=nl'])
+
+    def test_forget(self):
+        """Deleted and renamed entries are dropped."""
+        RemoteSnapshot(SEARCH).refresh(self.conn)
+        RemoteSnapshot(SEARCH).forget([
+            DeleteOperation('uid=a,ou=people,dc=esmgquadrivium,dc=nl'),
+            ModifyDNOperation('uid=B,ou=people,dc=esmgquadrivium,dc=nl', 'uid=d,ou=people,dc=esmgquadrivium,dc=nl'),
+            ModifyOperation('uid=d,ou=people,dc=esmgquadrivium,dc=nl', 'uid', ['d']),
+        ])
+        self.assertEqual({}, RemoteSnapshot(SEARCH).entries)
@@ -1,7 +1,9 @@
 from django.test import TestCase
+from ldap3 import MODIFY_REPLACE, MODIFY_DELETE, MODIFY_ADD
 
-from sync.ldapoperations import AddOperation, DeleteOperation, ModifyDNOperation, ModifyOperation
-from sync.sync import sync
+from sync.ldapoperations import AddOperation, DeleteOperation, ModifyDNOperation, ModifyOperation, \
+    ModifyAttributesOperation, ModifyValuesOperation
+from sync.sync import sync, merge_modifications
 
 
 class SyncTestCase(TestCase):
@@ -81,3 +83,88 @@ class SyncTestCase(TestCase):
         expect = [DeleteOperation('uid=test'), AddOperation('uid=test', {'uid': ['test'], 'id': [1]})]
         self.assertEqual(expect, operations1)
         self.assertEqual(expect, operations2)
+
+    def test_stream(self):
+        """Datasets can be given as a stream of (DN, attributes) tuples."""
+        change_to = {'uid=test': {'uid': ['test'], 'id': [1]}, 'uid=new': {'uid': ['new'], 'id': [2]}}
+        to_change = iter([('uid=test', {'uid': ['old'], 'id': [1]}), ('uid=nolink', {'uid': ['nolink']})])
+        operations = sync(change_to, to_change, on='id')
+        expect = [DeleteOperation('uid=nolink'),
+                  AddOperation('uid=new', {'uid': ['new'], 'id': [2]}),
+                  ModifyOperation('uid=test', 'uid', ['test'])]
+        self.assertEqual(expect, operations)
+
+    def test_modify_multiple(self):
+        """Changes to multiple attributes of an entry are merged into one operation."""
+        change_to = {'uid=test': {'uid': ['test'], 'cn': ['Piet Jansen'], 'givenName': ['Piet'], 'id': [4]}}
+        to_change = {'uid=test2': {'uid': ['test2'], 'cn': ['Henk Jansen'], 'sn': ['Jansen'], 'id': [4]}}
+        operations = sync(change_to, to_change, on='id')
+        self.assertEqual([ModifyDNOperation('uid=test2', 'uid=test'),
+                          ModifyAttributesOperation('uid=test', {
+                              'sn': [(MODIFY_REPLACE, [])],
+                              'uid': [(MODIFY_REPLACE, ['test'])],
+                              'cn': [(MODIFY_REPLACE, ['Piet Jansen'])],
+                              'givenName': [(MODIFY_REPLACE, ['Piet'])],
+                          })], operations)
+
+    def test_modify_multi_valued(self):
+        """For multi-valued attributes only the changed values are added and deleted."""
+        change_to = {'cn=group': {'member': ['uid=a', 'uid=b', 'uid=d'], 'cn': ['group'], 'id': [4]}}
+        to_change = {'cn=group': {'member': ['uid=a', 'uid=b', 'uid=c'], 'cn': ['Group'], 'id': [4]}}
+        operations = sync(change_to, to_change, on='id', multi_valued=['member'])
+        self.assertEqual([ModifyAttributesOperation('cn=group', {
+            'member': [(MODIFY_DELETE, ['uid=c']), (MODIFY_ADD, ['uid=d'])],
+            'cn': [(MODIFY_REPLACE, ['group'])],
+        })], operations)
+        # When the remote values turn out to differ, the member list is replaced
+        self.assertEqual(ModifyAttributesOperation('cn=group', {
+            'member': [(MODIFY_REPLACE, ['uid=a', 'uid=b', 'uid=d'])],
+            'cn': [(MODIFY_REPLACE, ['group'])],
+        }), operations[0].get_fallback())
+
+    def test_modify_multi_valued_add(self):
+        change_to = {'cn=group': {'member': ['uid=a', 'uid=b'], 'id': [4]}}
+        to_change = {'cn=group': {'member': ['uid=a'], 'id': [4]}}
+        operations = sync(change_to, to_change, on='id', multi_valued=['member'])
+        self.assertEqual([ModifyValuesOperation('cn=group', 'member', ['uid=b'], [])], operations)
+
+    def test_modify_multi_valued_create_remove(self):
+        """Creating or removing the attribute replaces it."""
+        change_to = {'cn=a': {'member': ['uid=a'], 'id': [1]}, 'cn=b': {'id': [2]}}
+        to_change = {'cn=a': {'id': [1]}, 'cn=b': {'member': ['uid=a'], 'id': [2]}}
+        operations = sync(change_to, to_change, on='id', multi_valued=['member'])
+        self.assertCountEqual([ModifyOperation('cn=a', 'member', ['uid=a']),
+                               ModifyOperation('cn=b', 'member', [])], operations)
+
+    def test_mixed_types(self):
+        """Values of different types with the same canonical form are equal."""
+        change_to = {'uid=test': {'uid': ['test'], 'id': [4], 'userPassword': ['{SSHA}x'], 'admin': [True]}}
+        to_change = {'uid=test': {'uid': ['test'], 'id': ['4'], 'userPassword': [b'{SSHA}x'], 'admin': ['TRUE']}}
+        self.assertEqual([], sync(change_to, to_change, on='id'))
+
+    def test_modify_case(self):
+        """A case change is a real change, except for DN values."""
+        change_to = {'cn=group': {'cn': ['Group'], 'member': ['uid=A'], 'id': [4]}}
+        to_change = {'cn=group': {'cn': ['group'], 'member': ['uid=a'], 'id': [4]}}
+        operations = sync(change_to, to_change, on='id')
+        self.assertEqual([ModifyOperation('cn=group', 'cn', ['Group'])], operations)
+
+
+class MergeModificationsTestCase(TestCase):
+    def test_merge(self):
+        operations = [
+            DeleteOperation('uid=a'),
+            ModifyOperation('uid=b', 'cn', ['B']),
+            ModifyOperation('uid=B', 'sn', ['B']),
+            ModifyOperation('uid=c', 'cn', ['C']),
+            ModifyDNOperation('uid=c', 'uid=d'),
+            ModifyOperation('uid=d', 'cn', ['D']),
+        ]
+        expect = [
+            DeleteOperation('uid=a'),
+            ModifyAttributesOperation('uid=b', {'cn': [(MODIFY_REPLACE, ['B'])], 'sn': [(MODIFY_REPLACE, ['B'])]}),
+            ModifyOperation('uid=c', 'cn', ['C']),
+            ModifyDNOperation('uid=c', 'uid=d'),
+            ModifyOperation('uid=d', 'cn', ['D']),
+        ]
+        self.assertEqual(expect, merge_modifications(operations))
@@ -0,0 +1,27 @@
+"""Timing of the phases of a sync run."""
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class PhaseTimer:
+    """Records the time spent in named phases.
+
+    Attributes:
+        durations: Dictionary from phase name onto the total seconds spent.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """Context manager that adds the time spent inside it to the given phase."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        """Adds the given time to a phase."""
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
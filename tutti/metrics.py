@@ -0,0 +1,268 @@
+"""Metrics registry with Prometheus text format output.
+
+Counters and histograms are kept per process. The web server runs several
+processes and a scrape is served by any one of them, so these are not
+exposed from the process itself. Instead, ProcessFiles sums the metrics of
+all processes. Metrics that are stored elsewhere, e.g. the task queue depth,
+are computed when scraped by collector functions, see register_collector().
+
+Docs: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import json
+import os
+import threading
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Tuple, Iterable, Callable, List, Any
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Sample = Tuple[str, Dict[str, str], float]
+"""A sample with name, labels and value."""
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+               for k, v in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value))
+
+
+class Metric:
+    """Base class for a metric with a fixed set of label names."""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Expected labels {}, got {}'.format(self.labelnames, tuple(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def get_values(self) -> Dict[Tuple[str, ...], Any]:
+        """Returns a copy of the values by label values."""
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name + '_total', dict(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+    """Counts observations, e.g. durations in seconds, in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def add(self, counts: Dict[float, float], total: float, **labels):
+        """Adds observations that were counted elsewhere.
+
+        Args:
+            counts: Number of observations by bucket upper bound, not
+                cumulative. Bounds that are not a bucket of this histogram are
+                counted in the next bucket.
+            total: Sum of the observations.
+        """
+        key = self._key(labels)
+        with self._lock:
+            current, current_total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for bound, count in counts.items():
+                current[bisect_left(self.buckets, bound)] += count
+            self._values[key] = current, current_total + total
+
+    def get_values(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        """Returns a copy of the bucket counts, not cumulative, and the sum by label values."""
+        with self._lock:
+            return {k: (list(counts), total) for k, (counts, total) in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the seconds spent inside it."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of metrics and scrape-time collectors."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Adds a metric, returns the already registered one if the name is taken."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+        """Adds a function that is called on each scrape.
+
+        The function returns (name, type, documentation, samples) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> Iterable[Tuple[str, str, str, List[Sample]]]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            yield metric.name, metric.type, metric.documentation, metric.samples()
+        for collector in collectors:
+            yield from collector()
+
+    def generate(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for name, metric_type, documentation, samples in self.collect():
+            if metric_type == 'counter' and not name.endswith('_total'):
+                # The samples of a counter have the _total suffix
+                name += '_total'
+            lines.append('# HELP {} {}'.format(name, documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for sample_name, labels, value in samples:
+                lines.append('{}{} {}'.format(sample_name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _empty_copy(metric: Metric) -> Metric:
+    if isinstance(metric, Histogram):
+        return Histogram(metric.name, metric.documentation, metric.labelnames, metric.buckets[:-1])
+    return type(metric)(metric.name, metric.documentation, metric.labelnames)
+
+
+class ProcessFiles:
+    """Sums counters and histograms over the processes of a server, e.g. the gunicorn workers.
+
+    Each process writes the values of its metrics to its own file in a shared
+    directory, see save(). When scraped, the files of all processes are
+    summed, so the result does not depend on the process that serves the
+    scrape. The files of processes that have exited are kept, so the totals
+    only go up.
+    """
+
+    def __init__(self, directory: str, metrics: Iterable[Metric]):
+        self.directory = directory
+        self.metrics = list(metrics)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._name = None
+
+    def _get_path(self) -> str:
+        # A forked process gets its own file, e.g. with gunicorn --preload
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._name = '{}-{}.json'.format(self._pid, uuid.uuid4().hex)
+        return os.path.join(self.directory, self._name)
+
+    def save(self):
+        """Writes the values of the metrics of this process to its file."""
+        data = {m.name: [[list(k), v] for k, v in m.get_values().items()] for m in self.metrics}
+        with self._lock:
+            path = self._get_path()
+            os.makedirs(self.directory, exist_ok=True)
+            # Replaced at once, so that a scrape never reads a partial file
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+
+    def collect(self) -> Iterable[Tuple[str, str, str, List[Sample]]]:
+        """Collector for Registry.register_collector() with the sum of all processes."""
+        totals = {m.name: _empty_copy(m) for m in self.metrics}
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        for name in sorted(n for n in names if n.endswith('.json')):
+            with open(os.path.join(self.directory, name)) as f:
+                data = json.load(f)
+            for metric in totals.values():
+                for key, value in data.get(metric.name, []):
+                    labels = dict(zip(metric.labelnames, key))
+                    if isinstance(metric, Histogram):
+                        metric.add(dict(zip(metric.buckets, value[0])), value[1], **labels)
+                    else:
+                        metric.inc(value, **labels)
+        for metric in totals.values():
+            yield metric.name, metric.type, metric.documentation, metric.samples()
+
+
+REGISTRY = Registry()
+"""Default registry."""
+
+
+def register_collector(collector):
+    """Adds a scrape-time collector to the default registry, can be used as decorator."""
+    REGISTRY.register_collector(collector)
+    return collector
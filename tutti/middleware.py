@@ -0,0 +1,34 @@
+from time import perf_counter
+
+from django.conf import settings
+
+from tutti.metrics import Histogram, ProcessFiles, register_collector
+
+REQUEST_SECONDS = Histogram('tutti_http_request_seconds', 'Latency of HTTP requests by view.',
+                            ['view', 'method', 'status'])
+
+PROCESS_FILES = ProcessFiles(settings.METRICS_DIR, [REQUEST_SECONDS])
+register_collector(PROCESS_FILES.collect)
+
+
+class RequestLatencyMiddleware:
+    """Records the latency of each request per view.
+
+    The view name is used as label instead of the path, so that the number of
+    label values stays bounded. The latencies are summed over the server
+    processes, see tutti.metrics.ProcessFiles.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        REQUEST_SECONDS.observe(perf_counter() - start,
+                                view=match.view_name if match else '<unresolved>',
+                                method=request.method,
+                                status=response.status_code)
+        PROCESS_FILES.save()
+        return response
@@ -1,5 +1,6 @@
 import os
 import os.path
+import tempfile
 from email.utils import getaddresses
 
 import environ
@@ -72,6 +73,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so that the latency includes the other middleware
+    'tutti.middleware.RequestLatencyMiddleware',
     'django.middleware.security.SecurityMiddleware',
     # We're using WhiteNoise for the static files
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -162,6 +165,21 @@ LDAP_HOST = os.getenv('DJANGO_LDAP_HOST')  # Can be in URI form
 LDAP_USER = os.getenv('DJANGO_LDAP_USER')
 LDAP_PASSWORD = getenv_with_file('DJANGO_LDAP_PASSWORD')
 LDAP_START_TLS = env.bool("DJANGO_LDAP_START_TLS", default=False)
+# Number of idle LDAP connections kept per process, and the number of seconds
+# after which an idle connection is closed.
+LDAP_POOL_SIZE = env.int("DJANGO_LDAP_POOL_SIZE", default=4)
+LDAP_POOL_MAX_IDLE = env.int("DJANGO_LDAP_POOL_MAX_IDLE", default=300)
+# Number of entries per page when reading from LDAP.
+LDAP_PAGE_SIZE = env.int("DJANGO_LDAP_PAGE_SIZE", default=500)
+# Hours after which the LDAP sync reads all remote entries instead of only the
+# changed ones. This is a safety net on top of the daily reconciliation, it
+# needs to be several days so that the daily runs don't read everything.
+LDAP_SNAPSHOT_FULL_INTERVAL = env.int("DJANGO_LDAP_SNAPSHOT_FULL_INTERVAL", default=7 * 24)
+# Number of qDBLinkIDs per bucket for the daily LDAP reconciliation, only
+# buckets that differ are read from LDAP, see sync.reconcile.
+LDAP_RECONCILE_BUCKET_SIZE = env.int("DJANGO_LDAP_RECONCILE_BUCKET_SIZE", default=100)
+# Maximum number of LDAP write operations in flight when applying a sync.
+LDAP_PIPELINE_WINDOW = env.int("DJANGO_LDAP_PIPELINE_WINDOW", default=16)
 # When True, an LDAP sync will be triggered after saving a person or group.
 LDAP_SYNC_ON_SAVE = env.bool("DJANGO_LDAP_SYNC_ON_SAVE", default=False)
 
@@ -244,6 +262,19 @@ Q_CLUSTER = {
     'poll': 30,  # Poll the database every 30 seconds for tasks
 }
 
+# Syncs triggered by saving objects wait this many seconds, triggers arriving
+# in the meantime are merged into the same sync.
+SYNC_DEBOUNCE = env.int("DJANGO_SYNC_DEBOUNCE", default=10)
+
+# Bearer token for the /metrics endpoint, which is denied when this is not set.
+METRICS_TOKEN = getenv_with_file("DJANGO_METRICS_TOKEN")
+
+# Each web server process writes its request metrics to a file in this directory, see tutti.metrics.ProcessFiles.
+METRICS_DIR = os.getenv("DJANGO_METRICS_DIR", os.path.join(tempfile.gettempdir(), "tutti-metrics"))
+
+# Sync runs are deleted after this many days, see sync.runs.
+SYNC_RUN_RETENTION = env.int("DJANGO_SYNC_RUN_RETENTION", default=30)
+
 # ID of the group in the database that holds the current Quadrivium members.
 MEMBERS_GROUP = env.int("MEMBERS_GROUP", default=-1)
 
@@ -258,6 +289,23 @@ BOOTSTRAP4 = {
 GRAPH_TENANT = os.getenv("GRAPH_TENANT")
 GRAPH_CLIENT_ID = os.getenv("GRAPH_CLIENT_ID")
 GRAPH_CLIENT_SECRET = getenv_with_file("GRAPH_CLIENT_SECRET")
+# Base URLs of Microsoft Graph and the token endpoint, can be changed for testing
+GRAPH_URL = os.getenv("GRAPH_URL", "https://graph.microsoft.com/v1.0")
+GRAPH_LOGIN_URL = os.getenv("GRAPH_LOGIN_URL", "https://login.microsoftonline.com")
+# Number of times a throttled (429, 503 or 504) Graph request is retried, and
+# the number of kept-alive connections per host.
+GRAPH_MAX_RETRIES = env.int("GRAPH_MAX_RETRIES", default=5)
+GRAPH_POOL_SIZE = env.int("GRAPH_POOL_SIZE", default=10)
+# Number of Graph requests the AAD sync does at the same time, and the maximum
+# number of requests per second of this process, 0 for no limit.
+GRAPH_CONCURRENCY = env.int("GRAPH_CONCURRENCY", default=4)
+GRAPH_RATE_LIMIT = env.float("GRAPH_RATE_LIMIT", default=0)
+# Seconds after creating an AAD object before its extension and license are
+# added. When the object is not readable yet, the wait is doubled each attempt.
+GRAPH_FOLLOW_UP_DELAY = env.int("GRAPH_FOLLOW_UP_DELAY", default=15)
+# Hours after which all AAD users and groups are read again, instead of only
+# the changes since the last sync.
+GRAPH_DELTA_FULL_INTERVAL = env.int("GRAPH_DELTA_FULL_INTERVAL", default=24)
 # Sync with Azure when a user or group is saved
 GRAPH_SYNC_ON_SAVE = env.bool("GRAPH_SYNC_ON_SAVE", default=False)
 # This license will be assigned when a new user is created in Azure
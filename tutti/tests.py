@@ -0,0 +1,117 @@
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from sync.ldapoperations import AddOperation
+from sync.metrics import LDAP_REQUEST_SECONDS
+from sync.runs import record_run, SCHEDULE
+from tutti.metrics import Registry, Counter, Histogram, ProcessFiles
+from tutti.middleware import PROCESS_FILES
+
+
+class RegistryTestCase(TestCase):
+    def test_counter(self):
+        registry = Registry()
+        c = registry.register(Counter('test_events', 'Events.', ['kind']))
+        c.inc(kind='a')
+        c.inc(2, kind='a')
+        self.assertIn('test_events_total{kind="a"} 3.0', registry.generate())
+
+    def test_histogram(self):
+        registry = Registry()
+        h = registry.register(Histogram('test_seconds', 'Durations.', buckets=[1, 5]))
+        h.observe(0.5)
+        h.observe(1)
+        h.observe(10)
+        text = registry.generate()
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="5.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', text)
+        self.assertIn('test_seconds_sum 11.5', text)
+
+    def test_histogram_add(self):
+        """Bucket counts that were counted elsewhere are added, also for a bound that is not a bucket."""
+        registry = Registry()
+        h = registry.register(Histogram('test_seconds', 'Durations.', buckets=[1, 5]))
+        h.observe(0.5)
+        h.add({1.0: 2, 3.0: 1, float('inf'): 1}, 20.0)
+        self.assertEqual({(): ([3, 1, 1], 20.5)}, h.get_values())
+        self.assertIn('test_seconds_bucket{le="5.0"} 4.0', registry.generate())
+
+    def test_wrong_labels(self):
+        with self.assertRaises(ValueError):
+            Counter('test', '', ['kind']).inc(other='a')
+
+    def test_label_escaping(self):
+        registry = Registry()
+        registry.register(Counter('test', '', ['path'])).inc(path='a"b\\c')
+        self.assertIn(r'test_total{path="a\"b\\c"} 1.0', registry.generate())
+
+
+class ProcessFilesTestCase(TestCase):
+    def test_sum(self):
+        """The metrics of all processes are summed, also of processes that have exited."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for seconds in (0.5, 10):
+            h = Histogram('test_seconds', 'Durations.', ['view'], buckets=[1, 5])
+            c = Counter('test_events', 'Events.')
+            h.observe(seconds, view='a')
+            c.inc()
+            # A process with its own metrics and file
+            ProcessFiles(directory.name, [h, c]).save()
+        registry = Registry()
+        registry.register_collector(ProcessFiles(directory.name, [h, c]).collect)
+        text = registry.generate()
+        self.assertIn('test_seconds_bucket{view="a",le="1.0"} 1.0', text)
+        self.assertIn('test_seconds_bucket{view="a",le="+Inf"} 2.0', text)
+        self.assertIn('test_seconds_sum{view="a"} 10.5', text)
+        self.assertIn('test_events_total 2.0', text)
+
+
+@override_settings(METRICS_TOKEN='secret')
+class MetricsViewTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(PROCESS_FILES, 'directory', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_metrics(self):
+        return self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+
+    def test_metrics(self):
+        with record_run('ldap', SCHEDULE) as run:
+            run.record('diff', 0.2)
+            run.add_operations([AddOperation('uid=a', {}), AddOperation('uid=b', {})])
+            LDAP_REQUEST_SECONDS.observe(0.02, operation='search')
+        self.get_metrics()
+        response = self.get_metrics()
+        text = response.content.decode()
+        self.assertEqual(200, response.status_code)
+        self.assertIn('# TYPE tutti_sync_runs_total counter', text)
+        self.assertIn('tutti_sync_runs_total{target="ldap",success="true"} 1.0', text)
+        self.assertIn('tutti_sync_operations_total{target="ldap",type="AddOperation"} 2.0', text)
+        self.assertIn('tutti_sync_phase_seconds_count{target="ldap",phase="diff"} 1.0', text)
+        self.assertIn('tutti_sync_phase_seconds_bucket{target="ldap",phase="diff",le="0.25"} 1.0', text)
+        self.assertIn('tutti_sync_phase_seconds_bucket{target="ldap",phase="diff",le="0.1"} 0.0', text)
+        # Requests made in the worker process are stored with the run
+        self.assertIn('tutti_ldap_request_seconds_count{operation="search"} 1.0', text)
+        self.assertIn('tutti_task_queue_depth 0.0', text)
+        # The first request was recorded by the middleware, in the file of this process
+        self.assertIn('tutti_http_request_seconds_count{view="metrics",method="GET",status="200"}', text)
+
+    def test_token(self):
+        self.assertEqual(403, self.client.get(reverse('metrics')).status_code)
+        self.assertEqual(403, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer other').status_code)
+        self.assertEqual(200, self.get_metrics().status_code)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_no_token(self):
+        """Access is denied when no token is configured."""
+        self.assertEqual(403, self.client.get(reverse('metrics')).status_code)
+        self.assertEqual(403, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code)
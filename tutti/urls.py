@@ -1,10 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from tutti.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('oidc/', include('oidc.urls')),
     path('ht/', include('health_check.urls')),
+    path('metrics', metrics, name='metrics'),
     path('penno/', include('pennotools.urls')),
     path('duqduqgo/', include('duqduqgo.urls')),
     path('members/', include('members.urls')),
@@ -0,0 +1,21 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpRequest, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from tutti.metrics import REGISTRY
+
+
+@require_GET
+def metrics(request: HttpRequest):
+    """Metrics in the Prometheus text format.
+
+    The request needs to have the METRICS_TOKEN setting as bearer token in
+    the Authorization header. When the setting is not set, access is denied.
+    """
+    token = (settings.METRICS_TOKEN or '').strip()
+    expected = 'Bearer {}'.format(token)
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.generate(), content_type='text/plain; version=0.0.4; charset=utf-8')